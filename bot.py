@@ -33,7 +33,7 @@ import os
 import httpx
 import urllib.parse
 from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -64,6 +64,12 @@ PANEL_URL = os.getenv('PANEL_URL')
 PANEL_USERNAME = os.getenv('PANEL_USERNAME', 'admin')
 PANEL_PASSWORD = os.getenv('PANEL_PASSWORD')
 
+# Panel HTTP connection pool (shared by all panel API calls)
+PANEL_HTTP_TIMEOUT = float(os.getenv('PANEL_HTTP_TIMEOUT', '30'))
+PANEL_HTTP_MAX_CONNECTIONS = int(os.getenv('PANEL_HTTP_MAX_CONNECTIONS', '20'))
+PANEL_HTTP_MAX_KEEPALIVE = int(os.getenv('PANEL_HTTP_MAX_KEEPALIVE', '10'))
+PANEL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('PANEL_HTTP_KEEPALIVE_EXPIRY', '60'))
+
 # SERVER CONFIG (for subscription links)
 SERVER_IP = os.getenv('SERVER_IP', '127.0.0.1')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '443'))
@@ -241,6 +247,23 @@ VPN_APPS = [
 ]
 
 
+# ==========================
+# PANEL HTTP SESSION
+# ==========================
+def create_panel_session() -> httpx.AsyncClient:
+    """One long-lived pooled client per panel; login only swaps auth on it."""
+    return httpx.AsyncClient(
+        timeout=PANEL_HTTP_TIMEOUT,
+        verify=False,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=PANEL_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=PANEL_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=PANEL_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
 # ==========================
 # 3X-UI API CLASS (VLESS)
 # ==========================
@@ -251,6 +274,18 @@ class XUIClient:
         self.password = password
         self.session = None
         self.logged_in = False
+        self._login_lock = asyncio.Lock()
+    
+    def _get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            self.session = create_panel_session()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+        self.logged_in = False
     
     async def restart_xray(self) -> bool:
         if not self.logged_in:
@@ -279,14 +314,19 @@ class XUIClient:
         return False
     
     async def login(self) -> bool:
+        # One login at a time; callers queued behind it reuse the fresh session
+        async with self._login_lock:
+            if self.logged_in:
+                return True
+            return await self._login()
+    
+    async def _login(self) -> bool:
         if not self.base_url:
             return False
         try:
-            self.session = httpx.AsyncClient(
-                timeout=30.0,
-                verify=False,
-                follow_redirects=True,
-            )
+            # The login response replaces the cookie on the pooled session, so
+            # requests already in flight keep using the old one until then
+            self._get_session()
             
             login_url = f"{self.base_url}/login"
             response = await self.session.post(
@@ -438,6 +478,12 @@ class XUIClient:
 xui = XUIClient(PANEL_URL, PANEL_USERNAME, PANEL_PASSWORD)
 
 
+async def close_panel_sessions():
+    for panel in (xui,):
+        if panel:
+            await panel.close()
+
+
 # ==========================
 # WAITING ANIMATION
 # ==========================
@@ -1052,6 +1098,13 @@ async def admin_panel(client: Client, message: Message):
 # ==========================
 # MAIN
 # ==========================
+async def main():
+    await app.start()
+    await idle()
+    await app.stop()
+    await close_panel_sessions()
+
+
 if __name__ == "__main__":
     print("=" * 50)
     print("🚀 Zembi VPN Bot")
@@ -1060,7 +1113,7 @@ if __name__ == "__main__":
     print("=" * 50)
     
     try:
-        app.run()
+        app.run(main())
     except Exception as e:
         print(f"❌ Error: {e}")
         sys.exit(1)
\ No newline at end of file
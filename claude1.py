@@ -32,7 +32,7 @@ import os
 import httpx
 import urllib.parse
 from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -63,6 +63,12 @@ PANEL_URL = os.getenv('PANEL_URL')
 PANEL_USERNAME = os.getenv('PANEL_USERNAME', 'admin')
 PANEL_PASSWORD = os.getenv('PANEL_PASSWORD')
 
+# Panel HTTP connection pool (shared by all panel API calls)
+PANEL_HTTP_TIMEOUT = float(os.getenv('PANEL_HTTP_TIMEOUT', '30'))
+PANEL_HTTP_MAX_CONNECTIONS = int(os.getenv('PANEL_HTTP_MAX_CONNECTIONS', '20'))
+PANEL_HTTP_MAX_KEEPALIVE = int(os.getenv('PANEL_HTTP_MAX_KEEPALIVE', '10'))
+PANEL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('PANEL_HTTP_KEEPALIVE_EXPIRY', '60'))
+
 # SERVER CONFIG (for subscription links)
 SERVER_IP = os.getenv('SERVER_IP', '127.0.0.1')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '443'))
@@ -243,6 +249,23 @@ VPN_APPS = [
 ]
 
 
+# ==========================
+# PANEL HTTP SESSION
+# ==========================
+def create_panel_session() -> httpx.AsyncClient:
+    """One long-lived pooled client per panel; login only swaps auth on it."""
+    return httpx.AsyncClient(
+        timeout=PANEL_HTTP_TIMEOUT,
+        verify=False,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=PANEL_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=PANEL_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=PANEL_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
 # ==========================
 # 3X-UI API CLASS (VLESS)
 # ==========================
@@ -253,6 +276,18 @@ class XUIClient:
         self.password = password
         self.session = None
         self.logged_in = False
+        self._login_lock = asyncio.Lock()
+    
+    def _get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            self.session = create_panel_session()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+        self.logged_in = False
     
     async def restart_xray(self) -> bool:
         if not self.logged_in:
@@ -281,14 +316,19 @@ class XUIClient:
         return False
     
     async def login(self) -> bool:
+        # One login at a time; callers queued behind it reuse the fresh session
+        async with self._login_lock:
+            if self.logged_in:
+                return True
+            return await self._login()
+    
+    async def _login(self) -> bool:
         if not self.base_url:
             return False
         try:
-            self.session = httpx.AsyncClient(
-                timeout=30.0,
-                verify=False,
-                follow_redirects=True,
-            )
+            # The login response replaces the cookie on the pooled session, so
+            # requests already in flight keep using the old one until then
+            self._get_session()
             
             login_url = f"{self.base_url}/login"
             response = await self.session.post(
@@ -447,18 +487,36 @@ class MarzbanClient:
         self.session = None
         self.access_token = None
         self.logged_in = False
+        self._login_lock = asyncio.Lock()
+    
+    def _get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            self.session = create_panel_session()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+        self.access_token = None
+        self.logged_in = False
     
     async def login(self) -> bool:
+        # One login at a time; callers queued behind it reuse the fresh session
+        async with self._login_lock:
+            if self.logged_in:
+                return True
+            return await self._login()
+    
+    async def _login(self) -> bool:
         if not self.base_url:
             logger.error("Marzban URL not configured")
             return False
         
         try:
-            self.session = httpx.AsyncClient(
-                timeout=30.0,
-                verify=False,
-                follow_redirects=True,
-            )
+            # The token is only swapped once the new one arrives, so requests
+            # already in flight keep using the old one
+            self._get_session()
             
             login_url = f"{self.base_url}/api/admin/token"
             response = await self.session.post(
@@ -567,6 +625,12 @@ xui = XUIClient(PANEL_URL, PANEL_USERNAME, PANEL_PASSWORD)
 marzban = MarzbanClient(MARZBAN_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD)
 
 
+async def close_panel_sessions():
+    for panel in (xui, marzban):
+        if panel:
+            await panel.close()
+
+
 # ==========================
 # WAITING ANIMATION
 # ==========================
@@ -1188,6 +1252,13 @@ async def admin_panel(client: Client, message: Message):
 # ==========================
 # MAIN
 # ==========================
+async def main():
+    await app.start()
+    await idle()
+    await app.stop()
+    await close_panel_sessions()
+
+
 if __name__ == "__main__":
     print("=" * 50)
     print("🚀 Zembi VPN Bot")
@@ -1195,7 +1266,7 @@ if __name__ == "__main__":
     print("=" * 50)
     
     try:
-        app.run()
+        app.run(main())
     except Exception as e:
         print(f"❌ Error: {e}")
         sys.exit(1)
@@ -35,8 +35,9 @@ import asyncio
 import os
 import httpx
 import urllib.parse
+from collections import deque
 from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -68,6 +69,22 @@ PANEL_URL = os.getenv('PANEL_URL')
 PANEL_USERNAME = os.getenv('PANEL_USERNAME', 'admin')
 PANEL_PASSWORD = os.getenv('PANEL_PASSWORD')
 
+# Panel HTTP connection pool (shared by all panel API calls)
+PANEL_HTTP_TIMEOUT = float(os.getenv('PANEL_HTTP_TIMEOUT', '30'))
+PANEL_HTTP_MAX_CONNECTIONS = int(os.getenv('PANEL_HTTP_MAX_CONNECTIONS', '20'))
+PANEL_HTTP_MAX_KEEPALIVE = int(os.getenv('PANEL_HTTP_MAX_KEEPALIVE', '10'))
+PANEL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('PANEL_HTTP_KEEPALIVE_EXPIRY', '60'))
+
+# Panel circuit breaker: open when PANEL_BREAKER_ERROR_RATE of the calls in
+# the last PANEL_BREAKER_WINDOW seconds failed or took longer than
+# PANEL_BREAKER_SLOW_SECONDS (and there were at least PANEL_BREAKER_MIN_CALLS),
+# then fail fast for PANEL_BREAKER_OPEN_SECONDS before probing again
+PANEL_BREAKER_WINDOW = float(os.getenv('PANEL_BREAKER_WINDOW', '60'))
+PANEL_BREAKER_MIN_CALLS = int(os.getenv('PANEL_BREAKER_MIN_CALLS', '5'))
+PANEL_BREAKER_ERROR_RATE = float(os.getenv('PANEL_BREAKER_ERROR_RATE', '0.5'))
+PANEL_BREAKER_OPEN_SECONDS = float(os.getenv('PANEL_BREAKER_OPEN_SECONDS', '30'))
+PANEL_BREAKER_SLOW_SECONDS = float(os.getenv('PANEL_BREAKER_SLOW_SECONDS', '10'))
+
 # SERVER CONFIG (for subscription links)
 SERVER_IP = os.getenv('SERVER_IP', '127.0.0.1')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '443'))
@@ -84,6 +101,9 @@ TRIAL_DURATION_HOURS = int(os.getenv('TRIAL_DURATION_HOURS', '24'))
 TRIAL_TRAFFIC_GB = int(os.getenv('TRIAL_TRAFFIC_GB', '1'))
 TRIAL_DEVICE_LIMIT = int(os.getenv('TRIAL_DEVICE_LIMIT', '1'))
 
+# Max keys per /generate command (all created in one addClient request)
+BULK_GENERATE_MAX = int(os.getenv('BULK_GENERATE_MAX', '50'))
+
 # ==========================
 # PLAN CONFIGURATION
 # ==========================
@@ -217,18 +237,241 @@ VPN_APPS = [
 ]
 
 
+# ==========================
+# PANEL HTTP SESSION
+# ==========================
+def create_panel_session() -> httpx.AsyncClient:
+    """One long-lived pooled client per panel; login only swaps auth on it."""
+    return httpx.AsyncClient(
+        timeout=PANEL_HTTP_TIMEOUT,
+        verify=False,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=PANEL_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=PANEL_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=PANEL_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+# ==========================
+# PANEL CIRCUIT BREAKER
+# ==========================
+class PanelUnavailable(Exception):
+    """Raised instead of calling a panel whose circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Per-panel circuit breaker over a rolling window of calls.
+    
+    Errors (exceptions and 5xx) and calls slower than `slow_seconds` count
+    against the panel. Once at least `min_calls` calls in the last `window`
+    seconds have a bad rate of `error_rate` or more, the circuit opens and
+    calls fail at once with PanelUnavailable. After `open_seconds` a single
+    probe call is let through (half-open); it closes or re-opens the circuit.
+    """
+    
+    def __init__(self, name: str, window: float, min_calls: int, error_rate: float, open_seconds: float, slow_seconds: float):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.slow_seconds = slow_seconds
+        self.calls = deque()   # (timestamp, ok, latency)
+        self.state = "closed"
+        self.opened_until = 0.0
+        self.probing = False
+        self.trips = 0
+    
+    def _trim(self):
+        cutoff = time.monotonic() - self.window
+        while self.calls and self.calls[0][0] < cutoff:
+            self.calls.popleft()
+    
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() >= self.opened_until:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record(self, ok: bool, latency: float):
+        ok = ok and latency < self.slow_seconds
+        if self.state == "half_open":
+            self.probing = False
+            if ok:
+                logger.info(f"🟢 {self.name} circuit closed")
+                self.state = "closed"
+                self.calls.clear()
+            else:
+                self._open()
+            return
+        
+        self.calls.append((time.monotonic(), ok, latency))
+        self._trim()
+        if self.state == "closed" and len(self.calls) >= self.min_calls:
+            bad = sum(1 for _, call_ok, _ in self.calls if not call_ok)
+            if bad / len(self.calls) >= self.error_rate:
+                self._open()
+    
+    def _open(self):
+        self.state = "open"
+        self.opened_until = time.monotonic() + self.open_seconds
+        self.trips += 1
+        logger.error(f"🔴 {self.name} circuit open for {self.open_seconds:.0f}s")
+    
+    async def call(self, send) -> httpx.Response:
+        """Run `send()` (one HTTP request) under the breaker."""
+        if not self.allow():
+            raise PanelUnavailable(f"{self.name} is unavailable (circuit open)")
+        started = time.monotonic()
+        try:
+            response = await send()
+        except asyncio.CancelledError:
+            # Not the panel's fault; just let another probe through
+            self.probing = False
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - started)
+            raise
+        self.record(response.status_code < 500, time.monotonic() - started)
+        return response
+    
+    def health_text(self) -> str:
+        self._trim()
+        if self.state != "closed":
+            wait = max(0, self.opened_until - time.monotonic())
+            state = "🟡 probing" if self.state == "half_open" else f"🔴 down, retry in {wait:.0f}s"
+        else:
+            state = "🟢 up"
+        if not self.calls:
+            return f"{self.name}: {state} (no calls, {self.trips} trips)\n"
+        latencies = sorted(latency for _, _, latency in self.calls)
+        bad = sum(1 for _, ok, _ in self.calls if not ok)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return (
+            f"{self.name}: {state}, {bad * 100 // len(self.calls)}% errors, "
+            f"avg {sum(latencies) / len(latencies) * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms "
+            f"({len(self.calls)} calls, {self.trips} trips)\n"
+        )
+
+
 # ==========================
 # 3X-UI API CLASS
 # ==========================
 class XUIClient:
+    # Panel builds expose the same operation under different paths; the first
+    # one that answers is remembered in self.endpoints until it starts 404ing
+    ENDPOINTS = {
+        "add_client": [
+            "/panel/api/inbounds/addClient",
+            "/panel/inbound/addClient",
+            "/xui/API/inbounds/addClient",
+        ],
+        "restart_xray": [
+            "/panel/setting/restartXrayService",
+            "/server/restartXrayService",
+            "/xui/setting/restartXrayService",
+        ],
+    }
+    
     def __init__(self, base_url: str, username: str, password: str):
         self.base_url = base_url.rstrip("/")
         self.username = username
         self.password = password
         self.session = None
         self.logged_in = False
+        self._login_lock = asyncio.Lock()
+        self.breaker = CircuitBreaker(
+            "3X-UI",
+            window=PANEL_BREAKER_WINDOW,
+            min_calls=PANEL_BREAKER_MIN_CALLS,
+            error_rate=PANEL_BREAKER_ERROR_RATE,
+            open_seconds=PANEL_BREAKER_OPEN_SECONDS,
+            slow_seconds=PANEL_BREAKER_SLOW_SECONDS,
+        )
         # Auto-detect if we need HTTPS
         self.use_https = self.base_url.startswith("https://")
+        self.endpoints = {}
+    
+    def _get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            self.session = create_panel_session()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+        self.logged_in = False
+    
+    async def _post_endpoint(self, op: str, accept=None, **kwargs) -> httpx.Response | None:
+        """
+        POST to the endpoint cached for `op`, probing the known variants
+        when nothing is cached yet or the cached one no longer exists.
+        With `accept(response)`, a JSON reply it rejects also moves on to
+        the next variant, and only an accepted one is cached.
+        """
+        cached = self.endpoints.get(op)
+        candidates = self.ENDPOINTS[op]
+        if cached:
+            candidates = [cached] + [e for e in candidates if e != cached]
+        
+        for endpoint in candidates:
+            url = f"{self.base_url}{endpoint}"
+            try:
+                response = await self.breaker.call(lambda: self.session.post(url, **kwargs))
+            except PanelUnavailable:
+                raise
+            except Exception as e:
+                logger.warning(f"{op} endpoint {endpoint} failed: {e}")
+                continue
+            
+            # A missing route comes back as 404 or as the panel's HTML page
+            if response.status_code != 404:
+                try:
+                    response.json()
+                except ValueError:
+                    pass
+                else:
+                    if accept is None or accept(response):
+                        if endpoint != cached:
+                            logger.info(f"🔎 {op} endpoint detected: {endpoint}")
+                            self.endpoints[op] = endpoint
+                        return response
+                    logger.warning(f"{op} endpoint {endpoint} refused: {response.text[:200]}")
+            
+            if endpoint == cached:
+                logger.warning(f"⚠️ Cached {op} endpoint {endpoint} stopped working, re-probing")
+                self.endpoints.pop(op, None)
+        
+        logger.error(f"All {op} endpoints failed")
+        return None
+    
+    async def discover(self) -> dict:
+        """
+        Probe the panel once at startup so real requests go straight to
+        the right addClient path. Restart is detected on first use since
+        probing it would restart Xray.
+        """
+        if not await self.login():
+            return self.endpoints
+        try:
+            # Inbound 0 never exists, so this is rejected without side effects
+            await self._post_endpoint(
+                "add_client",
+                data={"id": 0, "settings": json.dumps({"clients": []})},
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
+        except Exception as e:
+            logger.warning(f"Panel endpoint discovery failed: {e}")
+        logger.info(f"Panel endpoints: {self.endpoints or 'none detected'}")
+        return self.endpoints
     
     async def restart_xray(self) -> bool:
         """
@@ -239,50 +482,43 @@ class XUIClient:
             if not await self.login():
                 return False
         
-        restart_endpoints = [
-            "/panel/setting/restartXrayService",
-            "/server/restartXrayService", 
-            "/xui/setting/restartXrayService",
-        ]
-        
-        for endpoint in restart_endpoints:
-            try:
-                url = f"{self.base_url}{endpoint}"
-                logger.info(f"Trying to restart Xray via: {url}")
-                resp = await self.session.post(url)
-                
-                if resp.status_code == 200:
-                    try:
-                        data = resp.json()
-                        if data.get("success"):
-                            logger.info(f"✅ Xray restarted successfully via {endpoint}")
-                            return True
-                    except:
-                        pass
-            except Exception as e:
-                logger.warning(f"Restart endpoint {endpoint} failed: {e}")
-                continue
+        try:
+            # A variant that answers success=false is skipped, like a missing one
+            resp = await self._post_endpoint(
+                "restart_xray",
+                accept=lambda r: r.status_code == 200 and r.json().get("success"),
+            )
+            if resp is not None:
+                logger.info(f"✅ Xray restarted successfully via {self.endpoints['restart_xray']}")
+                return True
+        except Exception as e:
+            logger.warning(f"Xray restart failed: {e}")
         
         logger.warning("⚠️ Could not restart Xray - IP limits may not apply until manual restart")
         return False
     
     async def login(self) -> bool:
+        # One login at a time; callers queued behind it reuse the fresh session
+        async with self._login_lock:
+            if self.logged_in:
+                return True
+            return await self._login()
+    
+    async def _login(self) -> bool:
         try:
             # Use HTTPS if the URL starts with https
-            self.session = httpx.AsyncClient(
-                timeout=30.0,
-                verify=False,  # Skip SSL verification
-                follow_redirects=True,
-            )
+            self._get_session()
+            # The login response replaces the cookie on the pooled session, so
+            # requests already in flight keep using the old one until then
             
             login_url = f"{self.base_url}/login"
             logger.info(f"Attempting login to: {login_url}")
             
-            response = await self.session.post(
+            response = await self.breaker.call(lambda: self.session.post(
                 login_url,
                 data={"username": self.username, "password": self.password},
                 headers={"Content-Type": "application/x-www-form-urlencoded"}
-            )
+            ))
             
             logger.info(f"Login response: {response.status_code}")
             logger.info(f"Login response URL: {response.url}")  # Debug: see final URL after redirects
@@ -332,7 +568,7 @@ class XUIClient:
         try:
             api_url = f"{self.base_url}/panel/api/inbounds/list"
             logger.info(f"Getting inbounds from: {api_url}")
-            response = await self.session.get(api_url)
+            response = await self.breaker.call(lambda: self.session.get(api_url))
             
             logger.info(f"Get inbounds response: {response.status_code}")
             
@@ -380,124 +616,138 @@ class XUIClient:
             expiry_days: Number of days until expiry
             ip_limit: Maximum concurrent IPs/devices
         """
+        results = await self.add_clients(
+            inbound_id=inbound_id,
+            count=1,
+            email=email,
+            tg_username=tg_username,
+            uuid_strs=[uuid_str] if uuid_str else None,
+            traffic_limit_gb=traffic_limit_gb,
+            expiry_days=expiry_days,
+            ip_limit=ip_limit,
+        )
+        return results[0] if results else None
+    
+    async def add_clients(
+        self,
+        inbound_id: int,
+        count: int,
+        email: str,
+        tg_username: str = "",
+        uuid_strs: list = None,
+        traffic_limit_gb: int = 0,
+        expiry_days: int = 30,
+        ip_limit: int = 1,
+    ) -> list:
+        """
+        Add several clients to an inbound in one addClient request.
+        
+        The inbound is looked up once and Xray is restarted once for the
+        whole batch. Returns one result dict per client (same shape as
+        add_client), or an empty list if the panel rejected the batch.
+        """
         try:
             if not self.logged_in:
                 if not await self.login():
                     logger.error("Failed to login before adding client")
-                    return None
+                    return []
             
             inbound = await self.get_inbound(inbound_id)
             if not inbound:
                 logger.error(f"Inbound {inbound_id} not found. Check your INBOUND_ID settings.")
-                return None
+                return []
             
-            client_uuid = uuid_str or str(uuid.uuid4())
             expiry_time = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
             traffic_limit = traffic_limit_gb * 1024 * 1024 * 1024 if traffic_limit_gb > 0 else 0
             
             # Use telegram username as the client remark/email
-            client_email = f"{tg_username}_{int(time.time())}" if tg_username else email
+            base_email = f"{tg_username}_{int(time.time())}" if tg_username else email
             
-            # Client settings for VLESS
-            client_settings = {
-                "id": client_uuid,
-                "email": client_email,
-                "limitIp": ip_limit,
-                "totalGB": traffic_limit,
-                "expiryTime": expiry_time,
-                "enable": True,
-                "tgId": "",
-                "subId": client_email,
-                "flow": ""  # Empty for non-XTLS, or "xtls-rprx-vision" for XTLS
-            }
+            clients = []
+            for i in range(count):
+                client_email = base_email if count == 1 else f"{base_email}_{i + 1}"
+                client_uuid = uuid_strs[i] if uuid_strs and i < len(uuid_strs) else str(uuid.uuid4())
+                
+                # Client settings for VLESS
+                clients.append({
+                    "id": client_uuid,
+                    "email": client_email,
+                    "limitIp": ip_limit,
+                    "totalGB": traffic_limit,
+                    "expiryTime": expiry_time,
+                    "enable": True,
+                    "tgId": "",
+                    "subId": client_email,
+                    "flow": ""  # Empty for non-XTLS, or "xtls-rprx-vision" for XTLS
+                })
             
             # Prepare the request data
-            settings_json = json.dumps({"clients": [client_settings]})
+            settings_json = json.dumps({"clients": clients})
             
-            logger.info(f"Adding client to inbound {inbound_id}")
-            logger.info(f"Client email: {client_email}, IP limit: {ip_limit}")
+            logger.info(f"Adding {count} client(s) to inbound {inbound_id}")
+            logger.info(f"Client email: {base_email}, IP limit: {ip_limit}")
             logger.info(f"Settings: {settings_json}")
             
-            # Try multiple API endpoints
-            api_endpoints = [
-                "/panel/api/inbounds/addClient",
-                "/panel/inbound/addClient",
-                "/xui/API/inbounds/addClient",
-            ]
+            response = await self._post_endpoint(
+                "add_client",
+                data={
+                    "id": inbound_id,
+                    "settings": settings_json
+                },
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            if response is None:
+                logger.error("No add_client endpoint found on the panel")
+                return []
             
-            for endpoint in api_endpoints:
+            logger.info(f"Add client response status: {response.status_code}")
+            logger.info(f"Add client response: {response.text[:500] if response.text else 'empty'}")
+            
+            if response.status_code == 200:
                 try:
-                    api_url = f"{self.base_url}{endpoint}"
-                    logger.info(f"Trying to add client via: {api_url}")
-                    
-                    # Method 1: Form data with id and settings
-                    response = await self.session.post(
-                        api_url,
-                        data={
-                            "id": inbound_id,
-                            "settings": settings_json
-                        },
-                        headers={"Content-Type": "application/x-www-form-urlencoded"}
-                    )
-                    
-                    logger.info(f"Add client response status: {response.status_code}")
-                    logger.info(f"Add client response: {response.text[:500] if response.text else 'empty'}")
-                    
-                    if response.status_code == 200:
-                        try:
-                            result = response.json()
-                            if result.get("success"):
-                                logger.info(f"✅ Client added successfully: {client_email} with IP limit: {ip_limit}")
-                                
-                                # Restart Xray to apply IP limit
-                                logger.info("🔄 Restarting Xray to apply IP limit...")
-                                restart_success = await self.restart_xray()
-                                if restart_success:
-                                    logger.info("✅ Xray restarted - IP limit is now active!")
-                                else:
-                                    logger.warning("⚠️ Xray restart failed - IP limit may not work until manual restart")
-                                
-                                # Generate VLESS key
-                                vless_key = self._generate_vless_key(inbound, client_uuid, client_email)
-                                
-                                # Generate subscription link
-                                sub_link = self._generate_sub_link(client_email)
-                                
-                                return {
-                                    "uuid": client_uuid,
-                                    "email": client_email,
-                                    "expiry": datetime.now() + timedelta(days=expiry_days),
-                                    "traffic_limit_gb": traffic_limit_gb,
-                                    "ip_limit": ip_limit,
-                                    "vless_key": vless_key,
-                                    "sub_link": sub_link,
-                                    "xray_restarted": restart_success,
-                                }
-                            else:
-                                logger.error(f"Add client failed: {result}")
-                                # Check for specific error message
-                                if "Duplicate" in str(result) or "exist" in str(result).lower():
-                                    logger.error("Client may already exist with this email")
-                        except json.JSONDecodeError:
-                            logger.error(f"Failed to parse response as JSON: {response.text[:200]}")
-                    elif response.status_code == 404:
-                        logger.info(f"Endpoint {endpoint} not found, trying next...")
-                        continue
-                    else:
-                        logger.error(f"HTTP {response.status_code}: {response.text[:200]}")
+                    result = response.json()
+                    if result.get("success"):
+                        logger.info(f"✅ {count} client(s) added successfully: {base_email} with IP limit: {ip_limit}")
                         
-                except Exception as e:
-                    logger.error(f"Error with endpoint {endpoint}: {e}")
-                    continue
+                        # Restart Xray to apply IP limit
+                        logger.info("🔄 Restarting Xray to apply IP limit...")
+                        restart_success = await self.restart_xray()
+                        if restart_success:
+                            logger.info("✅ Xray restarted - IP limit is now active!")
+                        else:
+                            logger.warning("⚠️ Xray restart failed - IP limit may not work until manual restart")
+                        
+                        expiry = datetime.now() + timedelta(days=expiry_days)
+                        return [
+                            {
+                                "uuid": c["id"],
+                                "email": c["email"],
+                                "expiry": expiry,
+                                "traffic_limit_gb": traffic_limit_gb,
+                                "ip_limit": ip_limit,
+                                "vless_key": self._generate_vless_key(inbound, c["id"], c["email"]),
+                                "sub_link": self._generate_sub_link(c["email"]),
+                                "xray_restarted": restart_success,
+                            }
+                            for c in clients
+                        ]
+                    else:
+                        logger.error(f"Add client failed: {result}")
+                        # Check for specific error message
+                        if "Duplicate" in str(result) or "exist" in str(result).lower():
+                            logger.error("Client may already exist with this email")
+                except json.JSONDecodeError:
+                    logger.error(f"Failed to parse response as JSON: {response.text[:200]}")
+            else:
+                logger.error(f"HTTP {response.status_code}: {response.text[:200]}")
             
-            logger.error("All add_client endpoints failed")
-            return None
+            return []
             
         except Exception as e:
             logger.error(f"Error adding client: {e}")
             import traceback
             logger.error(traceback.format_exc())
-            return None
+            return []
     
     def _generate_sub_link(self, client_email: str) -> str:
         """Generate subscription link for the client."""
@@ -562,6 +812,12 @@ class XUIClient:
 xui = XUIClient(PANEL_URL, PANEL_USERNAME, PANEL_PASSWORD)
 
 
+async def close_panel_sessions():
+    for panel in (xui,):
+        if panel:
+            await panel.close()
+
+
 # ==========================
 # WAITING ANIMATION
 # ==========================
@@ -1192,8 +1448,10 @@ async def admin_panel(client: Client, message: Message):
         f"⏳ Pending: {pending}\n"
         f"👥 Subscribers: {len(user_subscriptions)}\n"
         f"🎁 Trial users: {len(user_trials)}\n\n"
+        f"**Panel:**\n"
+        f"{xui.breaker.health_text()}\n"
         f"**Commands:**\n"
-        f"/generate <user_id> <plan_key>\n"
+        f"/generate <user_id> <plan_key> [count]\n"
         f"/broadcast <message>"
     )
 
@@ -1206,8 +1464,9 @@ async def admin_generate(client: Client, message: Message):
     args = message.text.split()
     if len(args) < 3:
         await message.reply_text(
-            "Usage: /generate <user_id> <plan_key>\n"
-            "Plans: plan_1, plan_2, plan_3"
+            "Usage: /generate <user_id> <plan_key> [count]\n"
+            "Plans: plan_1, plan_2, plan_3\n"
+            f"Count: 1-{BULK_GENERATE_MAX} keys in one panel request"
         )
         return
     
@@ -1218,11 +1477,17 @@ async def admin_generate(client: Client, message: Message):
         await message.reply_text(f"❌ Invalid plan: {plan_key}")
         return
     
+    count = int(args[3]) if len(args) > 3 and args[3].isdigit() else 1
+    if not 1 <= count <= BULK_GENERATE_MAX:
+        await message.reply_text(f"❌ Count must be 1-{BULK_GENERATE_MAX}")
+        return
+    
     plan = VPN_PLANS[plan_key]
     inbound_id = plan.get("inbound_id", PLAN1_INBOUND_ID)
     
-    result = await xui.add_client(
+    results = await xui.add_clients(
         inbound_id=inbound_id,  # Plan-specific inbound!
+        count=count,
         email=f"manual_{target_user}",
         tg_username=f"user_{target_user}",
         traffic_limit_gb=plan["traffic_gb"],
@@ -1230,7 +1495,12 @@ async def admin_generate(client: Client, message: Message):
         ip_limit=plan["ip_limit"],
     )
     
-    if result:
+    if not results:
+        await message.reply_text("❌ Failed to generate key.")
+        return
+    
+    if len(results) == 1:
+        result = results[0]
         await message.reply_text(
             f"✅ **Key Generated!**\n\n"
             f"📦 Plan: {plan['name']}\n"
@@ -1239,13 +1509,42 @@ async def admin_generate(client: Client, message: Message):
             f"🔑 **VLESS Key:**\n`{result['vless_key']}`\n\n"
             f"📱 **Sub Link:**\n`{result['sub_link']}`"
         )
-    else:
-        await message.reply_text("❌ Failed to generate key.")
+        return
+    
+    await message.reply_text(
+        f"✅ **{len(results)} Keys Generated!**\n\n"
+        f"📦 Plan: {plan['name']}\n"
+        f"📱 IP Limit: {plan['ip_limit']}\n"
+        f"📅 Expires: {results[0]['expiry'].strftime('%Y-%m-%d')}"
+    )
+    
+    # Telegram messages are capped at 4096 chars, so send keys in chunks
+    chunk = ""
+    for i, result in enumerate(results, 1):
+        entry = (
+            f"**#{i}** `{result['email']}`\n"
+            f"🔑 `{result['vless_key']}`\n"
+            f"📱 `{result['sub_link']}`\n\n"
+        )
+        if len(chunk) + len(entry) > 3500:
+            await message.reply_text(chunk)
+            chunk = ""
+        chunk += entry
+    if chunk:
+        await message.reply_text(chunk)
 
 
 # ==========================
 # MAIN
 # ==========================
+async def main():
+    await app.start()
+    await xui.discover()
+    await idle()
+    await app.stop()
+    await close_panel_sessions()
+
+
 if __name__ == "__main__":
     print("=" * 50)
     print("🚀 Zembi VPN Bot")
@@ -1254,7 +1553,7 @@ if __name__ == "__main__":
     print("=" * 50)
     
     try:
-        app.run()
+        app.run(main())
     except Exception as e:
         print(f"❌ Error: {e}")
         sys.exit(1)
\ No newline at end of file
@@ -12,8 +12,9 @@ Features:
 - Telegram username as client identifier
 - Subscription links for easy app import
 - Free trial with 24-hour validity (VLESS only)
-- Payment screenshot submission
+- Payment screenshot submission (resubmitted screenshots are flagged, needs Pillow)
 - Admin approval/rejection with waiting animation
+- Several reviewer accounts, payments spread between them (REVIEWER_IDS)
 - Auto VPN key generation on payment approval
 
 BEFORE RUNNING:
@@ -24,17 +25,27 @@ BEFORE RUNNING:
 """
 
 import logging
+import io
+import re
+import sqlite3
 import sys
 import uuid
 import time
 import json
 import asyncio
+import functools
+import heapq
 import os
+import random
 import httpx
 import urllib.parse
 import base64
-from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -44,6 +55,11 @@ from pyrogram.types import (
 from pyrogram.errors import FloodWait
 from dotenv import load_dotenv
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -65,6 +81,35 @@ PANEL_URL = os.getenv('PANEL_URL')
 PANEL_USERNAME = os.getenv('PANEL_USERNAME', 'admin')
 PANEL_PASSWORD = os.getenv('PANEL_PASSWORD')
 
+# Panel HTTP connection pool (shared by all panel API calls)
+PANEL_HTTP_TIMEOUT = float(os.getenv('PANEL_HTTP_TIMEOUT', '30'))
+PANEL_HTTP_MAX_CONNECTIONS = int(os.getenv('PANEL_HTTP_MAX_CONNECTIONS', '20'))
+PANEL_HTTP_MAX_KEEPALIVE = int(os.getenv('PANEL_HTTP_MAX_KEEPALIVE', '10'))
+PANEL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('PANEL_HTTP_KEEPALIVE_EXPIRY', '60'))
+
+# Panel auth lifetime (used when the panel doesn't tell us the real expiry)
+XUI_SESSION_TTL = int(os.getenv('XUI_SESSION_TTL', '3600'))
+MARZBAN_TOKEN_TTL = int(os.getenv('MARZBAN_TOKEN_TTL', '86400'))
+PANEL_AUTH_MARGIN = int(os.getenv('PANEL_AUTH_MARGIN', '60'))
+
+# Cached inbound stream settings (port, network, TLS/Reality) lifetime
+INBOUND_CACHE_TTL = int(os.getenv('INBOUND_CACHE_TTL', '600'))
+
+# Xray restarts are batched: wait XRAY_RESTART_DELAY seconds after a change,
+# and never restart more than once per XRAY_RESTART_WINDOW seconds
+XRAY_RESTART_DELAY = int(os.getenv('XRAY_RESTART_DELAY', '5'))
+XRAY_RESTART_WINDOW = int(os.getenv('XRAY_RESTART_WINDOW', '60'))
+
+# Panel circuit breakers: open when PANEL_BREAKER_ERROR_RATE of the calls in
+# the last PANEL_BREAKER_WINDOW seconds failed or took longer than
+# PANEL_BREAKER_SLOW_SECONDS (and there were at least PANEL_BREAKER_MIN_CALLS),
+# then fail fast for PANEL_BREAKER_OPEN_SECONDS before probing again
+PANEL_BREAKER_WINDOW = float(os.getenv('PANEL_BREAKER_WINDOW', '60'))
+PANEL_BREAKER_MIN_CALLS = int(os.getenv('PANEL_BREAKER_MIN_CALLS', '5'))
+PANEL_BREAKER_ERROR_RATE = float(os.getenv('PANEL_BREAKER_ERROR_RATE', '0.5'))
+PANEL_BREAKER_OPEN_SECONDS = float(os.getenv('PANEL_BREAKER_OPEN_SECONDS', '30'))
+PANEL_BREAKER_SLOW_SECONDS = float(os.getenv('PANEL_BREAKER_SLOW_SECONDS', '10'))
+
 # VLESS SERVER CONFIG
 SERVER_IP = os.getenv('SERVER_IP', '127.0.0.1')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '443'))
@@ -88,11 +133,112 @@ MARZBAN_PASSWORD = os.getenv('MARZBAN_PASSWORD')
 OUTLINE_SERVER_IP = os.getenv('OUTLINE_SERVER_IP', '127.0.0.1')
 OUTLINE_INBOUND_NAME = os.getenv('OUTLINE_INBOUND_NAME', 'Shadowsocks TCP')
 
+# Database file (SQLite, survives restarts)
+DB_PATH = os.getenv('DB_PATH', 'zembi_bot.db')
+
 # Trial settings (VLESS only)
 TRIAL_DURATION_HOURS = int(os.getenv('TRIAL_DURATION_HOURS', '24'))
 TRIAL_TRAFFIC_GB = int(os.getenv('TRIAL_TRAFFIC_GB', '1'))
 TRIAL_DEVICE_LIMIT = int(os.getenv('TRIAL_DEVICE_LIMIT', '1'))
 
+# Max keys per /generate command (all created in one addClient request)
+BULK_GENERATE_MAX = int(os.getenv('BULK_GENERATE_MAX', '50'))
+
+# Max Marzban users created in parallel for one multi-key Outline order
+OUTLINE_CREATE_CONCURRENCY = int(os.getenv('OUTLINE_CREATE_CONCURRENCY', '3'))
+
+# Warm key pool: disabled keys pre-created on the panels so approvals only
+# have to enable one. Size is per plan (0 = off), see "pool_size" below.
+KEY_POOL_SIZE = int(os.getenv('KEY_POOL_SIZE', '2'))
+KEY_POOL_LOW_WATER = int(os.getenv('KEY_POOL_LOW_WATER', '1'))
+KEY_POOL_REFILL_INTERVAL = int(os.getenv('KEY_POOL_REFILL_INTERVAL', '300'))
+
+# Waiting animations: one scheduler edits all "Admin စစ်ဆေးနေပါတယ်" messages.
+# Rates are edits per second; the interval grows when the queue doesn't fit.
+ANIMATION_INTERVAL = float(os.getenv('ANIMATION_INTERVAL', '3'))
+ANIMATION_GLOBAL_RATE = float(os.getenv('ANIMATION_GLOBAL_RATE', '5'))
+ANIMATION_CHAT_RATE = float(os.getenv('ANIMATION_CHAT_RATE', '0.5'))
+ANIMATION_MAX_FAILURES = int(os.getenv('ANIMATION_MAX_FAILURES', '5'))
+
+# Outbound Telegram sends (all messages go through one governor).
+# Telegram allows ~30 messages/s overall and ~1/s per chat.
+TG_SEND_RATE = float(os.getenv('TG_SEND_RATE', '25'))
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', '1'))
+TG_CHAT_BURST = int(os.getenv('TG_CHAT_BURST', '3'))
+TG_SEND_RETRIES = int(os.getenv('TG_SEND_RETRIES', '5'))
+
+# Per-user callback budget (button presses per second, burst)
+CALLBACK_RATE = float(os.getenv('CALLBACK_RATE', '1'))
+CALLBACK_BURST = int(os.getenv('CALLBACK_BURST', '5'))
+
+# Stricter per-user budgets (per second, burst) for actions that reach the
+# panels or the admin. The buy/renew buttons share one budget.
+TRIAL_CLICK_RATE = float(os.getenv('TRIAL_CLICK_RATE', '0.05'))
+TRIAL_CLICK_BURST = int(os.getenv('TRIAL_CLICK_BURST', '2'))
+BUY_CLICK_RATE = float(os.getenv('BUY_CLICK_RATE', '0.2'))
+BUY_CLICK_BURST = int(os.getenv('BUY_CLICK_BURST', '3'))
+PHOTO_RATE = float(os.getenv('PHOTO_RATE', '0.1'))
+PHOTO_BURST = int(os.getenv('PHOTO_BURST', '2'))
+# At most one "slow down" notice per user per SLOW_DOWN_NOTICE_INTERVAL seconds;
+# per-action bucket tables keep at most USER_BUCKETS_MAX users each
+SLOW_DOWN_NOTICE_INTERVAL = float(os.getenv('SLOW_DOWN_NOTICE_INTERVAL', '10'))
+USER_BUCKETS_MAX = int(os.getenv('USER_BUCKETS_MAX', '10000'))
+
+# Duplicate screenshot detection: screenshots whose 64-bit dHash is within
+# SCREENSHOT_MATCH_DISTANCE bits (max 7) of an earlier one are flagged to the
+# admin. Download + hashing gets SCREENSHOT_CHECK_BUDGET seconds, else the
+# payment is forwarded unchecked.
+SCREENSHOT_HASH_WORKERS = int(os.getenv('SCREENSHOT_HASH_WORKERS', '2'))
+SCREENSHOT_MATCH_DISTANCE = min(7, int(os.getenv('SCREENSHOT_MATCH_DISTANCE', '4')))
+SCREENSHOT_CHECK_BUDGET = float(os.getenv('SCREENSHOT_CHECK_BUDGET', '3'))
+
+# Pending payments per page in the admin review queue (/queue)
+QUEUE_PAGE_SIZE = int(os.getenv('QUEUE_PAGE_SIZE', '8'))
+
+# Payment reviewers: each new payment goes to one of REVIEWER_IDS
+# (comma-separated user ids, default ADMIN_USER_ID), picked "least_loaded"
+# (fewest pending) or "round_robin". A payment nobody acted on within
+# REVIEW_TIMEOUT seconds moves to another reviewer (0 = never).
+# ADMIN_USER_ID can act on every payment.
+REVIEWER_IDS = os.getenv('REVIEWER_IDS', '')
+REVIEW_ASSIGNMENT = os.getenv('REVIEW_ASSIGNMENT', 'least_loaded')
+REVIEW_TIMEOUT = int(os.getenv('REVIEW_TIMEOUT', '900'))
+
+# Provisioning jobs (approved payments): worker count and retry schedule.
+# Retry n waits about PROVISION_RETRY_BASE * 2^(n-1) seconds (with jitter),
+# capped at PROVISION_RETRY_MAX.
+PROVISION_WORKERS = int(os.getenv('PROVISION_WORKERS', '3'))
+PROVISION_MAX_ATTEMPTS = int(os.getenv('PROVISION_MAX_ATTEMPTS', '6'))
+PROVISION_RETRY_BASE = float(os.getenv('PROVISION_RETRY_BASE', '5'))
+PROVISION_RETRY_MAX = float(os.getenv('PROVISION_RETRY_MAX', '300'))
+
+# Subscription expiry: due subscriptions are disabled on the panels
+# EXPIRY_BATCH_SIZE at a time; a failed disable is retried after
+# EXPIRY_RETRY_DELAY seconds.
+EXPIRY_BATCH_SIZE = int(os.getenv('EXPIRY_BATCH_SIZE', '100'))
+EXPIRY_CONCURRENCY = int(os.getenv('EXPIRY_CONCURRENCY', '5'))
+EXPIRY_RETRY_DELAY = float(os.getenv('EXPIRY_RETRY_DELAY', '300'))
+
+# Renewal reminder this many days before a paid subscription expires (0 = off)
+RENEWAL_REMINDER_DAYS = float(os.getenv('RENEWAL_REMINDER_DAYS', '3'))
+
+# Expired-client GC: every GC_INTERVAL seconds, delete panel clients that
+# expired more than GC_GRACE_DAYS ago, at most GC_BATCH_SIZE per inbound per
+# run and GC_RATE deletions per second (GC_INTERVAL = 0 turns it off)
+GC_INTERVAL = int(os.getenv('GC_INTERVAL', '21600'))
+GC_GRACE_DAYS = float(os.getenv('GC_GRACE_DAYS', '7'))
+GC_BATCH_SIZE = int(os.getenv('GC_BATCH_SIZE', '200'))
+GC_RATE = float(os.getenv('GC_RATE', '5'))
+
+# Traffic/online stats are pulled from the panels every USAGE_SYNC_INTERVAL
+# seconds into a local cache that the subscription screens read (0 = off)
+USAGE_SYNC_INTERVAL = int(os.getenv('USAGE_SYNC_INTERVAL', '300'))
+
+# User updates: handled in order per user, DISPATCH_WORKERS users at a time.
+# A user with USER_QUEUE_SIZE updates waiting gets further ones dropped.
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', '8'))
+USER_QUEUE_SIZE = int(os.getenv('USER_QUEUE_SIZE', '5'))
+
 # ==========================
 # PLAN CONFIGURATION
 # ==========================
@@ -117,6 +263,7 @@ VLESS_PLANS = {
         "traffic_gb": 0,
         "inbound_id": PLAN1_INBOUND_ID,
         "type": "vless",
+        "pool_size": KEY_POOL_SIZE,
     },
     "vless_2": {
         "label": f"2 devices = {plan_2_price}",
@@ -128,6 +275,7 @@ VLESS_PLANS = {
         "traffic_gb": 0,
         "inbound_id": PLAN2_INBOUND_ID,
         "type": "vless",
+        "pool_size": KEY_POOL_SIZE,
     },
     "vless_3": {
         "label": f"3 devices = {plan_3_price}",
@@ -139,6 +287,7 @@ VLESS_PLANS = {
         "traffic_gb": 0,
         "inbound_id": PLAN3_INBOUND_ID,
         "type": "vless",
+        "pool_size": KEY_POOL_SIZE,
     },
 }
 
@@ -152,6 +301,7 @@ OUTLINE_PLANS = {
         "days": 30,
         "traffic_gb": 0,
         "type": "outline",
+        "pool_size": KEY_POOL_SIZE,
     },
     "outline_2": {
         "label": f"2 keys = {plan_2_price}",
@@ -161,6 +311,7 @@ OUTLINE_PLANS = {
         "days": 30,
         "traffic_gb": 0,
         "type": "outline",
+        "pool_size": KEY_POOL_SIZE,
     },
     "outline_3": {
         "label": f"3 keys = {plan_3_price}",
@@ -170,6 +321,7 @@ OUTLINE_PLANS = {
         "days": 30,
         "traffic_gb": 0,
         "type": "outline",
+        "pool_size": KEY_POOL_SIZE,
     },
 }
 
@@ -191,6 +343,10 @@ def validate_config():
         errors.append("BOT_TOKEN is not set")
     if not ADMIN_USER_ID:
         errors.append("ADMIN_USER_ID is not set")
+    if not all(r.strip().isdigit() for r in REVIEWER_IDS.split(",") if r.strip()):
+        errors.append("REVIEWER_IDS must be comma-separated user ids")
+    if REVIEW_ASSIGNMENT not in ("least_loaded", "round_robin"):
+        errors.append("REVIEW_ASSIGNMENT must be least_loaded or round_robin")
     if not PANEL_URL:
         warnings.append("PANEL_URL is not set (VLESS won't work)")
     if not PANEL_PASSWORD:
@@ -199,6 +355,8 @@ def validate_config():
         warnings.append("MARZBAN_URL is not set (Outline won't work)")
     if not MARZBAN_PASSWORD:
         warnings.append("MARZBAN_PASSWORD is not set")
+    if Image is None:
+        warnings.append("Pillow is not installed (duplicate screenshot detection is off)")
     
     if errors:
         print("=" * 60)
@@ -225,6 +383,7 @@ validate_config()
 # Convert to proper types after validation
 API_ID = int(API_ID)
 ADMIN_USER_ID = int(ADMIN_USER_ID)
+REVIEWER_IDS = [int(r) for r in REVIEWER_IDS.split(",") if r.strip()] or [ADMIN_USER_ID]
 
 # ==========================
 # LOGGING
@@ -246,13 +405,378 @@ app = Client(
 )
 
 # ==========================
-# IN-MEMORY STORAGE
+# STORAGE (SQLite, WAL mode)
 # ==========================
-user_trials = {}
-user_subscriptions = {}
-pending_payments = {}
-user_states = {}
-waiting_tasks = {}
+STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    user_id     INTEGER PRIMARY KEY,
+    key         TEXT,
+    created_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id     INTEGER NOT NULL,
+    plan        TEXT NOT NULL,
+    type        TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'active',
+    expires_at  REAL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_expiry ON subscriptions(status, expires_at);
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id  TEXT PRIMARY KEY,
+    user_id     INTEGER NOT NULL,
+    status      TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
+CREATE TABLE IF NOT EXISTS user_states (
+    user_id     INTEGER PRIMARY KEY,
+    data        TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    run_at      REAL NOT NULL,
+    last_error  TEXT,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_at);
+CREATE TABLE IF NOT EXISTS screenshot_hashes (
+    payment_id  TEXT PRIMARY KEY,
+    user_id     INTEGER NOT NULL,
+    hash        INTEGER NOT NULL,
+    created_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    key         TEXT PRIMARY KEY,
+    used_bytes  INTEGER NOT NULL,
+    limit_bytes INTEGER NOT NULL,
+    expires_at  REAL,
+    last_seen   REAL,
+    online      INTEGER NOT NULL DEFAULT 0,
+    synced_at   REAL NOT NULL
+);
+"""
+
+
+class Storage:
+    """
+    Durable store for trials, subscriptions, payments, user states, jobs,
+    screenshot hashes and the panel usage cache.
+    
+    All SQL below is fixed text, so sqlite3's statement cache prepares each
+    query once. Use `with storage.batch():` to group several writes into a
+    single transaction.
+    """
+    
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(STORAGE_SCHEMA)
+        self._in_batch = False
+    
+    @contextmanager
+    def batch(self):
+        if self._in_batch:
+            yield
+            return
+        self._in_batch = True
+        self.db.execute("BEGIN")
+        try:
+            yield
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        finally:
+            self._in_batch = False
+    
+    def close(self):
+        self.db.close()
+    
+    # ----- trials -----
+    def has_trial(self, user_id: int) -> bool:
+        return self.db.execute("SELECT 1 FROM trials WHERE user_id = ?", (user_id,)).fetchone() is not None
+    
+    def add_trial(self, user_id: int, key: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO trials (user_id, key, created_at) VALUES (?, ?, ?)",
+            (user_id, key, time.time()),
+        )
+    
+    def count_trials(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+    
+    # ----- subscriptions -----
+    def add_subscription(self, user_id: int, sub: dict) -> int:
+        """`sub` is the dict shown in My Subscriptions; "expiry" is a datetime."""
+        data = {k: v for k, v in sub.items() if k not in ("plan", "type", "status", "expiry")}
+        expiry = sub.get("expiry")
+        cur = self.db.execute(
+            "INSERT INTO subscriptions (user_id, plan, type, status, expires_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                user_id,
+                sub["plan"],
+                sub.get("type", "vless"),
+                sub.get("status", "active"),
+                expiry.timestamp() if expiry else None,
+                json.dumps(data),
+            ),
+        )
+        return cur.lastrowid
+    
+    def get_subscriptions(self, user_id: int) -> list:
+        rows = self.db.execute(
+            "SELECT * FROM subscriptions WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        return [self._subscription(row) for row in rows]
+    
+    def list_subscriptions(self, status: str) -> list:
+        rows = self.db.execute("SELECT * FROM subscriptions WHERE status = ?", (status,)).fetchall()
+        return [self._subscription(row) for row in rows]
+    
+    def get_subscriptions_by_id(self, sub_ids: list) -> list:
+        rows = self.db.execute(
+            "SELECT * FROM subscriptions WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(sub_ids),)
+        ).fetchall()
+        return [self._subscription(row) for row in rows]
+    
+    def get_subscription(self, sub_id: int) -> dict | None:
+        subs = self.get_subscriptions_by_id([sub_id])
+        return subs[0] if subs else None
+    
+    def set_subscription_status(self, sub_id: int, status: str):
+        self.db.execute("UPDATE subscriptions SET status = ? WHERE id = ?", (status, sub_id))
+    
+    def renew_subscription(self, sub_id: int, expires_at: float):
+        """Reactivate with a new expiry; the next expiry gets its own reminder."""
+        self.db.execute(
+            "UPDATE subscriptions SET status = 'active', expires_at = ?, data = json_remove(data, '$.reminded') "
+            "WHERE id = ?",
+            (expires_at, sub_id),
+        )
+    
+    def mark_reminded(self, sub_id: int):
+        self.db.execute("UPDATE subscriptions SET data = json_set(data, '$.reminded', 1) WHERE id = ?", (sub_id,))
+    
+    def active_expiries(self):
+        """(expires_at, id, reminded) of every active subscription that can expire."""
+        return self.db.execute(
+            "SELECT expires_at, id, json_extract(data, '$.reminded') FROM subscriptions "
+            "WHERE status = 'active' AND expires_at IS NOT NULL"
+        )
+    
+    def count_subscribers(self) -> int:
+        return self.db.execute("SELECT COUNT(DISTINCT user_id) FROM subscriptions").fetchone()[0]
+    
+    def _subscription(self, row) -> dict:
+        sub = json.loads(row["data"])
+        sub.update(
+            id=row["id"],
+            user_id=row["user_id"],
+            plan=row["plan"],
+            type=row["type"],
+            status=row["status"],
+            expires_at=row["expires_at"],
+            expires=datetime.fromtimestamp(row["expires_at"]).strftime("%Y-%m-%d %H:%M") if row["expires_at"] else "N/A",
+        )
+        return sub
+    
+    # ----- payments -----
+    def add_payment(self, payment_id: str, payment: dict):
+        self.db.execute(
+            "INSERT INTO payments (payment_id, user_id, status, created_at, data) VALUES (?, ?, ?, ?, ?)",
+            (payment_id, payment["user_id"], payment["status"], payment["timestamp"], json.dumps(payment)),
+        )
+    
+    def get_payment(self, payment_id: str) -> dict | None:
+        row = self.db.execute(
+            "SELECT status, data FROM payments WHERE payment_id = ?", (payment_id,)
+        ).fetchone()
+        if not row:
+            return None
+        payment = json.loads(row["data"])
+        payment.update(payment_id=payment_id, status=row["status"])
+        return payment
+    
+    def update_payment(self, payment_id: str, **fields):
+        """
+        Set only the given keys of a payment's data in place. Status and
+        reviewer change only through set_payment_status / assign_payment.
+        """
+        if not fields.keys().isdisjoint({"status", "reviewer", "payment_id"}):
+            raise ValueError(f"update_payment can't set {sorted(fields)}")
+        if not fields:
+            return
+        paths = ", ".join(f"'$.{key}', json(?)" for key in fields)
+        self.db.execute(
+            f"UPDATE payments SET data = json_set(data, {paths}) WHERE payment_id = ?",
+            (*(json.dumps(value) for value in fields.values()), payment_id),
+        )
+    
+    def set_payment_status(self, payment_id: str, status: str, expected: str = "pending", reviewer: int | None = None) -> bool:
+        """
+        Atomic status transition; False if the payment wasn't in `expected`
+        or, when `reviewer` is given, isn't assigned to that reviewer.
+        """
+        cur = self.db.execute(
+            "UPDATE payments SET status = ? WHERE payment_id = ? AND status = ? "
+            "AND (? IS NULL OR json_extract(data, '$.reviewer') = ?)",
+            (status, payment_id, expected, reviewer, reviewer),
+        )
+        return cur.rowcount == 1
+    
+    def assign_payment(self, payment_id: str, reviewer: int | None, previous: int | None) -> bool:
+        """Atomically move a pending payment from `previous` to `reviewer`; False if it changed meanwhile."""
+        cur = self.db.execute(
+            "UPDATE payments SET data = json_set(data, '$.reviewer', ?, '$.assigned_at', ?) "
+            "WHERE payment_id = ? AND status = 'pending' AND json_extract(data, '$.reviewer') IS ?",
+            (reviewer, time.time(), payment_id, previous),
+        )
+        return cur.rowcount == 1
+    
+    def review_loads(self) -> dict:
+        """Pending payments per assigned reviewer."""
+        rows = self.db.execute(
+            "SELECT json_extract(data, '$.reviewer'), COUNT(*) FROM payments WHERE status = 'pending' GROUP BY 1"
+        ).fetchall()
+        return {row[0]: row[1] for row in rows}
+    
+    def overdue_reviews(self, before: float) -> list:
+        """Pending payments assigned (or, if never assigned, made) before `before`."""
+        rows = self.db.execute(
+            "SELECT payment_id, status, data FROM payments WHERE status = 'pending' "
+            "AND COALESCE(json_extract(data, '$.assigned_at'), created_at) < ? ORDER BY created_at",
+            (before,),
+        ).fetchall()
+        return [self._payment(row) for row in rows]
+    
+    def list_payments(self, status: str = "pending", limit: int = -1, offset: int = 0, reviewer: int | None = None) -> list:
+        """Oldest first; `limit`/`offset` page through them (-1 = all), `reviewer` keeps only theirs."""
+        rows = self.db.execute(
+            "SELECT payment_id, status, data FROM payments WHERE status = ? "
+            "AND (? IS NULL OR json_extract(data, '$.reviewer') = ?) ORDER BY created_at LIMIT ? OFFSET ?",
+            (status, reviewer, reviewer, limit, offset),
+        ).fetchall()
+        return [self._payment(row) for row in rows]
+    
+    def count_payments(self, status: str = "pending", reviewer: int | None = None) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM payments WHERE status = ? AND (? IS NULL OR json_extract(data, '$.reviewer') = ?)",
+            (status, reviewer, reviewer),
+        ).fetchone()[0]
+    
+    def oldest_payment_at(self, status: str = "pending", reviewer: int | None = None) -> float | None:
+        return self.db.execute(
+            "SELECT MIN(created_at) FROM payments WHERE status = ? AND (? IS NULL OR json_extract(data, '$.reviewer') = ?)",
+            (status, reviewer, reviewer),
+        ).fetchone()[0]
+    
+    def _payment(self, row) -> dict:
+        payment = json.loads(row["data"])
+        payment.update(payment_id=row["payment_id"], status=row["status"])
+        return payment
+    
+    # ----- user states -----
+    def get_state(self, user_id: int) -> dict | None:
+        row = self.db.execute("SELECT data FROM user_states WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+    
+    def set_state(self, user_id: int, state: dict):
+        self.db.execute(
+            "INSERT OR REPLACE INTO user_states (user_id, data) VALUES (?, ?)", (user_id, json.dumps(state))
+        )
+    
+    def clear_state(self, user_id: int):
+        self.db.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+    
+    # ----- jobs -----
+    def add_job(self, job_id: str, kind: str, data: dict) -> bool:
+        """Queue a job; the id is its idempotency key, so a second add is a no-op."""
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO jobs (id, kind, status, run_at, data) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, kind, time.time(), json.dumps(data)),
+        )
+        return cur.rowcount == 1
+    
+    def get_job(self, job_id: str) -> dict | None:
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+    
+    def save_job(self, job: dict):
+        """Write back a job dict from get_job()/list_jobs()."""
+        self.db.execute(
+            "UPDATE jobs SET status = ?, attempts = ?, run_at = ?, last_error = ?, data = ? WHERE id = ?",
+            (job["status"], job["attempts"], job["run_at"], job["last_error"], json.dumps(job["data"]), job["id"]),
+        )
+    
+    def list_jobs(self, status: str) -> list:
+        rows = self.db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY run_at", (status,)).fetchall()
+        return [self._job(row) for row in rows]
+    
+    def count_jobs(self, status: str) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+    
+    # ----- screenshot hashes -----
+    def add_screenshot_hash(self, payment_id: str, user_id: int, value: int):
+        # SQLite integers are signed 64-bit
+        signed = value - (1 << 64) if value >= 1 << 63 else value
+        self.db.execute(
+            "INSERT OR REPLACE INTO screenshot_hashes (payment_id, user_id, hash, created_at) VALUES (?, ?, ?, ?)",
+            (payment_id, user_id, signed, time.time()),
+        )
+    
+    def screenshot_hashes(self):
+        """(payment_id, user_id, hash) of every stored screenshot, oldest first."""
+        for payment_id, user_id, signed in self.db.execute(
+            "SELECT payment_id, user_id, hash FROM screenshot_hashes ORDER BY created_at"
+        ):
+            yield payment_id, user_id, signed & 0xFFFFFFFFFFFFFFFF
+    
+    # ----- usage cache -----
+    def save_usage(self, rows: list):
+        """`rows` are (key, used_bytes, limit_bytes, expires_at, last_seen, online, synced_at)."""
+        with self.batch():
+            self.db.executemany(
+                "INSERT OR REPLACE INTO usage (key, used_bytes, limit_bytes, expires_at, last_seen, online, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    
+    def get_usage(self, keys: list) -> dict:
+        rows = self.db.execute(
+            "SELECT * FROM usage WHERE key IN (SELECT value FROM json_each(?))", (json.dumps(keys),)
+        ).fetchall()
+        return {row["key"]: dict(row) for row in rows}
+    
+    def count_usage(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM usage").fetchone()[0]
+    
+    def _job(self, row) -> dict:
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "run_at": row["run_at"],
+            "last_error": row["last_error"],
+            "data": json.loads(row["data"]),
+        }
+
+
+storage = Storage(DB_PATH)
+
+# In-memory only
+trial_inflight = set()   # user_ids whose free trial is being issued right now
 
 # ==========================
 # VPN APPS LIST
@@ -266,6 +790,270 @@ VPN_APPS = [
 ]
 
 
+# ==========================
+# PANEL HTTP SESSION
+# ==========================
+def create_panel_session() -> httpx.AsyncClient:
+    """One long-lived pooled client per panel; login only swaps auth on it."""
+    return httpx.AsyncClient(
+        timeout=PANEL_HTTP_TIMEOUT,
+        verify=False,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=PANEL_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=PANEL_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=PANEL_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+# ==========================
+# PANEL AUTH MANAGER
+# ==========================
+class PanelAuth:
+    """
+    Shared login state for one panel.
+    
+    Concurrent callers share a single in-flight login, and the cookie/JWT
+    is considered valid only until its expiry (minus PANEL_AUTH_MARGIN).
+    """
+    
+    def __init__(self, name: str, login_func, ttl: int):
+        self.name = name
+        self._login_func = login_func
+        self.ttl = ttl
+        self.expires_at = 0.0
+        self.generation = 0
+        self._inflight = None
+    
+    @property
+    def valid(self) -> bool:
+        return time.time() < self.expires_at
+    
+    def invalidate(self):
+        self.expires_at = 0.0
+    
+    def set_expiry(self, expires_at: float | None):
+        if expires_at:
+            self.expires_at = expires_at - PANEL_AUTH_MARGIN
+    
+    async def ensure(self) -> bool:
+        if self.valid:
+            return True
+        return await self._login_once()
+    
+    async def refresh(self, generation: int) -> bool:
+        """Re-login after a rejected request, unless another caller already did."""
+        if generation != self.generation and self.valid:
+            return True
+        self.invalidate()
+        return await self._login_once()
+    
+    async def _login_once(self) -> bool:
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._login())
+        return await asyncio.shield(self._inflight)
+    
+    async def _login(self) -> bool:
+        try:
+            self.expires_at = 0.0
+            ok = await self._login_func()
+            if ok:
+                self.generation += 1
+                if not self.expires_at:
+                    self.expires_at = time.time() + self.ttl - PANEL_AUTH_MARGIN
+            return ok
+        finally:
+            self._inflight = None
+
+
+def jwt_expiry(token: str) -> float | None:
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+# ==========================
+# PANEL CIRCUIT BREAKER
+# ==========================
+class PanelUnavailable(Exception):
+    """Raised instead of calling a panel whose circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Per-panel circuit breaker over a rolling window of calls.
+    
+    Errors (exceptions and 5xx) and calls slower than `slow_seconds` count
+    against the panel. Once at least `min_calls` calls in the last `window`
+    seconds have a bad rate of `error_rate` or more, the circuit opens and
+    calls fail at once with PanelUnavailable. After `open_seconds` a single
+    probe call is let through (half-open); it closes or re-opens the circuit.
+    """
+    
+    def __init__(self, name: str, window: float, min_calls: int, error_rate: float, open_seconds: float, slow_seconds: float):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.slow_seconds = slow_seconds
+        self.calls = deque()   # (timestamp, ok, latency)
+        self.state = "closed"
+        self.opened_until = 0.0
+        self.probing = False
+        self.trips = 0
+    
+    def _trim(self):
+        cutoff = time.monotonic() - self.window
+        while self.calls and self.calls[0][0] < cutoff:
+            self.calls.popleft()
+    
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() >= self.opened_until:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record(self, ok: bool, latency: float):
+        ok = ok and latency < self.slow_seconds
+        if self.state == "half_open":
+            self.probing = False
+            if ok:
+                logger.info(f"🟢 {self.name} circuit closed")
+                self.state = "closed"
+                self.calls.clear()
+            else:
+                self._open()
+            return
+        
+        self.calls.append((time.monotonic(), ok, latency))
+        self._trim()
+        if self.state == "closed" and len(self.calls) >= self.min_calls:
+            bad = sum(1 for _, call_ok, _ in self.calls if not call_ok)
+            if bad / len(self.calls) >= self.error_rate:
+                self._open()
+    
+    def _open(self):
+        self.state = "open"
+        self.opened_until = time.monotonic() + self.open_seconds
+        self.trips += 1
+        logger.error(f"🔴 {self.name} circuit open for {self.open_seconds:.0f}s")
+    
+    async def call(self, send) -> httpx.Response:
+        """Run `send()` (one HTTP request) under the breaker."""
+        if not self.allow():
+            raise PanelUnavailable(f"{self.name} is unavailable (circuit open)")
+        started = time.monotonic()
+        try:
+            response = await send()
+        except asyncio.CancelledError:
+            # Not the panel's fault; just let another probe through
+            self.probing = False
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - started)
+            raise
+        self.record(response.status_code < 500, time.monotonic() - started)
+        return response
+    
+    def health_text(self) -> str:
+        self._trim()
+        if self.state != "closed":
+            wait = max(0, self.opened_until - time.monotonic())
+            state = "🟡 probing" if self.state == "half_open" else f"🔴 down, retry in {wait:.0f}s"
+        else:
+            state = "🟢 up"
+        if not self.calls:
+            return f"{self.name}: {state} (no calls, {self.trips} trips)\n"
+        latencies = sorted(latency for _, _, latency in self.calls)
+        bad = sum(1 for _, ok, _ in self.calls if not ok)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return (
+            f"{self.name}: {state}, {bad * 100 // len(self.calls)}% errors, "
+            f"avg {sum(latencies) / len(latencies) * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms "
+            f"({len(self.calls)} calls, {self.trips} trips)\n"
+        )
+
+
+def panel_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        window=PANEL_BREAKER_WINDOW,
+        min_calls=PANEL_BREAKER_MIN_CALLS,
+        error_rate=PANEL_BREAKER_ERROR_RATE,
+        open_seconds=PANEL_BREAKER_OPEN_SECONDS,
+        slow_seconds=PANEL_BREAKER_SLOW_SECONDS,
+    )
+
+
+# ==========================
+# XRAY RESTART SCHEDULER
+# ==========================
+class XrayRestartScheduler:
+    """
+    Coalesces Xray restarts for one panel.
+    
+    Callers only mark the panel dirty; a single background task performs at
+    most one restart per XRAY_RESTART_WINDOW, so key delivery never waits.
+    """
+    
+    def __init__(self, xui_client, delay: int, window: int):
+        self.xui = xui_client
+        self.delay = delay
+        self.window = window
+        self.dirty = False
+        self.last_restart = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.last_latency = None
+        self._task = None
+    
+    def mark_dirty(self):
+        self.dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while self.dirty:
+            wait = max(self.delay, self.last_restart + self.window - time.time())
+            await asyncio.sleep(wait)
+            await self._restart()
+    
+    async def _restart(self):
+        self.dirty = False
+        started = time.monotonic()
+        try:
+            ok = await self.xui.restart_xray()
+        except asyncio.CancelledError:
+            self.dirty = True
+            raise
+        self.last_latency = time.monotonic() - started
+        self.last_restart = time.time()
+        if ok:
+            self.restarts += 1
+            logger.info(f"🔄 Xray restart took {self.last_latency:.2f}s")
+        else:
+            # Retry in the next window
+            self.failures += 1
+            self.dirty = True
+    
+    async def flush(self):
+        """Apply a pending restart right away (used on shutdown)."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        if self.dirty:
+            await self._restart()
+            self.dirty = False
+
+
 # ==========================
 # 3X-UI API CLASS (VLESS)
 # ==========================
@@ -275,27 +1063,69 @@ class XUIClient:
         self.username = username
         self.password = password
         self.session = None
-        self.logged_in = False
+        self.auth = PanelAuth("3X-UI", self.login, XUI_SESSION_TTL)
+        self.breaker = panel_breaker("3X-UI")
+        # inbound_id -> (expires_at, stream metadata); full client lists are never kept
+        self._inbound_cache = {}
+        self._inbound_get_supported = True
+        self._inbound_refreshing = set()
+        self._restart_endpoint = None
+        self.restarter = XrayRestartScheduler(self, XRAY_RESTART_DELAY, XRAY_RESTART_WINDOW)
+    
+    def _get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            self.session = create_panel_session()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+        self.auth.invalidate()
+    
+    def _is_auth_rejected(self, response: httpx.Response) -> bool:
+        if response.status_code == 401:
+            return True
+        # Expired session: panel redirects API calls to the login page
+        return bool(response.history) and response.url.path != response.history[0].url.path
+    
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send an authenticated request, re-logging in once if the session expired."""
+        generation = self.auth.generation
+        url = f"{self.base_url}{path}"
+        
+        def send():
+            return self.session.request(method, url, **kwargs)
+        
+        response = await self.breaker.call(send)
+        if self._is_auth_rejected(response) and await self.auth.refresh(generation):
+            logger.info("🔑 3X-UI session expired, re-authenticated")
+            response = await self.breaker.call(send)
+        return response
     
     async def restart_xray(self) -> bool:
-        if not self.logged_in:
-            if not await self.login():
-                return False
+        if not await self.auth.ensure():
+            return False
         
         restart_endpoints = [
             "/panel/setting/restartXrayService",
             "/server/restartXrayService",
             "/xui/setting/restartXrayService",
         ]
+        # Try the endpoint that worked last time before probing the others
+        if self._restart_endpoint:
+            restart_endpoints.remove(self._restart_endpoint)
+            restart_endpoints.insert(0, self._restart_endpoint)
         
         for endpoint in restart_endpoints:
             try:
-                url = f"{self.base_url}{endpoint}"
-                resp = await self.session.post(url)
+                resp = await self._request("POST", endpoint)
                 if resp.status_code == 200:
                     data = resp.json()
                     if data.get("success"):
-                        logger.info(f"✅ Xray restarted via {endpoint}")
+                        if endpoint != self._restart_endpoint:
+                            logger.info(f"✅ Xray restarted via {endpoint}")
+                        self._restart_endpoint = endpoint
                         return True
             except Exception as e:
                 continue
@@ -307,23 +1137,22 @@ class XUIClient:
         if not self.base_url:
             return False
         try:
-            self.session = httpx.AsyncClient(
-                timeout=30.0,
-                verify=False,
-                follow_redirects=True,
-            )
+            session = self._get_session()
+            # Re-auth swaps cookies on the pooled session, the transport is kept
+            session.cookies.clear()
             
             login_url = f"{self.base_url}/login"
-            response = await self.session.post(
+            response = await self.breaker.call(lambda: self.session.post(
                 login_url,
                 data={"username": self.username, "password": self.password},
                 headers={"Content-Type": "application/x-www-form-urlencoded"}
-            )
+            ))
             
             if response.status_code == 200:
                 result = response.json()
                 if result.get("success"):
-                    self.logged_in = True
+                    cookie_expiry = [c.expires for c in session.cookies.jar if c.expires]
+                    self.auth.set_expiry(min(cookie_expiry) if cookie_expiry else None)
                     logger.info("✅ Successfully logged into 3X-UI")
                     return True
             return False
@@ -332,25 +1161,116 @@ class XUIClient:
             return False
     
     async def get_inbound(self, inbound_id: int) -> dict | None:
-        if not self.logged_in:
-            if not await self.login():
-                return None
+        """
+        Stream metadata for one inbound. Once cached it is always served from
+        memory; a stale entry is refreshed in the background.
+        """
+        cached = self._inbound_cache.get(inbound_id)
+        if cached:
+            if cached[0] <= time.time() and inbound_id not in self._inbound_refreshing:
+                self._inbound_refreshing.add(inbound_id)
+                asyncio.create_task(self._refresh_inbound(inbound_id))
+            return cached[1]
+        return await self._fetch_inbound(inbound_id)
+    
+    async def _refresh_inbound(self, inbound_id: int):
+        try:
+            await self._fetch_inbound(inbound_id)
+        finally:
+            self._inbound_refreshing.discard(inbound_id)
+    
+    async def warm_inbounds(self, inbound_ids):
+        """Prefetch inbound metadata so the first key doesn't pay for the lookup."""
+        for inbound_id in set(inbound_ids):
+            if not await self._fetch_inbound(inbound_id):
+                logger.warning(f"⚠️ Could not prefetch inbound {inbound_id}")
+    
+    async def _fetch_inbound(self, inbound_id: int) -> dict | None:
+        if not await self.auth.ensure():
+            return None
         
         try:
-            api_url = f"{self.base_url}/panel/api/inbounds/list"
-            response = await self.session.get(api_url)
+            if self._inbound_get_supported:
+                response = await self._request("GET", f"/panel/api/inbounds/get/{inbound_id}")
+                if response.status_code == 404:
+                    # Older panels only have the list endpoint
+                    self._inbound_get_supported = False
+                elif response.status_code == 200:
+                    result = response.json()
+                    if result.get("success") and result.get("obj"):
+                        return self._cache_inbound(result["obj"])
+                    return None
+            
+            response = await self._request("GET", "/panel/api/inbounds/list")
             
             if response.status_code == 200:
                 result = response.json()
                 if result.get("success"):
+                    # One list download refreshes every inbound we know about
                     for inbound in result.get("obj", []):
-                        if inbound.get("id") == inbound_id:
-                            return inbound
+                        self._cache_inbound(inbound)
+                    cached = self._inbound_cache.get(inbound_id)
+                    if cached:
+                        return cached[1]
             return None
         except Exception as e:
             logger.error(f"Error getting inbound: {e}")
             return None
     
+    def invalidate_inbound(self, inbound_id: int | None = None):
+        if inbound_id is None:
+            self._inbound_cache.clear()
+        else:
+            self._inbound_cache.pop(inbound_id, None)
+    
+    def _cache_inbound(self, inbound: dict) -> dict:
+        meta = self._inbound_meta(inbound)
+        self._inbound_cache[meta["id"]] = (time.time() + INBOUND_CACHE_TTL, meta)
+        return meta
+    
+    def _inbound_meta(self, inbound: dict) -> dict:
+        """Reduce a full inbound object to the pieces a vless:// key needs."""
+        meta = {
+            "id": inbound.get("id"),
+            "remark": inbound.get("remark", ""),
+            "port": SERVER_PORT,
+            "params": "security=none&type=tcp",
+        }
+        try:
+            stream_settings = json.loads(inbound.get("streamSettings") or "{}")
+            port = inbound.get("port", SERVER_PORT)
+            network = stream_settings.get("network", "tcp")
+            security = stream_settings.get("security", "none")
+            
+            params = [f"type={network}"]
+            
+            if security == "tls":
+                params.append("security=tls")
+                tls_settings = stream_settings.get("tlsSettings", {})
+                if tls_settings.get("serverName"):
+                    params.append(f"sni={tls_settings['serverName']}")
+            elif security == "reality":
+                params.append("security=reality")
+                reality_settings = stream_settings.get("realitySettings", {})
+                if reality_settings.get("serverNames"):
+                    params.append(f"sni={reality_settings['serverNames'][0]}")
+                if reality_settings.get("publicKey"):
+                    params.append(f"pbk={reality_settings['publicKey']}")
+            else:
+                params.append("security=none")
+            
+            if network == "ws":
+                ws_settings = stream_settings.get("wsSettings", {})
+                if ws_settings.get("path"):
+                    params.append(f"path={urllib.parse.quote(ws_settings['path'])}")
+            
+            params.append("encryption=none")
+            meta["port"] = port
+            meta["params"] = "&".join(params)
+        except Exception as e:
+            logger.warning(f"Could not parse stream settings of inbound {meta['id']}: {e}")
+        return meta
+    
     async def add_client(
         self,
         inbound_id: int,
@@ -360,39 +1280,70 @@ class XUIClient:
         expiry_days: int = 30,
         ip_limit: int = 1,
     ) -> dict | None:
+        results = await self.add_clients(
+            inbound_id=inbound_id,
+            count=1,
+            email=email,
+            tg_username=tg_username,
+            traffic_limit_gb=traffic_limit_gb,
+            expiry_days=expiry_days,
+            ip_limit=ip_limit,
+        )
+        return results[0] if results else None
+    
+    async def add_clients(
+        self,
+        inbound_id: int,
+        count: int,
+        email: str,
+        tg_username: str = "",
+        traffic_limit_gb: int = 0,
+        expiry_days: int = 30,
+        ip_limit: int = 1,
+        enable: bool = True,
+    ) -> list:
+        """
+        Create `count` clients with one inbound lookup and one addClient call.
+        Returns a result dict per client (empty list on failure).
+        expiry_days <= 0 creates clients that never expire.
+        """
         try:
-            if not self.logged_in:
-                if not await self.login():
-                    return None
+            if not await self.auth.ensure():
+                return []
             
             inbound = await self.get_inbound(inbound_id)
             if not inbound:
                 logger.error(f"Inbound {inbound_id} not found")
-                return None
+                return []
             
-            client_uuid = str(uuid.uuid4())
-            expiry_time = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
+            if expiry_days > 0:
+                expiry_time = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
+            else:
+                expiry_time = 0
             traffic_limit = traffic_limit_gb * 1024 * 1024 * 1024 if traffic_limit_gb > 0 else 0
             
-            client_email = f"{tg_username}_{int(time.time())}" if tg_username else email
+            base_email = f"{tg_username}_{int(time.time())}" if tg_username else email
             
-            client_settings = {
-                "id": client_uuid,
-                "email": client_email,
-                "limitIp": ip_limit,
-                "totalGB": traffic_limit,
-                "expiryTime": expiry_time,
-                "enable": True,
-                "tgId": "",
-                "subId": client_email,
-                "flow": ""
-            }
+            clients = []
+            for i in range(count):
+                client_email = base_email if count == 1 else f"{base_email}_{i + 1}"
+                clients.append({
+                    "id": str(uuid.uuid4()),
+                    "email": client_email,
+                    "limitIp": ip_limit,
+                    "totalGB": traffic_limit,
+                    "expiryTime": expiry_time,
+                    "enable": enable,
+                    "tgId": "",
+                    "subId": client_email,
+                    "flow": ""
+                })
             
-            settings_json = json.dumps({"clients": [client_settings]})
+            settings_json = json.dumps({"clients": clients})
             
-            api_url = f"{self.base_url}/panel/api/inbounds/addClient"
-            response = await self.session.post(
-                api_url,
+            response = await self._request(
+                "POST",
+                "/panel/api/inbounds/addClient",
                 data={"id": inbound_id, "settings": settings_json},
                 headers={"Content-Type": "application/x-www-form-urlencoded"}
             )
@@ -400,62 +1351,141 @@ class XUIClient:
             if response.status_code == 200:
                 result = response.json()
                 if result.get("success"):
-                    logger.info(f"✅ VLESS Client added: {client_email} IP limit: {ip_limit}")
+                    logger.info(f"✅ {count} VLESS Client(s) added: {base_email} IP limit: {ip_limit}")
                     
-                    await self.restart_xray()
+                    self.restarter.mark_dirty()
                     
-                    vless_key = self._generate_vless_key(inbound, client_uuid, client_email)
-                    sub_link = f"https://{SERVER_IP}:{SUB_PORT}/sub/{urllib.parse.quote(client_email)}"
-                    
-                    return {
-                        "uuid": client_uuid,
-                        "email": client_email,
-                        "expiry": datetime.now() + timedelta(days=expiry_days),
-                        "ip_limit": ip_limit,
-                        "vless_key": vless_key,
-                        "sub_link": sub_link,
-                    }
-            return None
+                    return [self.client_result(inbound, c) for c in clients]
+            # Inbound may have been edited or removed on the panel
+            self.invalidate_inbound(inbound_id)
+            return []
         except Exception as e:
             logger.error(f"Error adding VLESS client: {e}")
-            return None
+            return []
     
-    def _generate_vless_key(self, inbound: dict, client_uuid: str, remark: str) -> str:
+    async def update_client(self, inbound_id: int, client_settings: dict) -> bool:
+        """Replace one client's settings (3X-UI needs the full client object)."""
         try:
-            stream_settings = json.loads(inbound.get("streamSettings", "{}"))
-            port = inbound.get("port", SERVER_PORT)
-            network = stream_settings.get("network", "tcp")
-            security = stream_settings.get("security", "none")
-            
-            params = [f"type={network}"]
+            if not await self.auth.ensure():
+                return False
             
-            if security == "tls":
-                params.append("security=tls")
-                tls_settings = stream_settings.get("tlsSettings", {})
-                if tls_settings.get("serverName"):
-                    params.append(f"sni={tls_settings['serverName']}")
-            elif security == "reality":
-                params.append("security=reality")
-                reality_settings = stream_settings.get("realitySettings", {})
-                if reality_settings.get("serverNames"):
-                    params.append(f"sni={reality_settings['serverNames'][0]}")
-                if reality_settings.get("publicKey"):
-                    params.append(f"pbk={reality_settings['publicKey']}")
-            else:
-                params.append("security=none")
+            response = await self._request(
+                "POST",
+                f"/panel/api/inbounds/updateClient/{client_settings['id']}",
+                data={"id": inbound_id, "settings": json.dumps({"clients": [client_settings]})},
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
             
-            if network == "ws":
-                ws_settings = stream_settings.get("wsSettings", {})
-                if ws_settings.get("path"):
-                    params.append(f"path={urllib.parse.quote(ws_settings['path'])}")
+            if response.status_code == 200 and response.json().get("success"):
+                self.restarter.mark_dirty()
+                return True
+            logger.error(f"Update client {client_settings['email']} failed: {response.status_code} {response.text[:200]}")
+            return False
+        except Exception as e:
+            logger.error(f"Error updating VLESS client: {e}")
+            return False
+    
+    async def list_client_stats(self) -> list:
+        """Traffic stats of every client on every inbound (one list request)."""
+        try:
+            if not await self.auth.ensure():
+                return []
             
-            params.append("encryption=none")
-            query_string = "&".join(params)
-            encoded_remark = urllib.parse.quote(remark)
+            response = await self._request("GET", "/panel/api/inbounds/list")
+            if response.status_code == 200:
+                result = response.json()
+                if result.get("success"):
+                    stats = []
+                    for inbound in result.get("obj") or []:
+                        self._cache_inbound(inbound)
+                        stats += inbound.get("clientStats") or []
+                    return stats
+            logger.error(f"List client stats failed: {response.status_code}")
+            return []
+        except Exception as e:
+            logger.error(f"Error listing client stats: {e}")
+            return []
+    
+    async def online_clients(self) -> set:
+        """Emails of the clients connected right now."""
+        try:
+            if not await self.auth.ensure():
+                return set()
+            
+            response = await self._request("POST", "/panel/api/inbounds/onlines")
+            if response.status_code == 200 and response.json().get("success"):
+                return set(response.json().get("obj") or [])
+            return set()
+        except Exception as e:
+            logger.error(f"Error getting online clients: {e}")
+            return set()
+    
+    async def delete_client(self, inbound_id: int, client_uuid: str) -> bool:
+        try:
+            if not await self.auth.ensure():
+                return False
+            
+            response = await self._request("POST", f"/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}")
+            if response.status_code == 200 and response.json().get("success"):
+                self.restarter.mark_dirty()
+                return True
+            logger.error(f"Delete client {client_uuid} failed: {response.status_code} {response.text[:200]}")
+            return False
+        except Exception as e:
+            logger.error(f"Error deleting VLESS client: {e}")
+            return False
+    
+    async def get_inbound_clients(self, inbound_id: int) -> list | None:
+        """
+        Full client list of one inbound (expensive; not for the request path).
+        None if the panel couldn't be asked, so callers can tell that apart
+        from an empty inbound.
+        """
+        try:
+            if not await self.auth.ensure():
+                return None
             
-            return f"vless://{client_uuid}@{SERVER_IP}:{port}?{query_string}#{encoded_remark}"
+            response = await self._request("GET", f"/panel/api/inbounds/get/{inbound_id}")
+            if response.status_code == 200:
+                result = response.json()
+                if result.get("success") and result.get("obj"):
+                    inbound = result["obj"]
+                    self._cache_inbound(inbound)
+                    return json.loads(inbound.get("settings") or "{}").get("clients", [])
+            logger.error(f"Get inbound {inbound_id} clients failed: {response.status_code} {response.text[:200]}")
+            return None
         except Exception as e:
-            return f"vless://{client_uuid}@{SERVER_IP}:{SERVER_PORT}?security=none&type=tcp#{remark}"
+            logger.error(f"Error getting inbound clients: {e}")
+            return None
+    
+    async def find_client(self, inbound_id: int, email: str) -> dict | None:
+        """
+        Existing client by email, e.g. one created by a request whose reply
+        was lost. Raises if the client list can't be fetched.
+        """
+        clients = await self.get_inbound_clients(inbound_id)
+        if clients is None:
+            raise Exception(f"Client list of inbound {inbound_id} unavailable")
+        for client in clients:
+            if client.get("email") == email:
+                inbound = await self.get_inbound(inbound_id)
+                return self.client_result(inbound, client) if inbound else None
+        return None
+    
+    def client_result(self, inbound: dict, client: dict) -> dict:
+        expiry_time = client.get("expiryTime", 0)
+        return {
+            "uuid": client["id"],
+            "email": client["email"],
+            "expiry": datetime.fromtimestamp(expiry_time / 1000) if expiry_time > 0 else None,
+            "ip_limit": client.get("limitIp", 0),
+            "vless_key": self._generate_vless_key(inbound, client["id"], client["email"]),
+            "sub_link": f"https://{SERVER_IP}:{SUB_PORT}/sub/{urllib.parse.quote(client['subId'] or client['email'])}",
+        }
+    
+    def _generate_vless_key(self, inbound: dict, client_uuid: str, remark: str) -> str:
+        encoded_remark = urllib.parse.quote(remark)
+        return f"vless://{client_uuid}@{SERVER_IP}:{inbound['port']}?{inbound['params']}#{encoded_remark}"
 
 
 # ==========================
@@ -471,31 +1501,61 @@ class MarzbanClient:
         self.password = password
         self.session = None
         self.access_token = None
-        self.logged_in = False
+        self.auth = PanelAuth("Marzban", self.login, MARZBAN_TOKEN_TTL)
+        self.breaker = panel_breaker("Marzban")
+    
+    def _get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            self.session = create_panel_session()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+        self.access_token = None
+        self.auth.invalidate()
+    
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request with the current JWT, re-logging in once on 401."""
+        generation = self.auth.generation
+        url = f"{self.base_url}{path}"
+        headers = kwargs.pop("headers", {})
+        
+        def send():
+            return self.session.request(
+                method,
+                url,
+                headers={**headers, "Authorization": f"Bearer {self.access_token}"},
+                **kwargs,
+            )
+        
+        response = await self.breaker.call(send)
+        if response.status_code == 401 and await self.auth.refresh(generation):
+            logger.info("🔑 Marzban token expired, re-authenticated")
+            response = await self.breaker.call(send)
+        return response
     
     async def login(self) -> bool:
         if not self.base_url:
             logger.error("MARZBAN_URL is not set")
             return False
         try:
-            self.session = httpx.AsyncClient(
-                timeout=30.0,
-                verify=False,
-                follow_redirects=True,
-            )
+            self._get_session()
+            self.access_token = None
             
             # Marzban API login endpoint
             login_url = f"{self.base_url}/api/admin/token"
             logger.info(f"Marzban login URL: {login_url}")
             
-            response = await self.session.post(
+            response = await self.breaker.call(lambda: self.session.post(
                 login_url,
                 data={
                     "username": self.username,
                     "password": self.password,
                 },
                 headers={"Content-Type": "application/x-www-form-urlencoded"}
-            )
+            ))
             
             logger.info(f"Marzban login response: {response.status_code}")
             
@@ -503,7 +1563,7 @@ class MarzbanClient:
                 result = response.json()
                 self.access_token = result.get("access_token")
                 if self.access_token:
-                    self.logged_in = True
+                    self.auth.set_expiry(jwt_expiry(self.access_token))
                     logger.info("✅ Successfully logged into Marzban")
                     return True
                 else:
@@ -530,12 +1590,14 @@ class MarzbanClient:
         Returns the SS key (Outline compatible).
         """
         try:
-            if not self.logged_in:
-                if not await self.login():
-                    return None
+            if not await self.auth.ensure():
+                return None
             
-            # Calculate expiry timestamp
-            expiry_time = int((datetime.now() + timedelta(days=expiry_days)).timestamp())
+            # Calculate expiry timestamp (0 = never expires)
+            if expiry_days > 0:
+                expiry_time = int((datetime.now() + timedelta(days=expiry_days)).timestamp())
+            else:
+                expiry_time = 0
             traffic_limit = traffic_limit_gb * 1024 * 1024 * 1024 if traffic_limit_gb > 0 else 0
             
             # Unique username
@@ -559,59 +1621,20 @@ class MarzbanClient:
                 "note": f"Telegram: @{username}",
             }
             
-            api_url = f"{self.base_url}/api/user"
             logger.info(f"Creating Marzban user: {unique_username}")
             
-            response = await self.session.post(
-                api_url,
+            response = await self._request(
+                "POST",
+                "/api/user",
                 json=user_data,
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
-                }
+                headers={"Content-Type": "application/json"},
             )
             
             logger.info(f"Marzban create user response: {response.status_code}")
             
             if response.status_code in [200, 201]:
-                result = response.json()
                 logger.info(f"✅ Outline user created: {unique_username}")
-                
-                # Get the SS link from the response
-                ss_links = result.get("links", [])
-                ss_key = None
-                sub_link = None
-                
-                for link in ss_links:
-                    if link.startswith("ss://"):
-                        ss_key = link
-                        break
-                
-                # Get subscription link
-                sub_link = result.get("subscription_url", "")
-                if not sub_link:
-                    sub_link = f"{self.base_url}/sub/{unique_username}"
-                
-                if not ss_key:
-                    # Try to construct SS key manually
-                    proxies = result.get("proxies", {})
-                    ss_proxy = proxies.get("shadowsocks", {})
-                    if ss_proxy:
-                        password = ss_proxy.get("password", "")
-                        method = ss_proxy.get("method", "chacha20-ietf-poly1305")
-                        port = 443  # Default port - adjust based on your config
-                        
-                        auth = base64.urlsafe_b64encode(
-                            f"{method}:{password}".encode()
-                        ).decode().rstrip("=")
-                        ss_key = f"ss://{auth}@{OUTLINE_SERVER_IP}:{port}#{urllib.parse.quote(unique_username)}"
-                
-                return {
-                    "username": unique_username,
-                    "expiry": datetime.now() + timedelta(days=expiry_days),
-                    "ss_key": ss_key,
-                    "sub_link": sub_link,
-                }
+                return self.user_result(response.json())
             else:
                 logger.error(f"Marzban create user failed: {response.status_code}")
                 logger.error(f"Response: {response.text[:500]}")
@@ -622,672 +1645,3109 @@ class MarzbanClient:
             import traceback
             logger.error(traceback.format_exc())
             return None
-
-
-# Initialize API clients
-xui = XUIClient(PANEL_URL, PANEL_USERNAME, PANEL_PASSWORD) if PANEL_URL else None
-marzban = MarzbanClient(MARZBAN_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD) if MARZBAN_URL else None
-
-
-# ==========================
-# WAITING ANIMATION
-# ==========================
-async def show_waiting_animation(client: Client, chat_id: int, message_id: int, payment_id: str):
-    frames = ["⏳", "⌛"]
-    frame_idx = 0
     
-    while payment_id in pending_payments and pending_payments[payment_id]["status"] == "pending":
+    def user_result(self, user: dict) -> dict:
+        """Outline key details from a Marzban user object."""
+        username = user["username"]
+        
+        # Get the SS link from the response
+        ss_key = None
+        for link in user.get("links", []):
+            if link.startswith("ss://"):
+                ss_key = link
+                break
+        
+        # Get subscription link
+        sub_link = user.get("subscription_url", "")
+        if not sub_link:
+            sub_link = f"{self.base_url}/sub/{username}"
+        
+        if not ss_key:
+            # Try to construct SS key manually
+            proxies = user.get("proxies", {})
+            ss_proxy = proxies.get("shadowsocks", {})
+            if ss_proxy:
+                password = ss_proxy.get("password", "")
+                method = ss_proxy.get("method", "chacha20-ietf-poly1305")
+                port = 443  # Default port - adjust based on your config
+                
+                auth = base64.urlsafe_b64encode(
+                    f"{method}:{password}".encode()
+                ).decode().rstrip("=")
+                ss_key = f"ss://{auth}@{OUTLINE_SERVER_IP}:{port}#{urllib.parse.quote(username)}"
+        
+        expire = user.get("expire")
+        return {
+            "username": username,
+            "expiry": datetime.fromtimestamp(expire) if expire else None,
+            "ss_key": ss_key,
+            "sub_link": sub_link,
+        }
+    
+    async def find_users(self, prefix: str) -> list:
+        """Existing users whose name starts with `prefix`, as user_result() dicts."""
+        users = await self.list_users(search=prefix)
+        return [self.user_result(u) for u in users if u.get("username", "").startswith(prefix)]
+    
+    async def create_users(
+        self,
+        username: str,
+        count: int,
+        traffic_limit_gb: int = 0,
+        expiry_days: int = 30,
+    ) -> list:
+        """
+        Create `count` Outline users concurrently for one order.
+        All-or-nothing: if any key fails, the ones already created are
+        deleted again and an empty list is returned.
+        """
+        semaphore = asyncio.Semaphore(OUTLINE_CREATE_CONCURRENCY)
+        
+        async def create_one(i: int):
+            async with semaphore:
+                return await self.create_user(
+                    username=f"{username}_key{i+1}",
+                    traffic_limit_gb=traffic_limit_gb,
+                    expiry_days=expiry_days,
+                )
+        
+        results = await asyncio.gather(*(create_one(i) for i in range(count)))
+        created = [r for r in results if r]
+        if len(created) == count:
+            return created
+        
+        logger.error(f"Outline order for {username}: {len(created)}/{count} keys created, rolling back")
+        deleted = await asyncio.gather(*(self.delete_user(r["username"]) for r in created))
+        if not all(deleted):
+            leftover = [r["username"] for r, ok in zip(created, deleted) if not ok]
+            logger.error(f"Rollback incomplete, delete manually in Marzban: {leftover}")
+        return []
+    
+    async def modify_user(self, username: str, changes: dict) -> bool | None:
+        """
+        Partially update a user (status, expire, data_limit, note, ...).
+        None if the user doesn't exist, False on any other failure.
+        """
         try:
-            payment = pending_payments[payment_id]
-            elapsed = int(time.time() - payment["timestamp"])
-            mins, secs = divmod(elapsed, 60)
-            
-            vpn_type = "🔐 VLESS" if payment["plan"].get("type") == "vless" else "🌐 Outline"
-            
-            text = (
-                f"{frames[frame_idx]} **Admin စစ်ဆေးနေပါတယ်...**\n\n"
-                f"💳 Payment ID: `{payment_id[:8]}`\n"
-                f"📦 Plan: {vpn_type} - {payment['plan_name']}\n"
-                f"⏱ စောင့်ဆိုင်းချိန်: {mins}:{secs:02d}\n\n"
-                "📸 Screenshot ကို Admin ဆီပို့ပြီးပါပြီ။\n\n"
-                "📸 5-30 မိနစ်ကြာသည်အထိ reply တစ်စုံတစ်ရာ မရရှိပါက Support ကို နှိပ်ပြီး တိုက်ရိုက် ဆက်သွယ်နိုင်ပါတယ်ခင်ဗျာ။"
-            )
+            if not await self.auth.ensure():
+                return False
             
-            await client.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=text
+            response = await self._request(
+                "PUT",
+                f"/api/user/{urllib.parse.quote(username)}",
+                json=changes,
+                headers={"Content-Type": "application/json"},
             )
+            if response.status_code == 200:
+                return True
+            if response.status_code == 404:
+                logger.warning(f"Marzban user {username} not found")
+                return None
+            logger.error(f"Marzban modify user failed: {response.status_code} {response.text[:200]}")
+            return False
+        except Exception as e:
+            logger.error(f"Error modifying Marzban user: {e}")
+            return False
+    
+    async def list_users(self, search: str = "", status: str = "") -> list:
+        try:
+            if not await self.auth.ensure():
+                return []
             
-            frame_idx = (frame_idx + 1) % len(frames)
-            await asyncio.sleep(3)
+            params = {}
+            if search:
+                params["search"] = search
+            if status:
+                params["status"] = status
+            response = await self._request("GET", "/api/users", params=params)
+            if response.status_code == 200:
+                return response.json().get("users", [])
+            logger.error(f"Marzban list users failed: {response.status_code}")
+            return []
+        except Exception as e:
+            logger.error(f"Error listing Marzban users: {e}")
+            return []
+    
+    async def delete_user(self, username: str) -> bool:
+        try:
+            if not await self.auth.ensure():
+                return False
             
-        except asyncio.CancelledError:
-            break
-        except Exception:
-            await asyncio.sleep(5)
+            response = await self._request("DELETE", f"/api/user/{urllib.parse.quote(username)}")
+            if response.status_code in [200, 204, 404]:
+                logger.info(f"🗑 Marzban user deleted: {username}")
+                return True
+            logger.error(f"Marzban delete user failed: {response.status_code} {response.text[:200]}")
+            return False
+        except Exception as e:
+            logger.error(f"Error deleting Marzban user: {e}")
+            return False
+
+
+# Initialize API clients
+xui = XUIClient(PANEL_URL, PANEL_USERNAME, PANEL_PASSWORD) if PANEL_URL else None
+marzban = MarzbanClient(MARZBAN_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD) if MARZBAN_URL else None
 
 
 # ==========================
-# HELPERS
+# WARM KEY POOL
 # ==========================
-def get_main_menu_keyboard():
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🎁 Free Trial", callback_data="free_trial"),
-            InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs"),
-        ],
-        [
-            InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps"),
-            InlineKeyboardButton("🆘 Support", url=f"https://t.me/{ADMIN_USERNAME}"),
-        ],
-        [
-            InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices"),
-            InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices"),
-        ],
-    ])
+# Names given to pooled entries, so a restart can adopt them again
+POOL_VLESS_EMAIL = re.compile(r"^keypool_\d+_[0-9a-f]{8}(_\d+)?$")
+POOL_OUTLINE_USERNAME = re.compile(r"^keypool_[0-9a-f]{8}_\d+$")
+# Marzban can't rename users, so a claimed Outline user keeps its pool name;
+# only the note (overwritten by activate_outline) says it is still unsold
+POOL_OUTLINE_NOTE = "keypool"
 
 
-def get_username(user) -> str:
-    if user.username:
-        return user.username
-    elif user.first_name:
-        return f"{user.first_name}_{user.id}"
-    else:
-        return f"user_{user.id}"
+def is_pool_outline_user(user: dict) -> bool:
+    """True for a Marzban user that is still an unclaimed pool entry."""
+    username = user.get("username", "")
+    if not POOL_OUTLINE_USERNAME.match(username):
+        return False
+    # Pool users made before the marker still carry create_user()'s own note
+    return user.get("note") in (POOL_OUTLINE_NOTE, f"Telegram: @{username.rsplit('_', 1)[0]}")
 
 
-# ==========================
-# /start COMMAND
-# ==========================
-@app.on_message(filters.command("start") & filters.private)
-async def start_handler(client: Client, message: Message):
-    user_states.pop(message.from_user.id, None)
+class KeyPool:
+    """
+    Disabled clients pre-created on the panels, handed out on approval.
     
-    user_name = message.from_user.first_name or "User"
-    text = (
-        f"မင်္ဂလာပါ {user_name}! 🙏🏻\n\n"
-        "ကျနော်က **Zembi** ပါ။ ✌🏻\n\n"
-        "🔐 **VLESS** နဲ့ 🌐 **Outline** VPN key တွေကို\n"
-        "စျေးနှုန်း ချိုချိုသာသာနဲ့ ရောင်းပေးနေတာပါဗျ။\n\n"
-        "**🔐 VLESS VPN:**\n"
-        "• လက်ရှိ မြန်မာနိုင်ငံနှင့် အသင့်တော်ဆုံး\n"
-        "• V2Ray, Hiddify app များဖြင့် သုံးရန်\n"
-        "• Singapore Server 🇸🇬\n"
-        "• IP limit based (1 key = multi device)\n\n"
-        "**🌐 Outline VPN:**\n"
-        "• အလွယ်တကူ ချိတ်ဆက်နိုင်\n"
-        "• Outline app ဖြင့် သုံးရန်\n"
-        "• US Server 🇺🇸\n"
-        "• 1 key = 1 device\n\n"
-        "📊 Data: Unlimited\n"
-        "⏰ Validity: 30 Days\n\n"
-        "အောက်က menu မှ \n"
-        "VLESS VPN သို့မဟုတ် Outline VPN ကိုနှိပ်ပြီး ဝယ်ယူနိုင်ပါတယ်ဗျ။\n\n"
-        "အသေးစိတ်သိလိုပါက Support ကိုနှိပ်ပြီး admin နဲ့ ဆက်သွယ်နိုင်ပါတယ်နော်။\n\n"
-    )
-    await message.reply_text(text, reply_markup=get_main_menu_keyboard())
-
-
-# ==========================
-# CALLBACK HANDLER
-# ==========================
-@app.on_callback_query()
-async def callback_handler(client: Client, query: CallbackQuery):
-    data = query.data
-    user_id = query.from_user.id
-    user = query.from_user
+    VLESS clients are pooled per inbound and Marzban users in one shared
+    pool. A claim only renames/enables one entry and sets its expiry; a
+    background task tops the pools back up when they drop to the low-water
+    mark (and every KEY_POOL_REFILL_INTERVAL seconds).
+    """
     
-    await query.answer()
-
-    # ========== FREE TRIAL (VLESS only) ==========
-    if data == "free_trial":
-        if user_trials.get(user_id, {}).get("used"):
-            await query.message.reply_text(
-                "❌ **Free Trial ယူပြီးသားဖြစ်ပါတယ်။**",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices")],
-                    [InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices")],
-                    [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
-                ])
-            )
-            return
+    def __init__(self, xui_client, marzban_client):
+        self.xui = xui_client
+        self.marzban = marzban_client
+        self.vless = {}          # inbound_id -> deque of client uuids
+        self.outline = deque()   # pooled Marzban users
+        self.outline_adopted = False
+        self.hits = 0
+        self.misses = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def vless_targets(self) -> dict:
+        targets = {}
+        if self.xui:
+            for plan in VLESS_PLANS.values():
+                if plan.get("pool_size", 0) > 0:
+                    inbound_id = plan.get("inbound_id", PLAN1_INBOUND_ID)
+                    targets[inbound_id] = targets.get(inbound_id, 0) + plan["pool_size"]
+        return targets
+    
+    def outline_target(self) -> int:
+        if not self.marzban:
+            return 0
+        return sum(p.get("pool_size", 0) * p.get("num_keys", 1) for p in OUTLINE_PLANS.values())
+    
+    def _taken(self, remaining: int):
+        if remaining <= KEY_POOL_LOW_WATER:
+            self._wakeup.set()
+    
+    async def claim_vless(self, plan: dict, tg_username: str, email: str | None = None) -> dict | None:
+        inbound_id = plan.get("inbound_id", PLAN1_INBOUND_ID)
+        pool = self.vless.get(inbound_id)
+        if not pool:
+            self.misses += 1
+            return None
         
-        if not xui:
-            await query.message.reply_text("❌ VLESS server not configured.")
-            return
+        client_uuid = pool.popleft()
+        self._taken(len(pool))
         
-        loading_msg = await query.message.reply_text("⏳ Trial key ထုတ်ပေးနေပါတယ်...")
+        inbound = await self.xui.get_inbound(inbound_id)
+        email = email or f"{tg_username}_{int(time.time())}"
+        traffic_gb = plan.get("traffic_gb", 0)
+        client_settings = {
+            "id": client_uuid,
+            "email": email,
+            "limitIp": plan.get("ip_limit", 1),
+            "totalGB": traffic_gb * 1024 * 1024 * 1024 if traffic_gb > 0 else 0,
+            "expiryTime": int((datetime.now() + timedelta(days=plan.get("days", 30))).timestamp() * 1000),
+            "enable": True,
+            "tgId": "",
+            "subId": email,
+            "flow": ""
+        }
         
-        tg_username = get_username(user)
-        result = await xui.add_client(
-            inbound_id=TRIAL_INBOUND_ID,
-            email=f"trial_{tg_username}",
-            tg_username=tg_username,
-            traffic_limit_gb=TRIAL_TRAFFIC_GB,
-            expiry_days=TRIAL_DURATION_HOURS / 24,
-            ip_limit=TRIAL_DEVICE_LIMIT,
+        if inbound and await self.xui.update_client(inbound_id, client_settings):
+            self.hits += 1
+            logger.info(f"⚡ Pooled VLESS client claimed: {email}")
+            return self.xui.client_result(inbound, client_settings)
+        
+        # The client is still a disabled pool entry, so it can be handed out again
+        pool.appendleft(client_uuid)
+        self.misses += 1
+        return None
+    
+    def take_outline(self, num_keys: int) -> list:
+        """Reserve pooled Outline users; activate them with activate_outline()."""
+        if len(self.outline) < num_keys:
+            self.misses += 1
+            return []
+        
+        entries = [self.outline.popleft() for _ in range(num_keys)]
+        self._taken(len(self.outline))
+        return entries
+    
+    async def activate_outline(self, entries: list, plan: dict, tg_username: str) -> list:
+        num_keys = len(entries)
+        expiry = datetime.now() + timedelta(days=plan.get("days", 30))
+        traffic_gb = plan.get("traffic_gb", 0)
+        changes = {
+            "status": "active",
+            "expire": int(expiry.timestamp()),
+            "data_limit": traffic_gb * 1024 * 1024 * 1024 if traffic_gb > 0 else 0,
+            "note": f"Telegram: @{tg_username}",
+        }
+        updated = await asyncio.gather(
+            *(self.marzban.modify_user(e["username"], changes) for e in entries)
         )
         
-        if result:
-            user_trials[user_id] = {"used": True, "key": result["vless_key"]}
-            expiry = result["expiry"].strftime("%Y-%m-%d %H:%M")
-            
-            if user_id not in user_subscriptions:
-                user_subscriptions[user_id] = []
-            user_subscriptions[user_id].append({
-                "plan": "Free Trial (VLESS)",
-                "type": "vless",
-                "status": "active",
-                "expires": expiry,
-                "key": result["vless_key"],
-                "sub_link": result["sub_link"],
-                "ip_limit": TRIAL_DEVICE_LIMIT,
-            })
-            
-            await loading_msg.edit_text(
-                "🎁 **Free Trial Activated!**\n\n"
-                f"📱 Device Limit: {TRIAL_DEVICE_LIMIT}\n"
-                f"⏰ Duration: {TRIAL_DURATION_HOURS} Hours\n"
-                f"📅 Expires: {expiry}\n\n"
-                "🔑 **VLESS Key:**\n"
-                f"`{result['vless_key']}`\n\n"
-                "_(Tap to copy)_",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📱 Open Sub Link", url=result['sub_link'])],
-                    [InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")],
-                    [InlineKeyboardButton("⬅️ Menu", callback_data="back_menu")],
-                ])
-            )
-        else:
-            await loading_msg.edit_text(
-                "❌ **Error ဖြစ်သွားပါတယ်။** Admin ကို ဆက်သွယ်ပါ။",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🆘 Support", url=f"https://t.me/{ADMIN_USERNAME}")],
-                ])
+        if all(updated):
+            self.hits += 1
+            logger.info(f"⚡ {num_keys} pooled Outline user(s) claimed for {tg_username}")
+            return [{**e, "expiry": expiry} for e in entries]
+        
+        # Don't leave half-activated keys around; the order falls back to live creation
+        await asyncio.gather(*(self.marzban.delete_user(e["username"]) for e in entries))
+        self.misses += 1
+        return []
+    
+    async def adopt(self):
+        """
+        Pick up pool entries left on the panels by a previous run. An inbound
+        whose clients can't be listed is tried again next round, and isn't
+        refilled until then.
+        """
+        adopted = 0
+        for inbound_id in self.vless_targets():
+            if inbound_id in self.vless:
+                continue
+            clients = await self.xui.get_inbound_clients(inbound_id)
+            if clients is None:
+                continue
+            self.vless[inbound_id] = deque(
+                c["id"] for c in clients
+                if POOL_VLESS_EMAIL.match(c.get("email", "")) and not c.get("enable")
             )
-
-    # ========== MY SUBSCRIPTIONS ==========
-    elif data == "my_subs":
-        subs = user_subscriptions.get(user_id, [])
-        if subs:
-            text = "📋 **Your Subscriptions:**\n\n"
-            buttons = []
-            
-            for i, sub in enumerate(subs, 1):
-                status_emoji = "✅" if sub.get("status") == "active" else "❌"
-                type_emoji = "🔐" if sub.get("type") == "vless" else "🌐"
-                text += (
-                    f"**{i}. {type_emoji} {sub['plan']}** {status_emoji}\n"
-                    f"   📅 Expires: {sub['expires']}\n\n"
+            adopted += len(self.vless[inbound_id])
+        if self.outline_target() and not self.outline_adopted:
+            self.outline_adopted = True
+            for user in await self.marzban.list_users(search="keypool_", status="disabled"):
+                ss_key = next((l for l in user.get("links", []) if l.startswith("ss://")), None)
+                if is_pool_outline_user(user) and ss_key:
+                    self.outline.append({
+                        "username": user["username"],
+                        "ss_key": ss_key,
+                        "sub_link": user.get("subscription_url") or f"{self.marzban.base_url}/sub/{user['username']}",
+                    })
+                    adopted += 1
+        if adopted:
+            logger.info(f"♻️ Adopted {adopted} pooled key(s) from the panels")
+    
+    async def refill(self):
+        for inbound_id, target in self.vless_targets().items():
+            pool = self.vless.get(inbound_id)
+            if pool is None:
+                continue   # not adopted yet
+            missing = target - len(pool)
+            if missing > 0:
+                results = await self.xui.add_clients(
+                    inbound_id=inbound_id,
+                    count=missing,
+                    email=f"keypool_{inbound_id}_{uuid.uuid4().hex[:8]}",
+                    expiry_days=0,
+                    enable=False,
                 )
-                buttons.append([InlineKeyboardButton(
-                    f"🔑 View Key #{i}", 
-                    callback_data=f"view_key_{i-1}"
-                )])
-            
-            buttons.append([
-                InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices"),
-                InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices"),
-            ])
-            buttons.append([InlineKeyboardButton("⬅️ Back", callback_data="back_menu")])
-            
-            await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons))
-        else:
-            await query.message.reply_text(
-                "📋 **Subscription မရှိသေးပါ။**\n🎁 Free Trial စမ်းကြည့်ပါ!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🎁 Free Trial", callback_data="free_trial")],
-                    [InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices")],
-                    [InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices")],
-                    [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
-                ])
-            )
-
-    # ========== VIEW KEY DETAILS ==========
-    elif data.startswith("view_key_"):
-        key_idx = int(data.replace("view_key_", ""))
-        subs = user_subscriptions.get(user_id, [])
+                pool.extend(r["uuid"] for r in results)
         
-        if key_idx < len(subs):
-            sub = subs[key_idx]
-            type_emoji = "🔐" if sub.get("type") == "vless" else "🌐"
-            
-            # Handle multiple keys for Outline
-            keys = sub.get("keys", [sub.get("key", "N/A")])
-            if isinstance(keys, str):
-                keys = [keys]
-            
-            text = (
-                f"{type_emoji} **{sub['plan']}**\n"
-                "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                f"📅 Expires: {sub['expires']}\n"
-            )
-            
-            if sub.get("type") == "vless":
-                text += f"📱 IP Limit: {sub.get('ip_limit', 1)} device(s)\n\n"
-                text += "🔑 **VLESS Key (Tap to copy):**\n"
-                text += f"`{keys[0]}`\n\n"
-            else:
-                text += f"🔑 Keys: {len(keys)}\n\n"
-                for i, key in enumerate(keys, 1):
-                    text += f"**Key #{i}:**\n`{key}`\n\n"
+        missing = self.outline_target() - len(self.outline)
+        if missing > 0:
+            semaphore = asyncio.Semaphore(OUTLINE_CREATE_CONCURRENCY)
             
-            if sub.get('sub_link'):
-                text += f"📱 **Subscription Link:**\n`{sub.get('sub_link')}`"
+            async def create_one():
+                async with semaphore:
+                    user = await self.marzban.create_user(username=f"keypool_{uuid.uuid4().hex[:8]}", expiry_days=0)
+                    if user and user["ss_key"]:
+                        if await self.marzban.modify_user(user["username"], {"status": "disabled", "note": POOL_OUTLINE_NOTE}):
+                            self.outline.append(user)
+                        else:
+                            await self.marzban.delete_user(user["username"])
             
-            buttons = []
-            if sub.get('sub_link'):
-                buttons.append([InlineKeyboardButton("📱 Open Sub Link", url=sub['sub_link'])])
-            buttons.append([InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")])
-            buttons.append([InlineKeyboardButton("⬅️ Back", callback_data="my_subs")])
-            
-            await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ========== VLESS PRICES ==========
-    elif data == "vless_prices":
-        await query.message.reply_text(
-            "🔐 **VLESS VPN Plans**\n\n"
-            "✅ Unlimited Data\n"
-            "✅ 30 Days Validity\n"
-            "✅ Singapore Server 🇸🇬\n"
-            "✅ High-Speed\n"
-            "✅ 1 Key = Multi Device (IP based)\n\n"
-            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            f"🥉 **Basic** - {plan_1_price} (1 device)\n"
-            f"🥈 **Silver** - {plan_2_price} (2 devices)\n"
-            f"🥇 **Golden** - {plan_3_price} (3 devices)\n\n"
-            "Plan ရွေးချယ်ပါ:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"🥉 Basic - {plan_1_price}", callback_data="buy_vless_1")],
-                [InlineKeyboardButton(f"🥈 Silver - {plan_2_price}", callback_data="buy_vless_2")],
-                [InlineKeyboardButton(f"🥇 Golden - {plan_3_price}", callback_data="buy_vless_3")],
-                [InlineKeyboardButton("🌐 View Outline Plans", callback_data="outline_prices")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
-            ])
-        )
+            await asyncio.gather(*(create_one() for _ in range(missing)))
+    
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.adopt()
+            except Exception as e:
+                logger.error(f"Key pool adopt error: {e}")
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Key pool refill error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), KEY_POOL_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        if self.vless_targets() or self.outline_target():
+            self._task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    def stats_text(self) -> str:
+        total = self.hits + self.misses
+        rate = f"{self.hits * 100 // total}%" if total else "-"
+        vless = sum(len(p) for p in self.vless.values())
+        return f"⚡ Key pool: {vless} VLESS / {len(self.outline)} Outline ready (hit rate: {rate})\n"
 
-    # ========== OUTLINE PRICES ==========
-    elif data == "outline_prices":
-        await query.message.reply_text(
-            "🌐 **Outline VPN Plans**\n\n"
-            "✅ Unlimited Data\n"
-            "✅ 30 Days Validity\n"
-            "✅ Easy to connect\n"
-            "✅ Works on all platforms\n"
-            "⚠️ 1 Key = 1 Device\n\n"
-            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            f"🥉 **1 Key** - {plan_1_price}\n"
-            f"🥈 **2 Keys** - {plan_2_price}\n"
-            f"🥇 **3 Keys** - {plan_3_price}\n\n"
-            "Plan ရွေးချယ်ပါ:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"🥉 1 Key - {plan_1_price}", callback_data="buy_outline_1")],
-                [InlineKeyboardButton(f"🥈 2 Keys - {plan_2_price}", callback_data="buy_outline_2")],
-                [InlineKeyboardButton(f"🥇 3 Keys - {plan_3_price}", callback_data="buy_outline_3")],
-                [InlineKeyboardButton("🔐 View VLESS Plans", callback_data="vless_prices")],
-                [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
-            ])
-        )
 
-    # ========== BUY VLESS PLAN ==========
-    elif data.startswith("buy_vless_"):
-        plan_key = data.replace("buy_", "")
-        plan = VLESS_PLANS.get(plan_key)
-        
-        if not plan:
-            return
-        
-        user_states[user_id] = {
-            "state": "waiting_screenshot",
-            "plan_key": plan_key,
-            "plan": plan
+key_pool = KeyPool(xui, marzban)
+
+
+def tried_before(job: dict) -> bool:
+    """True if an earlier attempt of the job (also before a manual retry) may have reached the panel."""
+    return job["attempts"] + job["data"].get("earlier_attempts", 0) > 1
+
+
+async def provision_vless(plan: dict, tg_username: str, job: dict) -> dict | None:
+    """
+    Paid VLESS key: take one from the warm pool, else create it live.
+    The client email is fixed per job, so a retry first looks for the client
+    an earlier attempt may already have created.
+    """
+    inbound_id = plan.get("inbound_id", PLAN1_INBOUND_ID)
+    email = f"{tg_username}_{job['id'][:8]}"
+    if tried_before(job):
+        existing = await xui.find_client(inbound_id, email)
+        if existing:
+            return existing
+    
+    result = await key_pool.claim_vless(plan, tg_username, email=email)
+    if result:
+        return result
+    return await xui.add_client(
+        inbound_id=inbound_id,
+        email=email,
+        traffic_limit_gb=plan.get("traffic_gb", 0),
+        expiry_days=plan.get("days", 30),
+        ip_limit=plan.get("ip_limit", 1),
+    )
+
+
+async def provision_outline(plan: dict, tg_username: str, job: dict) -> list:
+    """
+    Paid Outline keys: take them from the warm pool, else create them live.
+    Pooled users are written to the job before activation and stay there
+    until run_payment_job records the subscription, and live users are named
+    after the job, so a retry reuses what an earlier attempt made.
+    """
+    state = job["data"]
+    num_keys = plan.get("num_keys", 1)
+    
+    base = f"{tg_username}_{job['id'][:8]}"
+    if not state.get("pool_entries"):
+        if tried_before(job):
+            existing = await marzban.find_users(base)
+            if len(existing) == num_keys:
+                return existing
+            # Leftovers of a half-finished attempt
+            await asyncio.gather(*(marzban.delete_user(u["username"]) for u in existing))
+        state["pool_entries"] = key_pool.take_outline(num_keys)
+        storage.save_job(job)
+    
+    if state["pool_entries"]:
+        # Activation is a plain PUT, so repeating it after a crash is harmless
+        results = await key_pool.activate_outline(state["pool_entries"], plan, tg_username)
+        if results:
+            return results
+        # activate_outline deleted them; fall back to live creation
+        state["pool_entries"] = []
+        storage.save_job(job)
+    
+    return await marzban.create_users(
+        username=base,
+        count=num_keys,
+        traffic_limit_gb=plan.get("traffic_gb", 0),
+        expiry_days=plan.get("days", 30),
+    )
+
+
+async def renew_vless(sub: dict, plan: dict, expires_at: float) -> bool:
+    """
+    Move the existing 3X-UI client's expiry to `expires_at` and enable it,
+    so the user keeps their key. False if the client is gone from the panel.
+    """
+    clients = await xui.get_inbound_clients(sub["inbound_id"])
+    if clients is None:
+        raise Exception("VLESS renewal failed: client list unavailable")
+    client = None
+    for c in clients:
+        if c.get("email") == sub["email"]:
+            client = c
+            break
+    if not client:
+        return False
+    
+    client.update(expiryTime=int(expires_at * 1000), enable=True, limitIp=plan.get("ip_limit", 1))
+    if not await xui.update_client(sub["inbound_id"], client):
+        raise Exception("VLESS renewal failed")
+    return True
+
+
+async def renew_outline(sub: dict, plan: dict, expires_at: float) -> bool:
+    """
+    Move the expiry of the subscription's Marzban users and re-activate them.
+    False if any of them is gone from the panel (the others are switched
+    off again, since fresh keys replace the whole set).
+    """
+    usernames = sub.get("usernames", [])
+    results = await asyncio.gather(*(
+        marzban.modify_user(username, {"expire": int(expires_at), "status": "active"})
+        for username in usernames
+    ))
+    if None in results:
+        await asyncio.gather(*(
+            marzban.modify_user(username, {"status": "disabled"})
+            for username, ok in zip(usernames, results) if ok
+        ))
+        return False
+    if not all(results):
+        raise Exception("Outline renewal failed")
+    return bool(results)
+
+
+async def close_panel_sessions():
+    if xui:
+        await xui.restarter.flush()
+    for panel in (xui, marzban):
+        if panel:
+            await panel.close()
+
+
+# ==========================
+# RATE LIMITING
+# ==========================
+class TokenBucket:
+    """`rate` tokens per second, holding at most `capacity`."""
+    
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, n: float = 1) -> float:
+        """Seconds until `n` tokens are available (0 = now)."""
+        self._fill()
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+    
+    def take(self, n: float = 1) -> bool:
+        self._fill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+    
+    @property
+    def full(self) -> bool:
+        self._fill()
+        return self.tokens >= self.capacity
+
+
+class BucketTable:
+    """
+    One TokenBucket per user for a single action. Holds at most `max_users`
+    buckets; the least recently used one is evicted (an evicted user just
+    starts over with a full bucket).
+    """
+    
+    def __init__(self, rate: float, burst: int, max_users: int = USER_BUCKETS_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = OrderedDict()   # user_id -> TokenBucket, oldest use first
+        self.evicted = 0
+    
+    def take(self, user_id: int) -> bool:
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.buckets.move_to_end(user_id)
+        return bucket.take()
+
+
+# Shared by every throttled action, so the notices can't be used for flooding
+slow_down_notices = BucketTable(1 / SLOW_DOWN_NOTICE_INTERVAL, 1)
+
+
+class RateLimit:
+    """
+    Per-user token bucket middleware for one action. Pass the same instance
+    to several routes to give them one shared budget.
+    """
+    
+    instances = []
+    
+    def __init__(self, rate: float, burst: int):
+        self.buckets = BucketTable(rate, burst)
+        self.limited = 0
+        RateLimit.instances.append(self)
+    
+    def allow(self, user_id: int) -> bool:
+        if self.buckets.take(user_id):
+            return True
+        self.limited += 1
+        return False
+    
+    async def __call__(self, route: dict, query: CallbackQuery, call_next):
+        user_id = query.from_user.id
+        if not self.allow(user_id):
+            # Always stop the button's spinner; only the text is rate limited
+            if slow_down_notices.take(user_id):
+                await query.answer("⏳ ခဏစောင့်ပြီးမှ ထပ်နှိပ်ပါ။", show_alert=False)
+            else:
+                await query.answer()
+            return
+        await call_next()
+    
+    @classmethod
+    def stats_text(cls) -> str:
+        buckets = sum(len(limit.buckets.buckets) for limit in cls.instances)
+        evicted = sum(limit.buckets.evicted for limit in cls.instances)
+        return (
+            f"🚦 Throttled: {sum(limit.limited for limit in cls.instances)} updates "
+            f"({buckets} user buckets, {evicted} evicted)\n"
+        )
+
+
+# Send priorities, lower goes first
+PRIORITY_DELIVERY = 0    # keys and payment results
+PRIORITY_ADMIN = 1
+PRIORITY_REPLY = 2       # menus and other interactive replies
+PRIORITY_REMINDER = 5    # renewal reminders
+PRIORITY_ANIMATION = 9
+
+
+class SendGovernor:
+    """
+    Single gate for outbound Telegram calls.
+    
+    Calls are queued by priority and released within a global and a per-chat
+    token bucket. A FloodWait pauses every send for exactly the time Telegram
+    asks for, then the call is retried (up to `retries` times).
+    """
+    
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, retries: int):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.chat_buckets = {}   # chat_id -> TokenBucket
+        self.queue = []          # (priority, seq, job)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.paused_until = 0.0
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.flood_waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    
+    def _push(self, job: dict):
+        self._seq += 1
+        heapq.heappush(self.queue, (job["priority"], self._seq, job))
+        self._wakeup.set()
+    
+    async def send(self, chat_id: int | None, call, priority: int = PRIORITY_REPLY, retries: int | None = None):
+        """Queue `call` (a no-arg coroutine function) and return its result."""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        job = {
+            "chat_id": chat_id,
+            "call": call,
+            "priority": priority,
+            "retries": self.retries if retries is None else retries,
+            "queued": time.monotonic(),
+            "future": asyncio.get_running_loop().create_future(),
         }
-        
-        text = (
-            f"🔐 **{plan['name']}**\n\n"
-            f"📱 IP Limit: {plan['ip_limit']} device(s)\n"
-            f"📊 Data: Unlimited\n"
-            f"⏰ Validity: {plan['days']} days\n"
-            f"💵 Price: **{plan['price']}**\n\n"
-            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            "**💳 ငွေလွှဲရန်:**\n\n"
-            f"💰 **K Pay** - {PAYMENT_NAME}\n"
-            f"   📞 `{KPAY_NO}`\n\n"
-            f"💰 **AYA Pay** - {PAYMENT_NAME}\n"
-            f"   📞 `{AYA_NO}`\n\n"
-            f"💰 **Wave Pay** - {PAYMENT_NAME}\n"
-            f"   📞 `{WAVE_NO}`\n\n"
-            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            "📸 **ငွေလွှဲပြီးရင် screenshot ပို့ပေးပါခင်ဗျာ။**\n\n"
-            "⚠️ **Note မှာ VPN နဲ့ ပတ်သတ်တဲ့ စာသားတွေ မရေးပါနဲ့နော်!**"
+        self._push(job)
+        return await job["future"]
+    
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) > 1000:
+                # A full bucket is the same as a new one, so those can go
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.full}
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[chat_id]
+    
+    def _pop_ready(self) -> tuple[dict | None, float]:
+        """Highest priority job whose chat has budget, else how long until one does."""
+        skipped = []
+        job, wait = None, 3600.0
+        while self.queue:
+            item = heapq.heappop(self.queue)
+            candidate = item[2]
+            if candidate["future"].done():
+                continue
+            if candidate["chat_id"] is None:
+                job = candidate
+                break
+            chat_wait = self._chat_bucket(candidate["chat_id"]).wait_time()
+            if not chat_wait:
+                job = candidate
+                break
+            wait = min(wait, chat_wait)
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+        return job, wait
+    
+    async def _sleep(self, seconds: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def run(self):
+        while True:
+            try:
+                if not self.queue:
+                    await self._sleep(3600)
+                    continue
+                now = time.monotonic()
+                if self.paused_until > now:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                wait = self.global_bucket.wait_time()
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                job, wait = self._pop_ready()
+                if not job:
+                    await self._sleep(wait)
+                    continue
+                self.global_bucket.take()
+                if job["chat_id"] is not None:
+                    self._chat_bucket(job["chat_id"]).take()
+                asyncio.create_task(self._execute(job))
+            except Exception:
+                logger.exception("Send governor loop error")
+                await asyncio.sleep(1)
+    
+    async def _execute(self, job: dict):
+        future = job["future"]
+        try:
+            result = await job["call"]()
+        except FloodWait as e:
+            self.flood_waits += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + e.value)
+            logger.warning(f"⏸ FloodWait {e.value}s, pausing all sends")
+            if job["retries"] > 0 and not future.done():
+                job["retries"] -= 1
+                self.retried += 1
+                self._push(job)
+                return
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.sent += 1
+            waited = time.monotonic() - job["queued"]
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if not future.done():
+                future.set_result(result)
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    def stats_text(self) -> str:
+        depth = {}
+        for priority, _, _ in self.queue:
+            depth[priority] = depth.get(priority, 0) + 1
+        depth_text = ", ".join(f"p{p}: {n}" for p, n in sorted(depth.items())) or "empty"
+        oldest = max((time.monotonic() - job["queued"] for _, _, job in self.queue), default=0.0)
+        avg = self.wait_total / self.sent if self.sent else 0.0
+        return (
+            f"📤 Sends: {self.sent} ok, {self.failed} failed, {self.retried} retried, "
+            f"{self.flood_waits} FloodWaits\n"
+            f"📥 Send queue: {len(self.queue)} ({depth_text}), oldest {oldest:.1f}s, "
+            f"avg wait {avg:.2f}s, max {self.wait_max:.1f}s\n"
         )
+
+
+governor = SendGovernor(TG_SEND_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_SEND_RETRIES)
+
+
+async def tg_send(method, *args, priority: int = PRIORITY_REPLY, **kwargs):
+    """
+    Run a Telegram call through the governor, e.g.
+    `await tg_send(message.reply_text, "hi")` or
+    `await tg_send(client.send_message, chat_id=uid, text="hi")`.
+    """
+    chat = getattr(getattr(method, "__self__", None), "chat", None)
+    chat_id = chat.id if chat else kwargs.get("chat_id")
+    return await governor.send(chat_id, lambda: method(*args, **kwargs), priority=priority)
+
+
+# ==========================
+# WAITING ANIMATION
+# ==========================
+def waiting_text(payment: dict, payment_id: str, frame: str) -> str:
+    elapsed = int(time.time() - payment["timestamp"])
+    mins, secs = divmod(elapsed, 60)
+    
+    vpn_type = "🔐 VLESS" if payment["plan"].get("type") == "vless" else "🌐 Outline"
+    
+    return (
+        f"{frame} **Admin စစ်ဆေးနေပါတယ်...**\n\n"
+        f"💳 Payment ID: `{payment_id[:8]}`\n"
+        f"📦 Plan: {vpn_type} - {payment['plan_name']}\n"
+        f"⏱ စောင့်ဆိုင်းချိန်: {mins}:{secs:02d}\n\n"
+        "📸 Screenshot ကို Admin ဆီပို့ပြီးပါပြီ။\n\n"
+        "📸 5-30 မိနစ်ကြာသည်အထိ reply တစ်စုံတစ်ရာ မရရှိပါက Support ကို နှိပ်ပြီး တိုက်ရိုက် ဆက်သွယ်နိုင်ပါတယ်ခင်ဗျာ။"
+    )
+
+
+class AnimationScheduler:
+    """
+    Edits every waiting message from one task instead of one task per payment.
+    
+    Pending payments sit in a heap ordered by their next edit time. Edits are
+    spent from a global and a per-chat token bucket, the interval stretches
+    when the queue wouldn't fit in the global budget, and a FloodWait pauses
+    all edits for the time Telegram asks for.
+    """
+    
+    frames = ["⏳", "⌛"]
+    
+    def __init__(self, interval: float, global_rate: float, chat_rate: float):
+        self.interval = interval
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_buckets = {}   # chat_id -> TokenBucket
+        self.entries = {}        # payment_id -> {"chat_id", "message_id", "frame", "failures", "seq"}
+        self.heap = []           # (due, seq, payment_id); stale seqs are skipped
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.client = None
+        self.paused_until = 0.0
+        self.edits = 0
+        self.flood_waits = 0
+    
+    def current_interval(self) -> float:
+        return max(self.interval, len(self.entries) / self.global_bucket.rate)
+    
+    def _schedule(self, payment_id: str, due: float):
+        self._seq += 1
+        self.entries[payment_id]["seq"] = self._seq
+        heapq.heappush(self.heap, (due, self._seq, payment_id))
+        self._wakeup.set()
+    
+    def add(self, chat_id: int, message_id: int, payment_id: str):
+        self.entries[payment_id] = {"chat_id": chat_id, "message_id": message_id, "frame": 0, "failures": 0}
+        self._schedule(payment_id, time.monotonic())
+    
+    def remove(self, payment_id: str):
+        entry = self.entries.pop(payment_id, None)
+        if entry and not any(e["chat_id"] == entry["chat_id"] for e in self.entries.values()):
+            self.chat_buckets.pop(entry["chat_id"], None)
+    
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return self.chat_buckets[chat_id]
+    
+    async def _sleep(self, seconds: float):
+        """Sleep, but wake early when a payment is added."""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def run(self):
+        while True:
+            try:
+                # Drop heap entries left behind by remove()/reschedule
+                while self.heap and self.entries.get(self.heap[0][2], {}).get("seq") != self.heap[0][1]:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    await self._sleep(3600)
+                    continue
+                
+                now = time.monotonic()
+                if self.paused_until > now:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                due, _, payment_id = self.heap[0]
+                if due > now:
+                    await self._sleep(due - now)
+                    continue
+                wait = self.global_bucket.wait_time()
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                
+                entry = self.entries[payment_id]
+                wait = self._chat_bucket(entry["chat_id"]).wait_time()
+                if wait:
+                    self._schedule(payment_id, now + wait)
+                    continue
+                
+                self.global_bucket.take()
+                self._chat_bucket(entry["chat_id"]).take()
+                await self._edit(payment_id, entry)
+            except Exception:
+                logger.exception("Waiting animation loop error")
+                await asyncio.sleep(5)
+    
+    async def _edit(self, payment_id: str, entry: dict):
+        payment = storage.get_payment(payment_id)
+        if not payment or payment["status"] != "pending":
+            self.remove(payment_id)
+            return
         
-        await query.message.reply_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel_payment")],
-            ])
+        try:
+            text = waiting_text(payment, payment_id, self.frames[entry["frame"]])
+            await governor.send(
+                entry["chat_id"],
+                lambda: self.client.edit_message_text(
+                    chat_id=entry["chat_id"],
+                    message_id=entry["message_id"],
+                    text=text
+                ),
+                priority=PRIORITY_ANIMATION,
+                retries=0,
+            )
+            self.edits += 1
+            entry["failures"] = 0
+            entry["frame"] = (entry["frame"] + 1) % len(self.frames)
+        except FloodWait as e:
+            self.flood_waits += 1
+            self.paused_until = time.monotonic() + e.value
+            logger.warning(f"⏸ FloodWait {e.value}s, pausing waiting animations")
+        except Exception as e:
+            entry["failures"] += 1
+            if entry["failures"] >= ANIMATION_MAX_FAILURES:
+                logger.error(f"Waiting animation for {payment_id[:8]} dropped: {e}")
+                self.remove(payment_id)
+                return
+        
+        if payment_id in self.entries:
+            self._schedule(payment_id, time.monotonic() + self.current_interval())
+    
+    def start(self, client: Client):
+        self.client = client
+        self._task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+    
+    def stats_text(self) -> str:
+        return (
+            f"⏳ Animations: {len(self.entries)} active, every {self.current_interval():.0f}s "
+            f"({self.edits} edits, {self.flood_waits} FloodWaits)\n"
         )
 
-    # ========== BUY OUTLINE PLAN ==========
-    elif data.startswith("buy_outline_"):
-        plan_key = data.replace("buy_", "")
-        plan = OUTLINE_PLANS.get(plan_key)
+
+animator = AnimationScheduler(ANIMATION_INTERVAL, ANIMATION_GLOBAL_RATE, ANIMATION_CHAT_RATE)
+
+
+def resume_waiting_animations():
+    """Payments survive restarts; put their waiting messages back on the scheduler."""
+    for payment in storage.list_payments("pending"):
+        if payment.get("message_id"):
+            animator.add(payment["chat_id"], payment["message_id"], payment["payment_id"])
+
+
+# ==========================
+# PROVISIONING JOBS
+# ==========================
+class JobFailed(Exception):
+    """Raised by a job handler for errors a retry can't fix."""
+
+
+class ProvisionQueue:
+    """
+    Durable queue for work that talks to the panels (key provisioning).
+    
+    Jobs are rows in the jobs table keyed by an idempotency key, so submitting
+    twice is a no-op and unfinished jobs are picked up again after a restart.
+    A fixed pool of workers runs them; a failed attempt is retried with
+    exponential backoff and jitter until `max_attempts`, then the kind's
+    failure handler runs.
+    """
+    
+    def __init__(self, workers: int, max_attempts: int, retry_base: float, retry_max: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.handlers = {}   # kind -> (run(client, job), fail(client, job, error))
+        self.queue = asyncio.Queue()
+        self.client = None
+        self._tasks = []
+        self._timers = set()
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+    
+    def register(self, kind: str, run, fail):
+        self.handlers[kind] = (run, fail)
+    
+    def submit(self, job_id: str, kind: str, data: dict) -> bool:
+        if not storage.add_job(job_id, kind, data):
+            return False
+        self.queue.put_nowait(job_id)
+        return True
+    
+    def requeue(self, job: dict):
+        """Run a failed job again from scratch (tried_before() still counts the old attempts)."""
+        job["data"]["earlier_attempts"] = job["data"].get("earlier_attempts", 0) + job["attempts"]
+        job.update(status="queued", attempts=0, run_at=time.time(), last_error=None)
+        storage.save_job(job)
+        self.queue.put_nowait(job["id"])
+    
+    def _schedule(self, job_id: str, run_at: float):
+        delay = run_at - time.time()
+        if delay <= 0:
+            self.queue.put_nowait(job_id)
+            return
         
-        if not plan:
+        def fire():
+            self._timers.discard(timer)
+            self.queue.put_nowait(job_id)
+        
+        timer = asyncio.get_running_loop().call_later(delay, fire)
+        self._timers.add(timer)
+    
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error(f"Job {job_id[:8]} crashed: {e}")
+    
+    async def _run(self, job_id: str):
+        job = storage.get_job(job_id)
+        if not job or job["status"] != "queued":
             return
+        run, fail = self.handlers[job["kind"]]
+        job["status"] = "running"
+        job["attempts"] += 1
+        storage.save_job(job)
         
-        user_states[user_id] = {
-            "state": "waiting_screenshot",
-            "plan_key": plan_key,
-            "plan": plan
-        }
+        try:
+            await run(self.client, job)
+        except Exception as e:
+            job["last_error"] = str(e) or type(e).__name__
+            if not isinstance(e, JobFailed) and job["attempts"] < self.max_attempts:
+                delay = self.backoff(job["attempts"])
+                job.update(status="queued", run_at=time.time() + delay)
+                storage.save_job(job)
+                self.retries += 1
+                logger.warning(
+                    f"🔁 Job {job_id[:8]} attempt {job['attempts']} failed ({job['last_error']}), retry in {delay:.0f}s"
+                )
+                self._schedule(job_id, job["run_at"])
+                return
+            
+            job["status"] = "failed"
+            storage.save_job(job)
+            self.failed += 1
+            logger.error(f"❌ Job {job_id[:8]} failed after {job['attempts']} attempt(s): {job['last_error']}")
+            await fail(self.client, job, job["last_error"])
+            return
+        
+        job["status"] = "done"
+        storage.save_job(job)
+        self.done += 1
+    
+    def start(self, client: Client):
+        self.client = client
+        # "running" jobs were interrupted by a restart
+        for job in storage.list_jobs("running"):
+            job["status"] = "queued"
+            storage.save_job(job)
+        resumed = storage.list_jobs("queued")
+        for job in resumed:
+            self._schedule(job["id"], job["run_at"])
+        if resumed:
+            logger.info(f"♻️ Resuming {len(resumed)} provisioning job(s)")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for timer in self._timers:
+            timer.cancel()
+        for task in self._tasks:
+            task.cancel()
+    
+    def stats_text(self) -> str:
+        return (
+            f"🛠 Jobs: {storage.count_jobs('queued') + storage.count_jobs('running')} queued, "
+            f"{storage.count_jobs('failed')} failed "
+            f"({self.done} done, {self.retries} retries since start)\n"
+        )
+
+
+provisioner = ProvisionQueue(PROVISION_WORKERS, PROVISION_MAX_ATTEMPTS, PROVISION_RETRY_BASE, PROVISION_RETRY_MAX)
+
+
+async def run_payment_job(client: Client, job: dict):
+    """Provision the keys of an approved payment, record them and deliver them."""
+    data = job["data"]
+    plan = data["plan"]
+    vless = plan.get("type", "vless") == "vless"
+    
+    if "sub" not in data and data.get("renew_sub_id"):
+        await renew_payment_subscription(job)
+    
+    if "sub" not in data:
+        if vless:
+            if not xui:
+                raise JobFailed("VLESS server not configured!")
+            result = await provision_vless(plan, data["username"], job)
+            if not result:
+                raise Exception("VLESS key generation failed")
+            sub = {
+                "plan": plan["name"],
+                "type": "vless",
+                "status": "active",
+                "expiry": result["expiry"],
+                "key": result["vless_key"],
+                "sub_link": result["sub_link"],
+                "ip_limit": plan.get("ip_limit", 1),
+                "inbound_id": plan.get("inbound_id", PLAN1_INBOUND_ID),
+                "uuid": result["uuid"],
+                "email": result["email"],
+                "plan_key": data.get("plan_key"),
+            }
+        else:
+            if not marzban:
+                raise JobFailed("Marzban server not configured!")
+            key_results = await provision_outline(plan, data["username"], job)
+            if not key_results:
+                raise Exception("Outline key generation failed")
+            generated_keys = [r["ss_key"] for r in key_results]
+            sub = {
+                "plan": plan["name"],
+                "type": "outline",
+                "status": "active",
+                "expiry": key_results[0]["expiry"],
+                "keys": generated_keys,
+                "key": generated_keys[0],
+                "sub_link": key_results[0].get("sub_link", ""),
+                "num_keys": len(generated_keys),
+                "usernames": [r["username"] for r in key_results],
+                "plan_key": data.get("plan_key"),
+            }
         
+        # Subscription and job checkpoint commit together, so a crash can't
+        # record the keys twice
+        expiry = sub.pop("expiry")
+        # The checkpoint only replaces the job data once the batch commits, so
+        # a failed commit leaves the claimed pool users on the job for the retry
+        checkpoint = {**data, "sub": {**sub, "expires_at": expiry.timestamp() if expiry else None}}
+        checkpoint.pop("pool_entries", None)
+        with storage.batch():
+            sub_id = storage.add_subscription(data["user_id"], {**sub, "expiry": expiry})
+            storage.save_job({**job, "data": checkpoint})
+        job["data"] = data = checkpoint
+        expiry_engine.add(sub_id, data["sub"]["expires_at"])
+    
+    sub = data["sub"]
+    expiry = datetime.fromtimestamp(sub["expires_at"]) if sub["expires_at"] else None
+    activated = "renewed" if sub.get("renewed") else "activated"
+    
+    if vless:
+        text = (
+            "🎉 **Payment Approved!**\n"
+            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+            f"🔐 **{plan['name']}** {activated}!\n\n"
+            f"📱 IP Limit: {plan.get('ip_limit', 1)} device(s)\n"
+            f"📅 Duration: {plan.get('days', 30)} days\n"
+            f"⏰ Expires: {expiry.strftime('%Y-%m-%d %H:%M')}\n\n"
+            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+            "🔑 **VLESS Key (Tap to copy):**\n"
+            f"`{sub['key']}`\n\n"
+            "ကျေးဇူးတင်ပါတယ် 🙏"
+        )
+        buttons = [
+            [InlineKeyboardButton("📱 Open Sub Link", url=sub['sub_link'])],
+            [InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs")],
+            [InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")],
+        ]
+        sent = "🔐 VLESS Key sent"
+    else:
+        # Build message with all keys
+        keys_text = ""
+        for i, key in enumerate(sub["keys"], 1):
+            keys_text += f"**Key #{i}:**\n`{key}`\n\n"
         text = (
-            f"🌐 **{plan['name']}**\n\n"
-            f"🔑 Keys: {plan['num_keys']}\n"
-            f"📊 Data: Unlimited\n"
-            f"⏰ Validity: {plan['days']} days\n"
-            f"💵 Price: **{plan['price']}**\n\n"
+            "🎉 **Payment Approved!**\n"
             "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            "**💳 ငွေလွှဲရန်:**\n\n"
-            f"💰 **K Pay** - {PAYMENT_NAME}\n"
-            f"   📞 `{KPAY_NO}`\n\n"
-            f"💰 **AYA Pay** - {PAYMENT_NAME}\n"
-            f"   📞 `{AYA_NO}`\n\n"
-            f"💰 **Wave Pay** - {PAYMENT_NAME}\n"
-            f"   📞 `{WAVE_NO}`\n\n"
+            f"🌐 **{plan['name']}** {activated}!\n\n"
+            f"🔑 Keys: {len(sub['keys'])}\n"
+            f"📅 Duration: {plan.get('days', 30)} days\n"
+            f"⏰ Expires: {expiry.strftime('%Y-%m-%d %H:%M') if expiry else 'N/A'}\n\n"
             "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            "📸 **ငွေလွှဲပြီးရင် screenshot ပို့ပေးပါ။**\n\n"
-            "⚠️ **Note မှာ VPN နဲ့ ပတ်သတ်တဲ့ စာသားတွေ မရေးပါနဲ့နော်!**"
+            "🔑 **Outline Keys (Tap to copy):**\n\n"
+            f"{keys_text}"
+            "💡 Outline app ဖွင့်ပြီး key ကို paste လုပ်ပါ။\n\n"
+            "ကျေးဇူးတင်ပါတယ် 🙏"
+        )
+        buttons = [
+            [InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs")],
+            [InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")],
+        ]
+        sent = f"🌐 {len(sub['keys'])} Outline Key(s) sent"
+    
+    try:
+        await tg_send(
+            client.send_message,
+            chat_id=data["user_id"],
+            text=text,
+            reply_markup=InlineKeyboardMarkup(buttons),
+            priority=PRIORITY_DELIVERY,
+        )
+        delivered = ""
+    except Exception as e:
+        logger.error(f"Failed to send to user: {e}")
+        delivered = f"\n⚠️ Not delivered to user: {e}"
+    
+    await edit_admin_caption(client, data, f"\n\n✅ **APPROVED**\n{sent}{delivered}")
+
+
+async def renew_payment_subscription(job: dict):
+    """
+    Extend the subscription a renewal payment is for, keeping its keys.
+    Sets data["sub"] on success; leaves it unset when the old keys are gone
+    from the panel, so fresh ones are provisioned instead.
+    """
+    data = job["data"]
+    old = storage.get_subscription(data["renew_sub_id"])
+    if not old or old["user_id"] != data["user_id"] or not old["expires_at"] or old["status"] == "removed":
+        return
+    
+    # Fixed once per job, so a retried attempt can't extend twice
+    if "renew_expires_at" not in data:
+        days = data["plan"].get("days", 30)
+        data["renew_expires_at"] = max(time.time(), old["expires_at"]) + days * 86400
+        storage.save_job(job)
+    expires_at = data["renew_expires_at"]
+    
+    if old["type"] == "vless":
+        if not xui:
+            raise JobFailed("VLESS server not configured!")
+        renewed = await renew_vless(old, data["plan"], expires_at)
+    else:
+        if not marzban:
+            raise JobFailed("Marzban server not configured!")
+        renewed = await renew_outline(old, data["plan"], expires_at)
+    if not renewed:
+        logger.warning(f"Keys of subscription {old['id']} are gone, issuing new ones")
+        return
+    
+    data["sub"] = {
+        "key": old.get("key"),
+        "keys": old.get("keys", [old.get("key")]),
+        "sub_link": old.get("sub_link", ""),
+        "expires_at": expires_at,
+        "renewed": True,
+    }
+    with storage.batch():
+        storage.renew_subscription(old["id"], expires_at)
+        storage.save_job(job)
+    expiry_engine.add(old["id"], expires_at)
+
+
+async def fail_payment_job(client: Client, job: dict, error: str):
+    data = job["data"]
+    try:
+        await tg_send(
+            client.send_message,
+            chat_id=data["user_id"],
+            text="✅ Payment approved!\n⚠️ Key gen failed. Admin will send manually.",
+            priority=PRIORITY_DELIVERY,
+        )
+    except Exception:
+        pass
+    await edit_admin_caption(
+        client,
+        data,
+        f"\n\n✅ APPROVED - ⚠️ Key gen failed!\n❌ {error}",
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔁 Retry", callback_data=f"retry_job_{job['id']}")],
+            [InlineKeyboardButton("📤 Message User", url=f"tg://user?id={data['user_id']}")],
+        ]),
+    )
+
+
+async def edit_admin_caption(client: Client, data: dict, suffix: str, reply_markup=None):
+    """Replace the status line under the admin's payment photo."""
+    try:
+        await tg_send(
+            client.edit_message_caption,
+            chat_id=data["admin_chat_id"],
+            message_id=data["admin_message_id"],
+            caption=data["caption"] + suffix,
+            reply_markup=reply_markup,
+            priority=PRIORITY_ADMIN,
+        )
+    except Exception as e:
+        logger.error(f"Failed to update admin caption: {e}")
+
+
+provisioner.register("payment", run_payment_job, fail_payment_job)
+
+
+# ==========================
+# SUBSCRIPTION EXPIRY
+# ==========================
+class ExpiryEngine:
+    """
+    Reminds users of upcoming expiries and expires subscriptions when their
+    time is up.
+    
+    (due, id, action) entries for every active subscription sit in a
+    min-heap that is loaded once at startup and fed by add(). The loop
+    sleeps until the earliest entry (add() wakes it for an earlier one),
+    then handles the due entries in batches: reminders go out through the
+    send governor, expired keys are disabled on the panels and their rows
+    marked expired. Entries are checked against the database when they
+    come due: a renewal add()s fresh entries, and the stale ones are
+    dropped when they come up.
+    """
+    
+    def __init__(self, batch_size: int, concurrency: int, retry_delay: float, remind_before: float):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.remind_before = remind_before
+        self.heap = []
+        self.wakeup = asyncio.Event()
+        self.client = None
+        self.task = None
+        self.expired = 0
+        self.reminded = 0
+        self.retries = 0
+    
+    def _push(self, due: float, sub_id: int, action: str):
+        heapq.heappush(self.heap, (due, sub_id, action))
+        if self.heap[0] == (due, sub_id, action):
+            self.wakeup.set()
+    
+    def add(self, sub_id: int, expires_at: float | None, reminded: bool = False):
+        if not expires_at:
+            return
+        self._push(expires_at, sub_id, "expire")
+        if self.remind_before and not reminded:
+            self._push(expires_at - self.remind_before, sub_id, "remind")
+    
+    def _pop_due(self, now: float) -> dict:
+        due = {"expire": [], "remind": []}
+        count = 0
+        while self.heap and self.heap[0][0] <= now and count < self.batch_size:
+            _, sub_id, action = heapq.heappop(self.heap)
+            due[action].append(sub_id)
+            count += 1
+        return due
+    
+    async def run(self):
+        while True:
+            try:
+                now = time.time()
+                due = self._pop_due(now)
+                if due["expire"] or due["remind"]:
+                    for action, handler in (("remind", self._remind), ("expire", self._expire)):
+                        if not due[action]:
+                            continue
+                        try:
+                            await handler(due[action])
+                        except Exception as e:
+                            logger.error(f"Expiry {action} batch failed: {e}")
+                            for sub_id in due[action]:
+                                heapq.heappush(self.heap, (now + self.retry_delay, sub_id, action))
+                    continue
+                
+                # Capped so a wall clock change can't leave us asleep for days
+                timeout = min(self.heap[0][0] - now, 3600) if self.heap else None
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception:
+                logger.exception("Expiry loop error")
+                await asyncio.sleep(5)
+    
+    async def _remind(self, sub_ids: list):
+        now = time.time()
+        subs = []
+        for sub in storage.get_subscriptions_by_id(sub_ids):
+            if sub["status"] != "active" or not sub["expires_at"] or sub["expires_at"] <= now:
+                continue
+            if sub.get("reminded") or not subscription_plan_key(sub):
+                continue
+            if sub["expires_at"] - self.remind_before <= now:
+                subs.append(sub)
+        if not subs:
+            return
+        
+        async def remind(sub: dict):
+            type_emoji = "🔐" if sub.get("type") == "vless" else "🌐"
+            try:
+                await tg_send(
+                    self.client.send_message,
+                    chat_id=sub["user_id"],
+                    text=(
+                        "⏰ **Subscription expiring soon**\n\n"
+                        f"{type_emoji} **{sub['plan']}**\n"
+                        f"📅 Expires: {sub['expires']}\n\n"
+                        "🔄 Renew now to keep using the same key."
+                    ),
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🔄 Renew", callback_data=f"renew_{sub['id']}")],
+                        [InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs")],
+                    ]),
+                    priority=PRIORITY_REMINDER,
+                )
+            except Exception as e:
+                logger.warning(f"Renewal reminder for {sub['user_id']} failed: {e}")
+        
+        # The governor paces these against the Telegram limits
+        await asyncio.gather(*(remind(sub) for sub in subs))
+        with storage.batch():
+            for sub in subs:
+                storage.mark_reminded(sub["id"])
+        self.reminded += len(subs)
+        logger.info(f"⏰ Sent {len(subs)} renewal reminder(s)")
+    
+    async def _expire(self, sub_ids: list):
+        now = time.time()
+        subs = []
+        for sub in storage.get_subscriptions_by_id(sub_ids):
+            if sub["status"] == "active" and sub["expires_at"] and sub["expires_at"] <= now:
+                subs.append(sub)
+        if not subs:
+            return
+        
+        # One client list per inbound for the whole batch
+        inbound_clients = {}
+        if xui:
+            for inbound_id in {s["inbound_id"] for s in subs if s["type"] == "vless" and s.get("inbound_id")}:
+                clients = await xui.get_inbound_clients(inbound_id)
+                # A failed list stays out, so its subscriptions are retried
+                if clients is not None:
+                    inbound_clients[inbound_id] = {c.get("email"): c for c in clients}
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def disable(sub: dict) -> bool:
+            async with semaphore:
+                return await self._disable(sub, inbound_clients)
+        
+        results = await asyncio.gather(*(disable(sub) for sub in subs))
+        with storage.batch():
+            for sub, ok in zip(subs, results):
+                if ok:
+                    storage.set_subscription_status(sub["id"], "expired")
+        
+        done = sum(results)
+        self.expired += done
+        for sub, ok in zip(subs, results):
+            if not ok:
+                self.retries += 1
+                heapq.heappush(self.heap, (now + self.retry_delay, sub["id"], "expire"))
+        logger.info(f"⌛ Expired {done}/{len(subs)} subscription(s)")
+    
+    async def _disable(self, sub: dict, inbound_clients: dict) -> bool:
+        """Switch the subscription's keys off on its panel (True if nothing is left enabled)."""
+        if sub["type"] == "vless":
+            if not xui or not sub.get("inbound_id"):
+                return True
+            clients = inbound_clients.get(sub["inbound_id"])
+            if clients is None:
+                return False
+            client = clients.get(sub.get("email"))
+            if not client or not client.get("enable", True):
+                return True
+            return await xui.update_client(sub["inbound_id"], {**client, "enable": False})
+        
+        if not marzban:
+            return True
+        results = await asyncio.gather(*(
+            marzban.modify_user(username, {"status": "disabled"}) for username in sub.get("usernames", [])
+        ))
+        # A user that no longer exists (None) has nothing left to disable
+        return all(ok is not False for ok in results)
+    
+    def start(self, client: Client):
+        self.client = client
+        self.heap = []
+        for expires_at, sub_id, reminded in storage.active_expiries():
+            self.heap.append((expires_at, sub_id, "expire"))
+            if self.remind_before and not reminded:
+                self.heap.append((expires_at - self.remind_before, sub_id, "remind"))
+        heapq.heapify(self.heap)
+        if self.heap:
+            logger.info(f"⌛ Tracking {len(self.heap)} expiry and reminder entries")
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+    
+    def stats_text(self) -> str:
+        next_text = "-"
+        if self.heap:
+            next_text = datetime.fromtimestamp(self.heap[0][0]).strftime("%Y-%m-%d %H:%M")
+        return (
+            f"⌛ Expiry: {len(self.heap)} scheduled, next {next_text} "
+            f"({self.expired} expired, {self.reminded} reminded, {self.retries} retries since start)\n"
         )
+
+
+expiry_engine = ExpiryEngine(EXPIRY_BATCH_SIZE, EXPIRY_CONCURRENCY, EXPIRY_RETRY_DELAY, RENEWAL_REMINDER_DAYS * 86400)
+
+
+# ==========================
+# EXPIRED CLIENT GC
+# ==========================
+class ClientGC:
+    """
+    Deletes long-expired clients from the panels.
+    
+    3X-UI keeps every client of an inbound in one settings JSON, so each
+    leftover trial or lapsed subscription makes every later addClient, list
+    and restart a bit slower. Each run deletes clients that expired more
+    than `grace` seconds ago (pool entries and never-expiring clients are
+    left alone), marks their subscriptions "removed" and reports to the
+    admin.
+    """
+    
+    def __init__(self, interval: int, grace: float, batch_size: int, rate: float):
+        self.interval = interval
+        self.grace = grace
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate)
+        self.client = None
+        self.task = None
+        self.lock = asyncio.Lock()
+        self.last_run = None
+        self.last_report = None
+        self.last_deleted = 0
+        self.total_clients = 0
+        self.total_bytes = 0
+    
+    async def _throttle(self):
+        while not self.bucket.take():
+            await asyncio.sleep(self.bucket.wait_time())
+    
+    async def collect_vless(self, cutoff: float) -> tuple[set, int]:
+        """Delete expired 3X-UI clients; returns {(inbound_id, email)} and bytes freed."""
+        deleted = set()
+        freed = 0
+        inbound_ids = {TRIAL_INBOUND_ID} | {p.get("inbound_id", PLAN1_INBOUND_ID) for p in VLESS_PLANS.values()}
+        for inbound_id in sorted(inbound_ids):
+            clients = await xui.get_inbound_clients(inbound_id)
+            if clients is None:
+                logger.warning(f"⚠️ GC skipped inbound {inbound_id}: client list unavailable")
+                continue
+            expired = [
+                c for c in clients
+                if 0 < c.get("expiryTime", 0) < cutoff * 1000 and not POOL_VLESS_EMAIL.match(c.get("email", ""))
+            ]
+            count = 0
+            for c in expired[:self.batch_size]:
+                await self._throttle()
+                if await xui.delete_client(inbound_id, c["id"]):
+                    deleted.add((inbound_id, c.get("email")))
+                    freed += len(json.dumps(c))
+                    count += 1
+            if expired:
+                logger.info(f"🧹 Inbound {inbound_id}: deleted {count}/{len(expired)} expired client(s)")
+        return deleted, freed
+    
+    async def collect_outline(self, cutoff: float) -> set:
+        """Delete expired Marzban users; returns their usernames."""
+        deleted = set()
+        expired = []
+        for status in ("expired", "disabled"):
+            expired += [
+                u["username"] for u in await marzban.list_users(status=status)
+                if u.get("expire") and u["expire"] < cutoff and not is_pool_outline_user(u)
+            ]
+        for username in expired[:self.batch_size]:
+            await self._throttle()
+            if await marzban.delete_user(username):
+                deleted.add(username)
+        return deleted
+    
+    def forget(self, vless_deleted: set, outline_deleted: set) -> int:
+        """Mark expired subscriptions whose keys are all gone as removed."""
+        removed = []
+        for sub in storage.list_subscriptions("expired"):
+            if sub["type"] == "vless":
+                gone = (sub.get("inbound_id"), sub.get("email")) in vless_deleted
+            else:
+                usernames = sub.get("usernames", [])
+                gone = bool(usernames) and all(u in outline_deleted for u in usernames)
+            if gone:
+                removed.append(sub["id"])
+        with storage.batch():
+            for sub_id in removed:
+                storage.set_subscription_status(sub_id, "removed")
+        return len(removed)
+    
+    async def collect(self) -> str:
+        async with self.lock:
+            started = time.monotonic()
+            cutoff = time.time() - self.grace
+            vless_deleted, freed = (await self.collect_vless(cutoff)) if xui else (set(), 0)
+            outline_deleted = (await self.collect_outline(cutoff)) if marzban else set()
+            forgotten = self.forget(vless_deleted, outline_deleted)
+            
+            self.last_run = time.time()
+            self.last_deleted = len(vless_deleted) + len(outline_deleted)
+            self.total_clients += self.last_deleted
+            self.total_bytes += freed
+            self.last_report = (
+                f"🧹 **Client GC** ({time.monotonic() - started:.1f}s)\n"
+                f"🔐 3X-UI clients deleted: {len(vless_deleted)} (~{freed / 1024:.1f} KB of inbound settings)\n"
+                f"🌐 Marzban users deleted: {len(outline_deleted)}\n"
+                f"📋 Subscriptions marked removed: {forgotten}"
+            )
+            logger.info(self.last_report.replace("**", ""))
+            return self.last_report
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                report = await self.collect()
+                if self.last_deleted:
+                    await tg_send(self.client.send_message, chat_id=ADMIN_USER_ID, text=report, priority=PRIORITY_ADMIN)
+            except Exception:
+                logger.exception("Client GC failed")
+    
+    def start(self, client: Client):
+        self.client = client
+        if self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+    
+    def stats_text(self) -> str:
+        last = datetime.fromtimestamp(self.last_run).strftime("%Y-%m-%d %H:%M") if self.last_run else "never"
+        return (
+            f"🧹 GC: last run {last} "
+            f"({self.total_clients} clients, {self.total_bytes / 1024:.1f} KB reclaimed since start)\n"
+        )
+
+
+client_gc = ClientGC(GC_INTERVAL, GC_GRACE_DAYS * 86400, GC_BATCH_SIZE, GC_RATE)
+
+
+# ==========================
+# USAGE SYNC
+# ==========================
+def usage_keys(sub: dict) -> list:
+    """Usage cache keys of a subscription's panel clients."""
+    if sub.get("type") == "vless":
+        return [f"vless:{sub.get('inbound_id')}:{sub.get('email')}"] if sub.get("email") else []
+    return [f"outline:{username}" for username in sub.get("usernames", [])]
+
+
+def format_bytes(n: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.2f} {unit}"
+        n /= 1024
+    return f"{n:.2f} TB"
+
+
+def usage_text(sub: dict, usage: dict, indent: str = "") -> str:
+    """Used/remaining data and last-seen lines from the usage cache ("" if not synced yet)."""
+    entries = [usage[key] for key in usage_keys(sub) if key in usage]
+    if not entries:
+        return ""
+    used = sum(e["used_bytes"] for e in entries)
+    limit = sum(e["limit_bytes"] for e in entries) if all(e["limit_bytes"] for e in entries) else 0
+    if limit:
+        text = f"{indent}📊 Used: {format_bytes(used)} / {format_bytes(limit)} ({format_bytes(max(0, limit - used))} left)\n"
+    else:
+        text = f"{indent}📊 Used: {format_bytes(used)} / Unlimited\n"
+    
+    if any(e["online"] for e in entries):
+        text += f"{indent}🟢 Online now\n"
+    else:
+        last_seen = max((e["last_seen"] or 0) for e in entries)
+        if last_seen:
+            text += f"{indent}👁 Last seen: {datetime.fromtimestamp(last_seen).strftime('%Y-%m-%d %H:%M')}\n"
+    return text
+
+
+class UsageSync:
+    """
+    Copies client traffic stats from the panels into the usage table.
+    
+    One pass is one inbound list (plus the online list) from 3X-UI and one
+    user list from Marzban, so the cost doesn't depend on how often users
+    open their subscriptions; the screens only read the local table.
+    """
+    
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.task = None
+        self.last_sync = None
+        self.last_duration = 0.0
+        self.last_count = 0
+    
+    async def vless_rows(self, now: float) -> list:
+        stats = await xui.list_client_stats()
+        online = await xui.online_clients() if stats else set()
+        rows = []
+        for c in stats:
+            last_online = c.get("lastOnline") or 0
+            rows.append((
+                f"vless:{c.get('inboundId')}:{c.get('email')}",
+                (c.get("up") or 0) + (c.get("down") or 0),
+                c.get("total") or 0,
+                c["expiryTime"] / 1000 if (c.get("expiryTime") or 0) > 0 else None,
+                last_online / 1000 if last_online > 0 else None,
+                int(c.get("email") in online),
+                now,
+            ))
+        return rows
+    
+    async def outline_rows(self, now: float) -> list:
+        rows = []
+        for u in await marzban.list_users():
+            last_seen = None
+            if u.get("online_at"):
+                # Marzban reports naive UTC timestamps
+                online_at = datetime.fromisoformat(u["online_at"].rstrip("Z"))
+                last_seen = online_at.replace(tzinfo=timezone.utc).timestamp()
+            rows.append((
+                f"outline:{u['username']}",
+                u.get("used_traffic") or 0,
+                u.get("data_limit") or 0,
+                u.get("expire") or None,
+                last_seen,
+                0,
+                now,
+            ))
+        return rows
+    
+    async def sync(self):
+        started = time.monotonic()
+        now = time.time()
+        rows = []
+        if xui:
+            rows += await self.vless_rows(now)
+        if marzban:
+            rows += await self.outline_rows(now)
+        storage.save_usage(rows)
+        self.last_sync = now
+        self.last_count = len(rows)
+        self.last_duration = time.monotonic() - started
+        logger.info(f"📊 Usage synced for {len(rows)} client(s) in {self.last_duration:.1f}s")
+    
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Usage sync failed: {e}")
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        if self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+    
+    def stats_text(self) -> str:
+        last = datetime.fromtimestamp(self.last_sync).strftime("%H:%M") if self.last_sync else "never"
+        return f"📊 Usage: {storage.count_usage()} cached, last sync {last} ({self.last_count} in {self.last_duration:.1f}s)\n"
+
+
+usage_sync = UsageSync(USAGE_SYNC_INTERVAL)
+
+
+# ==========================
+# DUPLICATE SCREENSHOTS
+# ==========================
+def dhash(data: bytes, size: int = 8) -> int:
+    """64-bit difference hash of an image (runs in the hashing threads)."""
+    image = Image.open(io.BytesIO(data)).convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+class ScreenshotIndex:
+    """
+    dHashes of payment screenshots with Hamming-distance lookup.
+    
+    Hashes sit in flat arrays (backed by the screenshot_hashes table) and
+    every hash is also filed under each of its eight bytes. Two hashes at
+    most 7 bits apart agree on at least one whole byte, so a lookup only
+    compares against the entries sharing a byte with it instead of
+    scanning them all. Hashing runs in a thread pool, off the event loop
+    (PIL releases the GIL while decoding and resizing).
+    """
+    
+    BANDS = 8
+    
+    def __init__(self, max_distance: int, workers: int, budget: float):
+        self.max_distance = max_distance
+        self.workers = workers
+        self.budget = budget
+        self.hashes = array("Q")
+        self.user_ids = array("q")
+        self.payment_ids = []
+        self.bands = [{} for _ in range(self.BANDS)]   # byte value -> array of positions
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dhash")
+        self.checked = 0
+        self.flagged = 0
+        self.timeouts = 0
+        self.total_latency = 0.0
+    
+    def _index(self, value: int, payment_id: str, user_id: int):
+        position = len(self.hashes)
+        self.hashes.append(value)
+        self.user_ids.append(user_id)
+        self.payment_ids.append(payment_id)
+        for band in range(self.BANDS):
+            key = (value >> (band * 8)) & 0xFF
+            positions = self.bands[band].get(key)
+            if positions is None:
+                positions = self.bands[band][key] = array("I")
+            positions.append(position)
+    
+    def load(self):
+        for payment_id, user_id, value in storage.screenshot_hashes():
+            self._index(value, payment_id, user_id)
+        if self.hashes:
+            logger.info(f"🖼 Loaded {len(self.hashes)} screenshot hashes")
+    
+    def add(self, value: int, payment_id: str, user_id: int):
+        storage.add_screenshot_hash(payment_id, user_id, value)
+        self._index(value, payment_id, user_id)
+    
+    def lookup(self, value: int, limit: int = 3) -> list:
+        """Closest earlier screenshots as (distance, payment_id, user_id)."""
+        seen = set()
+        matches = []
+        for band in range(self.BANDS):
+            for position in self.bands[band].get((value >> (band * 8)) & 0xFF, ()):
+                if position in seen:
+                    continue
+                seen.add(position)
+                distance = (value ^ self.hashes[position]).bit_count()
+                if distance <= self.max_distance:
+                    matches.append((distance, self.payment_ids[position], self.user_ids[position]))
+        return sorted(matches)[:limit]
+    
+    async def _hash(self, client: Client, message: Message) -> int:
+        media = await client.download_media(message, in_memory=True)
+        return await asyncio.get_running_loop().run_in_executor(self.pool, dhash, media.getvalue())
+    
+    async def check(self, client: Client, message: Message) -> tuple[int | None, list]:
+        """Hash a screenshot and find earlier look-alikes: (hash or None, matches)."""
+        if Image is None:
+            return None, []
+        started = time.monotonic()
+        try:
+            value = await asyncio.wait_for(self._hash(client, message), self.budget)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"Screenshot check took over {self.budget:.0f}s, forwarding unchecked")
+            return None, []
+        except Exception as e:
+            logger.error(f"Screenshot hashing failed: {e}")
+            return None, []
+        
+        matches = self.lookup(value)
+        self.checked += 1
+        self.total_latency += time.monotonic() - started
+        if matches:
+            self.flagged += 1
+        return value, matches
+    
+    def caption_text(self, matches: list, user_id: int) -> str:
+        if not matches:
+            return ""
+        text = "⚠️ **Possible duplicate screenshot!**\n"
+        for distance, payment_id, match_user_id in matches:
+            who = "same user" if match_user_id == user_id else f"user `{match_user_id}`"
+            text += f"   • `{payment_id[:8]}` ({who}, {distance} bits off)\n"
+        return text + "\n"
+    
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+    
+    def stats_text(self) -> str:
+        if Image is None:
+            return "🖼 Screenshots: duplicate check off (no Pillow)\n"
+        avg = self.total_latency / self.checked * 1000 if self.checked else 0
+        return (
+            f"🖼 Screenshots: {len(self.hashes)} hashed, {self.flagged} flagged, "
+            f"{self.timeouts} over budget (avg {avg:.0f}ms)\n"
+        )
+
+
+screenshots = ScreenshotIndex(SCREENSHOT_MATCH_DISTANCE, SCREENSHOT_HASH_WORKERS, SCREENSHOT_CHECK_BUDGET)
+
+
+# ==========================
+# UPDATE DISPATCH
+# ==========================
+class UpdateDispatcher:
+    """
+    Runs each user's updates one at a time, in arrival order, and different
+    users in parallel on `workers` tasks.
+    
+    Pyrogram handlers only enqueue, so one user mashing buttons can't hold
+    the update workers and two updates of the same user can't race on their
+    state. A user takes turns with the others, one update per turn. An
+    update whose key is already queued or running for that user is dropped
+    as a duplicate, and so is anything beyond `queue_size` waiting updates.
+    """
+    
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queues = {}     # user_id -> deque of (key, call); present while queued or running
+        self.running = {}    # user_id -> key being handled
+        self.ready = asyncio.Queue()
+        self._tasks = []
+        self.handled = 0
+        self.duplicates = 0
+        self.rejected = 0
+    
+    def submit(self, user_id: int, key: str, call) -> str | None:
+        """
+        Queue `call` (a no-arg coroutine function) behind the user's earlier
+        updates. Returns None if queued, else "duplicate" or "busy".
+        """
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        
+        queue = self.queues.get(user_id)
+        if queue is None:
+            self.queues[user_id] = deque([(key, call)])
+            self.ready.put_nowait(user_id)
+            return None
+        if self.running.get(user_id) == key or any(k == key for k, _ in queue):
+            self.duplicates += 1
+            return "duplicate"
+        if len(queue) >= self.queue_size:
+            self.rejected += 1
+            return "busy"
+        # The worker handling this user puts it back in line when done
+        queue.append((key, call))
+        return None
+    
+    async def _worker(self):
+        while True:
+            user_id = await self.ready.get()
+            queue = self.queues[user_id]
+            key, call = queue.popleft()
+            self.running[user_id] = key
+            try:
+                await call()
+            except Exception as e:
+                logger.error(f"Update {key} of user {user_id} failed: {e}")
+            finally:
+                self.handled += 1
+                del self.running[user_id]
+                if queue:
+                    self.ready.put_nowait(user_id)
+                else:
+                    del self.queues[user_id]
+    
+    def per_user(self, key, on_drop=None, limit=None):
+        """
+        Handler decorator: `key(update)` names the update for duplicate
+        detection; `limit` (a RateLimit) is checked before anything is queued.
+        """
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(client: Client, update):
+                user_id = update.from_user.id
+                if limit and not limit.allow(user_id):
+                    reason = "limited"
+                else:
+                    reason = self.submit(user_id, key(update), lambda: handler(client, update))
+                if reason and on_drop:
+                    await on_drop(update, reason)
+            return wrapper
+        return decorator
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+    
+    def stats_text(self) -> str:
+        return (
+            f"📨 Updates: {self.handled} handled, {len(self.queues)} user(s) busy "
+            f"({self.duplicates} duplicates, {self.rejected} over limit dropped)\n"
+        )
+
+
+async def drop_callback(query: CallbackQuery, reason: str):
+    """Stop the button's spinner for a press that was not queued."""
+    notice = reason == "busy" and slow_down_notices.take(query.from_user.id)
+    try:
+        await query.answer("⏳ Please wait..." if notice else None)
+    except Exception:
+        pass
+
+
+async def drop_photo(message: Message, reason: str):
+    if reason == "duplicate" or not slow_down_notices.take(message.from_user.id):
+        return
+    try:
+        await tg_send(message.reply_text, "⏳ Too many photos, please wait a moment and send it again.")
+    except Exception:
+        pass
+
+
+dispatcher = UpdateDispatcher(DISPATCH_WORKERS, USER_QUEUE_SIZE)
+
+
+# ==========================
+# PAYMENT REVIEWERS
+# ==========================
+def review_markup(payment_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Approve", callback_data=f"approve_{payment_id}"),
+            InlineKeyboardButton("❌ Reject", callback_data=f"reject_{payment_id}"),
+        ],
+    ])
+
+
+class ReviewAssigner:
+    """
+    Spreads payment reviews over several reviewer accounts.
+    
+    Each new payment is assigned to one reviewer ("least_loaded": fewest
+    pending payments, ties taken in turn; "round_robin": strict rotation)
+    and only that reviewer gets the photo. The assignment is stored on the
+    payment and changed by compare-and-swap, and approve/reject check it in
+    the same UPDATE as the status change, so two reviewers can never both
+    handle one payment. A payment left alone for `timeout` seconds is
+    handed to another reviewer. The owner can act on every payment.
+    """
+    
+    def __init__(self, reviewers: list, owner: int, strategy: str, timeout: int):
+        self.reviewers = list(dict.fromkeys(reviewers))
+        self.owner = owner
+        self.strategy = strategy
+        self.timeout = timeout
+        self.turn = 0
+        self.client = None
+        self.task = None
+        self.assigned = 0
+        self.reassigned = 0
+        self.unreachable = 0
+    
+    def role(self, user_id: int) -> str | None:
+        if user_id == self.owner:
+            return "owner"
+        if user_id in self.reviewers:
+            return "reviewer"
+        return None
+    
+    def scope(self, user_id: int) -> int | None:
+        """The reviewer whose payments `user_id` may act on (None = all of them)."""
+        return None if user_id == self.owner else user_id
+    
+    def may_handle(self, user_id: int, payment: dict | None) -> bool:
+        scope = self.scope(user_id)
+        return scope is None or bool(payment) and payment.get("reviewer") == scope
+    
+    def candidates(self, exclude: int | None = None) -> list:
+        """Reviewers in the order to try them for the next payment."""
+        start = self.turn % len(self.reviewers)
+        self.turn += 1
+        order = self.reviewers[start:] + self.reviewers[:start]
+        if self.strategy == "least_loaded":
+            loads = storage.review_loads()
+            order.sort(key=lambda reviewer: loads.get(reviewer, 0))   # stable, so ties keep their turn
+        return [reviewer for reviewer in order if reviewer != exclude]
+    
+    async def hand_over(self, client: Client, payment_id: str, photo: str, caption: str, current: int | None = None) -> int | None:
+        """
+        Assign the payment to the first reviewer (other than `current`) the
+        photo can be sent to. None if it was decided or moved meanwhile, or
+        no reviewer could be reached (then it goes back to `current`).
+        """
+        holder = current
+        for reviewer in self.candidates(exclude=current):
+            if not storage.assign_payment(payment_id, reviewer, holder):
+                return None
+            holder = reviewer
+            try:
+                message = await tg_send(
+                    client.send_photo,
+                    chat_id=reviewer,
+                    photo=photo,
+                    caption=caption,
+                    reply_markup=review_markup(payment_id),
+                    priority=PRIORITY_ADMIN,
+                )
+            except Exception as e:
+                self.unreachable += 1
+                logger.warning(f"⚠️ Reviewer {reviewer} unreachable: {e}")
+                continue
+            # Later caption edits (approve, reject, provisioning) go to this photo
+            storage.update_payment(payment_id, admin_chat_id=reviewer, admin_message_id=message.id, caption=caption)
+            return reviewer
+        storage.assign_payment(payment_id, current, holder)
+        return None
+    
+    async def assign(self, client: Client, payment_id: str, photo: str, caption: str) -> int | None:
+        reviewer = await self.hand_over(client, payment_id, photo, caption)
+        if reviewer is not None:
+            self.assigned += 1
+        return reviewer
+    
+    async def reassign(self, payment: dict):
+        current = payment.get("reviewer")
+        reviewer = await self.hand_over(self.client, payment["payment_id"], payment["photo_file_id"], payment["caption"], current)
+        if reviewer is None:
+            return
+        self.reassigned += 1
+        logger.info(f"🔀 Payment {payment['payment_id'][:8]} moved from reviewer {current} to {reviewer}")
+        if payment.get("admin_message_id"):
+            await edit_admin_caption(
+                self.client, admin_ref_of(payment), f"\n\n🔀 **Reassigned** (no action in {format_age(self.timeout)})"
+            )
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(min(self.timeout, 60))
+            try:
+                for payment in storage.overdue_reviews(time.time() - self.timeout):
+                    if payment.get("caption"):
+                        await self.reassign(payment)
+            except Exception as e:
+                logger.error(f"Review reassignment failed: {e}")
+    
+    def start(self, client: Client):
+        self.client = client
+        if self.timeout > 0 and len(self.reviewers) > 1:
+            self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+    
+    def stats_text(self) -> str:
+        loads = storage.review_loads()
+        per_reviewer = ", ".join(f"{reviewer}: {loads.get(reviewer, 0)}" for reviewer in self.reviewers)
+        return (
+            f"👮 Reviewers ({self.strategy}): {per_reviewer} pending | "
+            f"{self.assigned} assigned, {self.reassigned} reassigned, {self.unreachable} unreachable\n"
+        )
+
+
+reviewers = ReviewAssigner(REVIEWER_IDS, ADMIN_USER_ID, REVIEW_ASSIGNMENT, REVIEW_TIMEOUT)
+PHOTO_LIMIT = RateLimit(PHOTO_RATE, PHOTO_BURST)
+
+
+# ==========================
+# HELPERS
+# ==========================
+def get_username(user) -> str:
+    if user.username:
+        return user.username
+    elif user.first_name:
+        return f"{user.first_name}_{user.id}"
+    else:
+        return f"user_{user.id}"
+
+
+def subscription_plan_key(sub: dict) -> str | None:
+    """Plan a subscription was bought with (None for trials and unknown plans)."""
+    if sub.get("plan_key") in ALL_PLANS:
+        return sub["plan_key"]
+    # Rows from before plan_key was stored only have the plan name
+    for plan_key, plan in ALL_PLANS.items():
+        if plan["name"] == sub.get("plan"):
+            return plan_key
+    return None
+
+
+# ==========================
+# VIEWS
+# ==========================
+class ViewRegistry:
+    """
+    Static screens (text + keyboard) rendered once and reused on every click.
+    
+    Builders are registered per view name and called by build() for each
+    language; call build() again after changing plans or prices.
+    """
+    
+    def __init__(self, languages: tuple = ("my",)):
+        self.languages = languages
+        self.builders = {}   # name -> builder(lang) -> (text, markup)
+        self.cache = {}      # (name, lang) -> (text, markup)
+    
+    def register(self, name: str):
+        def decorator(builder):
+            self.builders[name] = builder
+            return builder
+        return decorator
+    
+    def build(self):
+        self.cache = {
+            (name, lang): builder(lang)
+            for name, builder in self.builders.items()
+            for lang in self.languages
+        }
+        logger.info(f"🖼 Rendered {len(self.cache)} views")
+    
+    def get(self, name: str, lang: str = "my") -> tuple[str, InlineKeyboardMarkup | None]:
+        return self.cache[(name, lang)]
+    
+    def text(self, name: str, lang: str = "my") -> str:
+        return self.cache[(name, lang)][0]
+    
+    def markup(self, name: str, lang: str = "my") -> InlineKeyboardMarkup | None:
+        return self.cache[(name, lang)][1]
+
+
+views = ViewRegistry()
+
+
+@views.register("main_menu")
+def main_menu_view(lang: str):
+    return "🔐 **Zembi VPN Bot**\n\nMenu:", InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎁 Free Trial", callback_data="free_trial"),
+            InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs"),
+        ],
+        [
+            InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps"),
+            InlineKeyboardButton("🆘 Support", url=f"https://t.me/{ADMIN_USERNAME}"),
+        ],
+        [
+            InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices"),
+            InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices"),
+        ],
+    ])
+
+
+@views.register("welcome")
+def welcome_view(lang: str):
+    # Sent after the per-user greeting line
+    return (
+        "ကျနော်က **Zembi** ပါ။ ✌🏻\n\n"
+        "🔐 **VLESS** နဲ့ 🌐 **Outline** VPN key တွေကို\n"
+        "စျေးနှုန်း ချိုချိုသာသာနဲ့ ရောင်းပေးနေတာပါဗျ။\n\n"
+        "**🔐 VLESS VPN:**\n"
+        "• လက်ရှိ မြန်မာနိုင်ငံနှင့် အသင့်တော်ဆုံး\n"
+        "• V2Ray, Hiddify app များဖြင့် သုံးရန်\n"
+        "• Singapore Server 🇸🇬\n"
+        "• IP limit based (1 key = multi device)\n\n"
+        "**🌐 Outline VPN:**\n"
+        "• အလွယ်တကူ ချိတ်ဆက်နိုင်\n"
+        "• Outline app ဖြင့် သုံးရန်\n"
+        "• US Server 🇺🇸\n"
+        "• 1 key = 1 device\n\n"
+        "📊 Data: Unlimited\n"
+        "⏰ Validity: 30 Days\n\n"
+        "အောက်က menu မှ \n"
+        "VLESS VPN သို့မဟုတ် Outline VPN ကိုနှိပ်ပြီး ဝယ်ယူနိုင်ပါတယ်ဗျ။\n\n"
+        "အသေးစိတ်သိလိုပါက Support ကိုနှိပ်ပြီး admin နဲ့ ဆက်သွယ်နိုင်ပါတယ်နော်။\n\n"
+    ), main_menu_view(lang)[1]
+
+
+@views.register("cancelled")
+def cancelled_view(lang: str):
+    return "❌ **ပယ်ဖျက်လိုက်ပါပြီ။**", main_menu_view(lang)[1]
+
+
+@views.register("vless_prices")
+def vless_prices_view(lang: str):
+    return (
+        "🔐 **VLESS VPN Plans**\n\n"
+        "✅ Unlimited Data\n"
+        "✅ 30 Days Validity\n"
+        "✅ Singapore Server 🇸🇬\n"
+        "✅ High-Speed\n"
+        "✅ 1 Key = Multi Device (IP based)\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"🥉 **Basic** - {plan_1_price} (1 device)\n"
+        f"🥈 **Silver** - {plan_2_price} (2 devices)\n"
+        f"🥇 **Golden** - {plan_3_price} (3 devices)\n\n"
+        "Plan ရွေးချယ်ပါ:"
+    ), InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🥉 Basic - {plan_1_price}", callback_data="buy_vless_1")],
+        [InlineKeyboardButton(f"🥈 Silver - {plan_2_price}", callback_data="buy_vless_2")],
+        [InlineKeyboardButton(f"🥇 Golden - {plan_3_price}", callback_data="buy_vless_3")],
+        [InlineKeyboardButton("🌐 View Outline Plans", callback_data="outline_prices")],
+        [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
+    ])
+
+
+@views.register("outline_prices")
+def outline_prices_view(lang: str):
+    return (
+        "🌐 **Outline VPN Plans**\n\n"
+        "✅ Unlimited Data\n"
+        "✅ 30 Days Validity\n"
+        "✅ Easy to connect\n"
+        "✅ Works on all platforms\n"
+        "⚠️ 1 Key = 1 Device\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"🥉 **1 Key** - {plan_1_price}\n"
+        f"🥈 **2 Keys** - {plan_2_price}\n"
+        f"🥇 **3 Keys** - {plan_3_price}\n\n"
+        "Plan ရွေးချယ်ပါ:"
+    ), InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🥉 1 Key - {plan_1_price}", callback_data="buy_outline_1")],
+        [InlineKeyboardButton(f"🥈 2 Keys - {plan_2_price}", callback_data="buy_outline_2")],
+        [InlineKeyboardButton(f"🥇 3 Keys - {plan_3_price}", callback_data="buy_outline_3")],
+        [InlineKeyboardButton("🔐 View VLESS Plans", callback_data="vless_prices")],
+        [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
+    ])
+
+
+@views.register("vpn_apps")
+def vpn_apps_view(lang: str):
+    text = "📲 **VPN Apps**\n\n"
+    buttons = []
+    for vpn_type, title in (("vless", "**🔐 For VLESS:**\n"), ("outline", "\n**🌐 For Outline:**\n")):
+        text += title
+        for vpn_app in VPN_APPS:
+            if vpn_app["for"] == vpn_type:
+                text += f"• {vpn_app['name']} - {vpn_app['platform']}\n"
+                buttons.append([InlineKeyboardButton(f"📥 {vpn_app['name']}", url=vpn_app["url"])])
+    
+    buttons.append([InlineKeyboardButton("⬅️ Back", callback_data="back_menu")])
+    return text, InlineKeyboardMarkup(buttons)
+
+
+views.build()
+
+
+# ==========================
+# /start COMMAND
+# ==========================
+@app.on_message(filters.command("start") & filters.private)
+@dispatcher.per_user(lambda message: f"message:{message.id}")
+async def start_handler(client: Client, message: Message):
+    storage.clear_state(message.from_user.id)
+    
+    user_name = message.from_user.first_name or "User"
+    text, markup = views.get("welcome")
+    await tg_send(message.reply_text, f"မင်္ဂလာပါ {user_name}! 🙏🏻\n\n" + text, reply_markup=markup)
+
+
+# ==========================
+# CALLBACK ROUTER
+# ==========================
+class CallbackRouter:
+    """
+    Maps callback_data to handler functions.
+    
+    Exact routes ("my_subs") are a dict lookup. Prefix routes ("view_key_")
+    must end in "_" and match the longest registered prefix; the rest of the
+    data is parsed and passed to the handler as its third argument. Every
+    route runs through its middleware chain: timing, then the optional admin
+    check and per-user rate limit, then the query is answered.
+    """
+    
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.stats = {}   # route name -> [calls, total seconds, max seconds]
+    
+    def route(self, key: str, prefix: bool = False, parse=None, reviewer: bool = False, rate: tuple | None = None, answer: bool = True):
+        """
+        Register a handler. `parse` converts the prefix argument (a ValueError
+        rejects the query), `reviewer` allows only payment reviewers (and the
+        owner), `rate` is (tokens per second, burst) per user, or a shared RateLimit, and
+        `answer=False` leaves query.answer() to the handler.
+        """
+        def decorator(func):
+            middleware = [self.timing]
+            if reviewer:
+                middleware.append(reviewer_only)
+            if rate:
+                middleware.append(rate if isinstance(rate, RateLimit) else RateLimit(*rate))
+            if answer:
+                middleware.append(answer_query)
+            route = {"name": key, "func": func, "prefix": prefix, "parse": parse, "middleware": middleware}
+            if prefix:
+                assert key.endswith("_"), key
+                self.prefixes[key] = route
+            else:
+                self.exact[key] = route
+            return func
+        return decorator
+    
+    def match(self, data: str) -> tuple[dict | None, str | None]:
+        route = self.exact.get(data)
+        if route:
+            return route, None
+        end = data.rfind("_")
+        while end != -1:
+            route = self.prefixes.get(data[:end + 1])
+            if route:
+                return route, data[end + 1:]
+            end = data.rfind("_", 0, end)
+        return None, None
+    
+    async def dispatch(self, client: Client, query: CallbackQuery):
+        route, arg = self.match(query.data or "")
+        if not route:
+            await query.answer()
+            return
+        
+        args = (client, query)
+        if route["prefix"]:
+            try:
+                args += (route["parse"](arg) if route["parse"] else arg,)
+            except ValueError:
+                await query.answer("❌ Invalid request", show_alert=True)
+                return
+        
+        async def call_handler():
+            await route["func"](*args)
+        
+        call = call_handler
+        for middleware in reversed(route["middleware"]):
+            call = functools.partial(middleware, route, query, call)
+        await call()
+    
+    async def timing(self, route: dict, query: CallbackQuery, call_next):
+        started = time.perf_counter()
+        try:
+            await call_next()
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = self.stats.setdefault(route["name"], [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+    
+    def stats_text(self, top: int = 5) -> str:
+        if not self.stats:
+            return ""
+        busiest = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        lines = [
+            f"   {name}: {calls}× avg {total / calls * 1000:.0f}ms, max {worst * 1000:.0f}ms"
+            for name, (calls, total, worst) in busiest
+        ]
+        return "⏱ Callbacks:\n" + "\n".join(lines) + "\n"
+
+
+async def reviewer_only(route: dict, query: CallbackQuery, call_next):
+    if not reviewers.role(query.from_user.id):
+        await query.answer("❌ Admin only!", show_alert=True)
+        return
+    await call_next()
+
+
+async def answer_query(route: dict, query: CallbackQuery, call_next):
+    await query.answer()
+    await call_next()
+
+
+router = CallbackRouter()
+USER_RATE = (CALLBACK_RATE, CALLBACK_BURST)
+TRIAL_LIMIT = RateLimit(TRIAL_CLICK_RATE, TRIAL_CLICK_BURST)
+BUY_LIMIT = RateLimit(BUY_CLICK_RATE, BUY_CLICK_BURST)
+
+
+# ==========================
+# CALLBACK HANDLERS
+# ==========================
+# ========== FREE TRIAL (VLESS only) ==========
+@router.route("free_trial", rate=TRIAL_LIMIT)
+async def on_free_trial(client: Client, query: CallbackQuery):
+    user_id = query.from_user.id
+    user = query.from_user
+    
+    if storage.has_trial(user_id):
+        await tg_send(
+            query.message.reply_text,
+            "❌ **Free Trial ယူပြီးသားဖြစ်ပါတယ်။**",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices")],
+                [InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices")],
+                [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
+            ])
+        )
+        return
+    
+    if not xui:
+        await tg_send(query.message.reply_text, "❌ VLESS server not configured.")
+        return
+    
+    if user_id in trial_inflight:
+        # A previous tap is already issuing this user's trial
+        return
+    trial_inflight.add(user_id)
+    
+    try:
+        loading_msg = await tg_send(query.message.reply_text, "⏳ Trial key ထုတ်ပေးနေပါတယ်...")
+        
+        # Inbound params come from the prefetched cache and the Xray
+        # restart is deferred, so this is a single addClient call
+        tg_username = get_username(user)
+        result = await xui.add_client(
+            inbound_id=TRIAL_INBOUND_ID,
+            email=f"trial_{tg_username}",
+            tg_username=tg_username,
+            traffic_limit_gb=TRIAL_TRAFFIC_GB,
+            expiry_days=TRIAL_DURATION_HOURS / 24,
+            ip_limit=TRIAL_DEVICE_LIMIT,
+        )
+    finally:
+        trial_inflight.discard(user_id)
+    
+    if result:
+        expiry = result["expiry"].strftime("%Y-%m-%d %H:%M")
+        
+        with storage.batch():
+            storage.add_trial(user_id, result["vless_key"])
+            sub_id = storage.add_subscription(user_id, {
+                "plan": "Free Trial (VLESS)",
+                "type": "vless",
+                "status": "active",
+                "expiry": result["expiry"],
+                "key": result["vless_key"],
+                "sub_link": result["sub_link"],
+                "ip_limit": TRIAL_DEVICE_LIMIT,
+                "inbound_id": TRIAL_INBOUND_ID,
+                "uuid": result["uuid"],
+                "email": result["email"],
+            })
+        expiry_engine.add(sub_id, result["expiry"].timestamp())
         
-        await query.message.reply_text(
-            text,
+        await tg_send(
+            loading_msg.edit_text,
+            "🎁 **Free Trial Activated!**\n\n"
+            f"📱 Device Limit: {TRIAL_DEVICE_LIMIT}\n"
+            f"⏰ Duration: {TRIAL_DURATION_HOURS} Hours\n"
+            f"📅 Expires: {expiry}\n\n"
+            "🔑 **VLESS Key:**\n"
+            f"`{result['vless_key']}`\n\n"
+            "_(Tap to copy)_",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📱 Open Sub Link", url=result['sub_link'])],
+                [InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")],
+                [InlineKeyboardButton("⬅️ Menu", callback_data="back_menu")],
+            ]),
+            priority=PRIORITY_DELIVERY,
+        )
+    else:
+        await tg_send(
+            loading_msg.edit_text,
+            "❌ **Error ဖြစ်သွားပါတယ်။** Admin ကို ဆက်သွယ်ပါ။",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel_payment")],
+                [InlineKeyboardButton("🆘 Support", url=f"https://t.me/{ADMIN_USERNAME}")],
             ])
         )
 
-    # ========== CANCEL PAYMENT ==========
-    elif data == "cancel_payment":
-        user_states.pop(user_id, None)
-        await query.message.reply_text("❌ **ပယ်ဖျက်လိုက်ပါပြီ။**", reply_markup=get_main_menu_keyboard())
 
-    # ========== VPN APPS ==========
-    elif data == "vpn_apps":
-        text = "📲 **VPN Apps**\n\n"
-        text += "**🔐 For VLESS:**\n"
+# ========== MY SUBSCRIPTIONS ==========
+@router.route("my_subs", rate=USER_RATE)
+async def on_my_subs(client: Client, query: CallbackQuery):
+    user_id = query.from_user.id
+    
+    subs = storage.get_subscriptions(user_id)
+    if subs:
+        text = "📋 **Your Subscriptions:**\n\n"
         buttons = []
-        for app in VPN_APPS:
-            if app["for"] == "vless":
-                text += f"• {app['name']} - {app['platform']}\n"
-                buttons.append([InlineKeyboardButton(f"📥 {app['name']}", url=app["url"])])
-        
-        text += "\n**🌐 For Outline:**\n"
-        for app in VPN_APPS:
-            if app["for"] == "outline":
-                text += f"• {app['name']} - {app['platform']}\n"
-                buttons.append([InlineKeyboardButton(f"📥 {app['name']}", url=app["url"])])
-        
-        buttons.append([InlineKeyboardButton("⬅️ Back", callback_data="back_menu")])
-        await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ========== ADMIN APPROVE ==========
-    elif data.startswith("approve_"):
-        if user_id != ADMIN_USER_ID:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
-        
-        payment_id = data.replace("approve_", "")
-        
-        if payment_id not in pending_payments:
-            await query.answer("❌ Not found!", show_alert=True)
-            return
-        
-        payment = pending_payments[payment_id]
-        
-        if payment["status"] != "pending":
-            await query.answer("❌ Already processed!", show_alert=True)
-            return
-        
-        if payment_id in waiting_tasks:
-            waiting_tasks[payment_id].cancel()
-            del waiting_tasks[payment_id]
-        
-        pending_payments[payment_id]["status"] = "approved"
-        
-        plan = payment["plan"]
-        buyer_user_id = payment["user_id"]
-        tg_username = payment["username"]
-        plan_type = plan.get("type", "vless")
+        usage = storage.get_usage([key for sub in subs for key in usage_keys(sub)])
         
-        result = None
-        
-        if plan_type == "vless":
-            if not xui:
-                await query.message.edit_caption(
-                    caption=query.message.caption + "\n\n❌ VLESS server not configured!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("📤 Message User", url=f"tg://user?id={buyer_user_id}")],
-                    ])
-                )
-                del pending_payments[payment_id]
-                return
-            
-            # Generate VLESS key from 3X-UI
-            inbound_id = plan.get("inbound_id", PLAN1_INBOUND_ID)
-            result = await xui.add_client(
-                inbound_id=inbound_id,
-                email=f"{tg_username}_{plan['name'].replace(' ', '_')}",
-                tg_username=tg_username,
-                traffic_limit_gb=plan.get("traffic_gb", 0),
-                expiry_days=plan.get("days", 30),
-                ip_limit=plan.get("ip_limit", 1),
+        for i, sub in enumerate(subs, 1):
+            status_emoji = "✅" if sub.get("status") == "active" else "❌"
+            type_emoji = "🔐" if sub.get("type") == "vless" else "🌐"
+            text += (
+                f"**{i}. {type_emoji} {sub['plan']}** {status_emoji}\n"
+                f"   📅 Expires: {sub['expires']}\n"
+                f"{usage_text(sub, usage, indent='   ')}\n"
             )
-            
-            if result:
-                if buyer_user_id not in user_subscriptions:
-                    user_subscriptions[buyer_user_id] = []
-                
-                user_subscriptions[buyer_user_id].append({
-                    "plan": plan["name"],
-                    "type": "vless",
-                    "status": "active",
-                    "expires": result["expiry"].strftime("%Y-%m-%d %H:%M"),
-                    "key": result["vless_key"],
-                    "sub_link": result["sub_link"],
-                    "ip_limit": plan.get("ip_limit", 1),
-                })
-                
-                try:
-                    await client.send_message(
-                        chat_id=buyer_user_id,
-                        text=(
-                            "🎉 **Payment Approved!**\n"
-                            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                            f"🔐 **{plan['name']}** activated!\n\n"
-                            f"📱 IP Limit: {plan.get('ip_limit', 1)} device(s)\n"
-                            f"📅 Duration: {plan.get('days', 30)} days\n"
-                            f"⏰ Expires: {result['expiry'].strftime('%Y-%m-%d %H:%M')}\n\n"
-                            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                            "🔑 **VLESS Key (Tap to copy):**\n"
-                            f"`{result['vless_key']}`\n\n"
-                            "ကျေးဇူးတင်ပါတယ် 🙏"
-                        ),
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("📱 Open Sub Link", url=result['sub_link'])],
-                            [InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs")],
-                            [InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")],
-                        ])
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send to user: {e}")
-                
-                await query.message.edit_caption(
-                    caption=query.message.caption + f"\n\n✅ **APPROVED**\n🔐 VLESS Key sent",
-                    reply_markup=None
-                )
-        
-        else:
-            # Generate Outline keys from Marzban
-            if not marzban:
-                await query.message.edit_caption(
-                    caption=query.message.caption + "\n\n❌ Marzban server not configured!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("📤 Message User", url=f"tg://user?id={buyer_user_id}")],
-                    ])
-                )
-                del pending_payments[payment_id]
-                return
-            
-            num_keys = plan.get("num_keys", 1)
-            generated_keys = []
-            sub_link = None
-            expiry = None
-            
-            for i in range(num_keys):
-                key_result = await marzban.create_user(
-                    username=f"{tg_username}_key{i+1}",
-                    traffic_limit_gb=plan.get("traffic_gb", 0),
-                    expiry_days=plan.get("days", 30),
-                )
-                
-                if key_result:
-                    generated_keys.append(key_result["ss_key"])
-                    if not sub_link:
-                        sub_link = key_result.get("sub_link", "")
-                    if not expiry:
-                        expiry = key_result["expiry"]
-            
-            if generated_keys:
-                if buyer_user_id not in user_subscriptions:
-                    user_subscriptions[buyer_user_id] = []
-                
-                user_subscriptions[buyer_user_id].append({
-                    "plan": plan["name"],
-                    "type": "outline",
-                    "status": "active",
-                    "expires": expiry.strftime("%Y-%m-%d %H:%M") if expiry else "N/A",
-                    "keys": generated_keys,
-                    "key": generated_keys[0],
-                    "sub_link": sub_link,
-                    "num_keys": len(generated_keys),
-                })
-                
-                # Build message with all keys
-                keys_text = ""
-                for i, key in enumerate(generated_keys, 1):
-                    keys_text += f"**Key #{i}:**\n`{key}`\n\n"
-                
-                try:
-                    await client.send_message(
-                        chat_id=buyer_user_id,
-                        text=(
-                            "🎉 **Payment Approved!**\n"
-                            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                            f"🌐 **{plan['name']}** activated!\n\n"
-                            f"🔑 Keys: {len(generated_keys)}\n"
-                            f"📅 Duration: {plan.get('days', 30)} days\n"
-                            f"⏰ Expires: {expiry.strftime('%Y-%m-%d %H:%M') if expiry else 'N/A'}\n\n"
-                            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                            "🔑 **Outline Keys (Tap to copy):**\n\n"
-                            f"{keys_text}"
-                            "💡 Outline app ဖွင့်ပြီး key ကို paste လုပ်ပါ။\n\n"
-                            "ကျေးဇူးတင်ပါတယ် 🙏"
-                        ),
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("📋 My Subscriptions", callback_data="my_subs")],
-                            [InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")],
-                        ])
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send to user: {e}")
-                
-                await query.message.edit_caption(
-                    caption=query.message.caption + f"\n\n✅ **APPROVED**\n🌐 {len(generated_keys)} Outline Key(s) sent",
-                    reply_markup=None
-                )
-                
-                result = True  # Mark as successful
+            buttons.append([InlineKeyboardButton(
+                f"🔑 View Key #{i}", 
+                callback_data=f"view_key_{i-1}"
+            )])
         
-        if not result:
-            try:
-                await client.send_message(
-                    chat_id=buyer_user_id,
-                    text="✅ Payment approved!\n⚠️ Key gen failed. Admin will send manually."
-                )
-            except:
-                pass
-            await query.message.edit_caption(
-                caption=query.message.caption + "\n\n✅ APPROVED - ⚠️ Key gen failed!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📤 Message User", url=f"tg://user?id={buyer_user_id}")],
-                ])
-            )
+        buttons.append([
+            InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices"),
+            InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices"),
+        ])
+        buttons.append([InlineKeyboardButton("⬅️ Back", callback_data="back_menu")])
         
-        del pending_payments[payment_id]
+        await tg_send(query.message.reply_text, text, reply_markup=InlineKeyboardMarkup(buttons))
+    else:
+        await tg_send(
+            query.message.reply_text,
+            "📋 **Subscription မရှိသေးပါ။**\n🎁 Free Trial စမ်းကြည့်ပါ!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🎁 Free Trial", callback_data="free_trial")],
+                [InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices")],
+                [InlineKeyboardButton("🌐 Outline VPN", callback_data="outline_prices")],
+                [InlineKeyboardButton("⬅️ Back", callback_data="back_menu")],
+            ])
+        )
 
-    # ========== ADMIN REJECT ==========
-    elif data.startswith("reject_"):
-        if user_id != ADMIN_USER_ID:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
-        
-        payment_id = data.replace("reject_", "")
-        
-        if payment_id not in pending_payments:
-            await query.answer("❌ Not found!", show_alert=True)
-            return
+
+# ========== VIEW KEY DETAILS ==========
+@router.route("view_key_", prefix=True, parse=int, rate=USER_RATE)
+async def on_view_key(client: Client, query: CallbackQuery, key_idx: int):
+    user_id = query.from_user.id
+    
+    subs = storage.get_subscriptions(user_id)
+    
+    if key_idx < len(subs):
+        sub = subs[key_idx]
+        type_emoji = "🔐" if sub.get("type") == "vless" else "🌐"
         
-        payment = pending_payments[payment_id]
+        # Handle multiple keys for Outline
+        keys = sub.get("keys", [sub.get("key", "N/A")])
+        if isinstance(keys, str):
+            keys = [keys]
         
-        if payment["status"] != "pending":
-            await query.answer("❌ Already processed!", show_alert=True)
-            return
+        text = (
+            f"{type_emoji} **{sub['plan']}**\n"
+            "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+            f"📅 Expires: {sub['expires']}\n"
+            f"{usage_text(sub, storage.get_usage(usage_keys(sub)))}"
+        )
         
-        if payment_id in waiting_tasks:
-            waiting_tasks[payment_id].cancel()
-            del waiting_tasks[payment_id]
+        if sub.get("type") == "vless":
+            text += f"📱 IP Limit: {sub.get('ip_limit', 1)} device(s)\n\n"
+            text += "🔑 **VLESS Key (Tap to copy):**\n"
+            text += f"`{keys[0]}`\n\n"
+        else:
+            text += f"🔑 Keys: {len(keys)}\n\n"
+            for i, key in enumerate(keys, 1):
+                text += f"**Key #{i}:**\n`{key}`\n\n"
         
-        pending_payments[payment_id]["status"] = "rejected"
+        if sub.get('sub_link'):
+            text += f"📱 **Subscription Link:**\n`{sub.get('sub_link')}`"
         
-        try:
-            await client.send_message(
-                chat_id=payment["user_id"],
-                text="❌ **Payment Rejected**\n\nအားနာပါတယ်ခင်ဗျာ... \nလူကြီးမင်း၏ Screenshot ကို ပြန်လည် စစ်ဆေးပေးပါဦးဗျာ။",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🆘 Contact Admin", url=f"https://t.me/{ADMIN_USERNAME}")],
-                    [InlineKeyboardButton("🔄 Try Again", callback_data="back_menu")],
-                ])
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify user: {e}")
+        buttons = []
+        if sub.get('sub_link'):
+            buttons.append([InlineKeyboardButton("📱 Open Sub Link", url=sub['sub_link'])])
+        if subscription_plan_key(sub):
+            buttons.append([InlineKeyboardButton("🔄 Renew", callback_data=f"renew_{sub['id']}")])
+        buttons.append([InlineKeyboardButton("📲 VPN Apps", callback_data="vpn_apps")])
+        buttons.append([InlineKeyboardButton("⬅️ Back", callback_data="my_subs")])
         
-        await query.message.edit_caption(
-            caption=query.message.caption + "\n\n❌ **REJECTED**",
-            reply_markup=None
+        await tg_send(query.message.reply_text, text, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+# ========== VLESS PRICES ==========
+@router.route("vless_prices", rate=USER_RATE)
+async def on_vless_prices(client: Client, query: CallbackQuery):
+    text, markup = views.get("vless_prices")
+    await tg_send(query.message.reply_text, text, reply_markup=markup)
+
+
+# ========== OUTLINE PRICES ==========
+@router.route("outline_prices", rate=USER_RATE)
+async def on_outline_prices(client: Client, query: CallbackQuery):
+    text, markup = views.get("outline_prices")
+    await tg_send(query.message.reply_text, text, reply_markup=markup)
+
+
+# ========== BUY VLESS PLAN ==========
+@router.route("buy_vless_", prefix=True, rate=BUY_LIMIT)
+async def on_buy_vless(client: Client, query: CallbackQuery, plan_no: str):
+    user_id = query.from_user.id
+    
+    plan_key = f"vless_{plan_no}"
+    plan = VLESS_PLANS.get(plan_key)
+    
+    if not plan:
+        return
+    
+    storage.set_state(user_id, {
+        "state": "waiting_screenshot",
+        "plan_key": plan_key,
+        "plan": plan
+    })
+    
+    text = (
+        f"🔐 **{plan['name']}**\n\n"
+        f"📱 IP Limit: {plan['ip_limit']} device(s)\n"
+        f"📊 Data: Unlimited\n"
+        f"⏰ Validity: {plan['days']} days\n"
+        f"💵 Price: **{plan['price']}**\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        "**💳 ငွေလွှဲရန်:**\n\n"
+        f"💰 **K Pay** - {PAYMENT_NAME}\n"
+        f"   📞 `{KPAY_NO}`\n\n"
+        f"💰 **AYA Pay** - {PAYMENT_NAME}\n"
+        f"   📞 `{AYA_NO}`\n\n"
+        f"💰 **Wave Pay** - {PAYMENT_NAME}\n"
+        f"   📞 `{WAVE_NO}`\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        "📸 **ငွေလွှဲပြီးရင် screenshot ပို့ပေးပါခင်ဗျာ။**\n\n"
+        "⚠️ **Note မှာ VPN နဲ့ ပတ်သတ်တဲ့ စာသားတွေ မရေးပါနဲ့နော်!**"
+    )
+    
+    await tg_send(
+        query.message.reply_text,
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel_payment")],
+        ])
+    )
+
+
+# ========== BUY OUTLINE PLAN ==========
+@router.route("buy_outline_", prefix=True, rate=BUY_LIMIT)
+async def on_buy_outline(client: Client, query: CallbackQuery, plan_no: str):
+    user_id = query.from_user.id
+    
+    plan_key = f"outline_{plan_no}"
+    plan = OUTLINE_PLANS.get(plan_key)
+    
+    if not plan:
+        return
+    
+    storage.set_state(user_id, {
+        "state": "waiting_screenshot",
+        "plan_key": plan_key,
+        "plan": plan
+    })
+    
+    text = (
+        f"🌐 **{plan['name']}**\n\n"
+        f"🔑 Keys: {plan['num_keys']}\n"
+        f"📊 Data: Unlimited\n"
+        f"⏰ Validity: {plan['days']} days\n"
+        f"💵 Price: **{plan['price']}**\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        "**💳 ငွေလွှဲရန်:**\n\n"
+        f"💰 **K Pay** - {PAYMENT_NAME}\n"
+        f"   📞 `{KPAY_NO}`\n\n"
+        f"💰 **AYA Pay** - {PAYMENT_NAME}\n"
+        f"   📞 `{AYA_NO}`\n\n"
+        f"💰 **Wave Pay** - {PAYMENT_NAME}\n"
+        f"   📞 `{WAVE_NO}`\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        "📸 **ငွေလွှဲပြီးရင် screenshot ပို့ပေးပါ။**\n\n"
+        "⚠️ **Note မှာ VPN နဲ့ ပတ်သတ်တဲ့ စာသားတွေ မရေးပါနဲ့နော်!**"
+    )
+    
+    await tg_send(
+        query.message.reply_text,
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel_payment")],
+        ])
+    )
+
+
+# ========== RENEW SUBSCRIPTION ==========
+@router.route("renew_", prefix=True, parse=int, rate=BUY_LIMIT)
+async def on_renew(client: Client, query: CallbackQuery, sub_id: int):
+    user_id = query.from_user.id
+    
+    sub = storage.get_subscription(sub_id)
+    if not sub or sub["user_id"] != user_id:
+        return
+    plan_key = subscription_plan_key(sub)
+    if not plan_key:
+        return
+    
+    # Same payment flow as a new purchase; approval extends this subscription
+    plan_type, plan_no = plan_key.split("_", 1)
+    buy = on_buy_vless if plan_type == "vless" else on_buy_outline
+    await buy(client, query, plan_no)
+    storage.set_state(user_id, {**storage.get_state(user_id), "renew_sub_id": sub_id})
+
+
+# ========== CANCEL PAYMENT ==========
+@router.route("cancel_payment", rate=USER_RATE)
+async def on_cancel_payment(client: Client, query: CallbackQuery):
+    user_id = query.from_user.id
+    
+    storage.clear_state(user_id)
+    text, markup = views.get("cancelled")
+    await tg_send(query.message.reply_text, text, reply_markup=markup)
+
+
+# ========== VPN APPS ==========
+@router.route("vpn_apps", rate=USER_RATE)
+async def on_vpn_apps(client: Client, query: CallbackQuery):
+    text, markup = views.get("vpn_apps")
+    await tg_send(query.message.reply_text, text, reply_markup=markup)
+
+
+# ========== ADMIN APPROVE ==========
+def approve_payment(payment: dict, admin_ref: dict, reviewer: int | None = None) -> bool:
+    """
+    Approve a pending payment and queue its provisioning job. `admin_ref`
+    is the admin photo (chat/message id, caption) the job reports back to.
+    False if the payment was no longer pending (or, with `reviewer`, is
+    assigned to someone else).
+    """
+    # Atomic pending -> approved transition, so a double click can't process twice
+    payment_id = payment["payment_id"]
+    if not storage.set_payment_status(payment_id, "approved", reviewer=reviewer):
+        return False
+    
+    animator.remove(payment_id)
+    # Keys are made by a provisioning worker, so a slow or down panel
+    # doesn't hold up the admin; the worker updates the caption
+    provisioner.submit(payment_id, "payment", {
+        "user_id": payment["user_id"],
+        "username": payment["username"],
+        "plan": payment["plan"],
+        "plan_key": payment["plan_key"],
+        "renew_sub_id": payment.get("renew_sub_id"),
+        **admin_ref,
+    })
+    return True
+
+
+def not_yours_text(payment_id: str) -> str:
+    """Why an approve/reject didn't go through."""
+    payment = storage.get_payment(payment_id)
+    if payment and payment["status"] == "pending":
+        return "🔀 Reassigned to another reviewer"
+    return "❌ Already processed!"
+
+
+@router.route("approve_", prefix=True, reviewer=True, answer=False)
+async def on_approve(client: Client, query: CallbackQuery, payment_id: str):
+    payment = storage.get_payment(payment_id)
+    
+    if not payment:
+        await query.answer("❌ Not found!", show_alert=True)
+        return
+    
+    admin_ref = {
+        "admin_chat_id": query.message.chat.id,
+        "admin_message_id": query.message.id,
+        "caption": query.message.caption,
+    }
+    if not approve_payment(payment, admin_ref, reviewers.scope(query.from_user.id)):
+        await query.answer(not_yours_text(payment_id), show_alert=True)
+        return
+    
+    await query.answer()
+    await tg_send(
+        query.message.edit_caption,
+        caption=query.message.caption + "\n\n✅ **APPROVED**\n⏳ Generating key...",
+        reply_markup=None,
+        priority=PRIORITY_ADMIN,
+    )
+
+
+# ========== ADMIN RETRY FAILED JOB ==========
+@router.route("retry_job_", prefix=True, reviewer=True, answer=False)
+async def on_retry_job(client: Client, query: CallbackQuery, job_id: str):
+    job = storage.get_job(job_id)
+    if not job or job["status"] != "failed":
+        await query.answer("❌ Already processed!", show_alert=True)
+        return
+    # Payment jobs are keyed by payment id; same reviewer scope as approve/reject
+    if not reviewers.may_handle(query.from_user.id, storage.get_payment(job_id)):
+        await query.answer("🔀 Assigned to another reviewer", show_alert=True)
+        return
+    
+    await query.answer()
+    provisioner.requeue(job)
+    await tg_send(
+        query.message.edit_caption,
+        caption=job["data"]["caption"] + "\n\n✅ **APPROVED**\n⏳ Retrying key generation...",
+        reply_markup=None,
+        priority=PRIORITY_ADMIN,
+    )
+
+
+# ========== ADMIN REJECT ==========
+async def notify_rejected(client: Client, payment: dict, admin_ref: dict):
+    """Tell the user their payment was rejected and mark the admin photo."""
+    try:
+        await tg_send(
+            client.send_message,
+            chat_id=payment["user_id"],
+            text="❌ **Payment Rejected**\n\nအားနာပါတယ်ခင်ဗျာ... \nလူကြီးမင်း၏ Screenshot ကို ပြန်လည် စစ်ဆေးပေးပါဦးဗျာ။",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🆘 Contact Admin", url=f"https://t.me/{ADMIN_USERNAME}")],
+                [InlineKeyboardButton("🔄 Try Again", callback_data="back_menu")],
+            ]),
+            priority=PRIORITY_DELIVERY,
         )
-        
-        del pending_payments[payment_id]
+    except Exception as e:
+        logger.error(f"Failed to notify user: {e}")
+    
+    await edit_admin_caption(client, admin_ref, "\n\n❌ **REJECTED**")
+
+
+@router.route("reject_", prefix=True, reviewer=True, answer=False)
+async def on_reject(client: Client, query: CallbackQuery, payment_id: str):
+    payment = storage.get_payment(payment_id)
+    
+    if not payment:
+        await query.answer("❌ Not found!", show_alert=True)
+        return
+    
+    # Atomic pending -> rejected transition, so a double click can't process twice
+    if not storage.set_payment_status(payment_id, "rejected", reviewer=reviewers.scope(query.from_user.id)):
+        await query.answer(not_yours_text(payment_id), show_alert=True)
+        return
+    
+    animator.remove(payment_id)
+    await query.answer()
+    
+    await notify_rejected(client, payment, {
+        "admin_chat_id": query.message.chat.id,
+        "admin_message_id": query.message.id,
+        "caption": query.message.caption,
+    })
+
+
+# ========== ADMIN REVIEW QUEUE ==========
+review_selection = {}   # admin user_id -> payment ids ticked in the queue view
+
+
+def format_age(seconds: float) -> str:
+    seconds = int(max(0, seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m"
+    if seconds < 86400:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    return f"{seconds // 86400}d {seconds % 86400 // 3600}h"
+
+
+def queue_summary(reviewer: int | None = None) -> str:
+    pending = storage.count_payments("pending", reviewer)
+    oldest = storage.oldest_payment_at("pending", reviewer)
+    if not oldest:
+        return f"{pending} pending"
+    return f"{pending} pending, oldest {format_age(time.time() - oldest)}"
+
+
+def review_digest(admin_id: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    One page of pending payments, oldest first, with tick boxes and bulk
+    actions. Reviewers see the payments assigned to them, the owner all.
+    """
+    scope = reviewers.scope(admin_id)
+    pending = storage.count_payments("pending", scope)
+    pages = max(1, -(-pending // QUEUE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    payments = storage.list_payments("pending", limit=QUEUE_PAGE_SIZE, offset=page * QUEUE_PAGE_SIZE, reviewer=scope)
+    selected = review_selection.setdefault(admin_id, set())
+    
+    text = f"📥 **Review Queue** ({queue_summary(scope)})\nPage {page + 1}/{pages}\n\n"
+    buttons = []
+    now = time.time()
+    for i, payment in enumerate(payments, page * QUEUE_PAGE_SIZE + 1):
+        payment_id = payment["payment_id"]
+        type_emoji = "🔐" if payment["plan"].get("type", "vless") == "vless" else "🌐"
+        flags = " 🔄" if payment.get("renew_sub_id") else ""
+        flags += " ⚠️ dup" if payment.get("duplicates") else ""
+        if scope is None and len(reviewers.reviewers) > 1:
+            flags += f" 👮 {payment.get('reviewer') or '-'}"
+        text += (
+            f"{i}. `{payment_id[:8]}` @{payment['username']}{flags}\n"
+            f"    {type_emoji} {payment['plan_name']} - {payment['plan']['price']} - {format_age(now - payment['timestamp'])} ago\n"
+        )
+        tick = "☑️" if payment_id in selected else "⬜"
+        buttons.append([InlineKeyboardButton(f"{tick} {i}. {payment_id[:8]}", callback_data=f"qsel_{page}_{payment_id}")])
+    if not payments:
+        text += "✅ Nothing to review.\n"
+    text += f"\nSelected: {len(selected)}"
+    
+    buttons.append([
+        InlineKeyboardButton("⬅️", callback_data=f"qpage_{page - 1}"),
+        InlineKeyboardButton("🔄 Refresh", callback_data=f"qpage_{page}"),
+        InlineKeyboardButton("➡️", callback_data=f"qpage_{page + 1}"),
+    ])
+    buttons.append([
+        InlineKeyboardButton("☑️ Select page", callback_data=f"qall_{page}"),
+        InlineKeyboardButton("✖️ Clear", callback_data=f"qclear_{page}"),
+    ])
+    buttons.append([
+        InlineKeyboardButton(f"✅ Approve selected ({len(selected)})", callback_data=f"qapprove_{page}"),
+        InlineKeyboardButton("❌ Reject selected", callback_data=f"qreject_{page}"),
+    ])
+    return text, InlineKeyboardMarkup(buttons)
+
+
+async def show_review_digest(query: CallbackQuery, page: int):
+    text, markup = review_digest(query.from_user.id, page)
+    try:
+        await tg_send(query.message.edit_text, text, reply_markup=markup, priority=PRIORITY_ADMIN)
+    except Exception:
+        # Telegram refuses edits that change nothing
+        pass
+
+
+def selected_payments(admin_id: int) -> list:
+    """Ticked payments that are still pending (others are dropped from the selection)."""
+    selected = review_selection.pop(admin_id, set())
+    payments = [storage.get_payment(payment_id) for payment_id in selected]
+    pending = [p for p in payments if p and p["status"] == "pending"]
+    return sorted(pending, key=lambda p: p["timestamp"])
+
+
+def admin_ref_of(payment: dict) -> dict:
+    return {
+        "admin_chat_id": payment.get("admin_chat_id", ADMIN_USER_ID),
+        "admin_message_id": payment.get("admin_message_id"),
+        "caption": payment.get("caption", ""),
+    }
+
+
+@router.route("qpage_", prefix=True, parse=int, reviewer=True)
+async def on_queue_page(client: Client, query: CallbackQuery, page: int):
+    await show_review_digest(query, page)
 
-    # ========== BACK TO MENU ==========
-    elif data == "back_menu":
-        user_states.pop(user_id, None)
-        await query.message.reply_text("🔐 **Zembi VPN Bot**\n\nMenu:", reply_markup=get_main_menu_keyboard())
+
+def parse_queue_select(arg: str) -> tuple[int, str]:
+    """Split a "{page}_{payment_id}" argument; ValueError if malformed."""
+    page, payment_id = arg.split("_", 1)
+    return int(page), payment_id
+
+
+@router.route("qsel_", prefix=True, parse=parse_queue_select, reviewer=True)
+async def on_queue_select(client: Client, query: CallbackQuery, arg: tuple[int, str]):
+    page, payment_id = arg
+    selected = review_selection.setdefault(query.from_user.id, set())
+    selected.symmetric_difference_update({payment_id})
+    await show_review_digest(query, page)
+
+
+@router.route("qall_", prefix=True, parse=int, reviewer=True)
+async def on_queue_select_page(client: Client, query: CallbackQuery, page: int):
+    payments = storage.list_payments(
+        "pending", limit=QUEUE_PAGE_SIZE, offset=page * QUEUE_PAGE_SIZE, reviewer=reviewers.scope(query.from_user.id)
+    )
+    review_selection.setdefault(query.from_user.id, set()).update(p["payment_id"] for p in payments)
+    await show_review_digest(query, page)
+
+
+@router.route("qclear_", prefix=True, parse=int, reviewer=True)
+async def on_queue_clear(client: Client, query: CallbackQuery, page: int):
+    review_selection.pop(query.from_user.id, None)
+    await show_review_digest(query, page)
+
+
+@router.route("qapprove_", prefix=True, parse=int, reviewer=True, answer=False)
+async def on_queue_approve(client: Client, query: CallbackQuery, page: int):
+    # Every approval is its own provisioning job, so the workers (and the
+    # key pool) handle the whole batch in parallel; each job edits its
+    # admin photo when done
+    scope = reviewers.scope(query.from_user.id)
+    approved = sum(approve_payment(p, admin_ref_of(p), scope) for p in selected_payments(query.from_user.id))
+    await query.answer(f"✅ {approved} approved, generating keys...")
+    await show_review_digest(query, page)
+
+
+@router.route("qreject_", prefix=True, parse=int, reviewer=True, answer=False)
+async def on_queue_reject(client: Client, query: CallbackQuery, page: int):
+    scope = reviewers.scope(query.from_user.id)
+    rejected = []
+    for payment in selected_payments(query.from_user.id):
+        if storage.set_payment_status(payment["payment_id"], "rejected", reviewer=scope):
+            animator.remove(payment["payment_id"])
+            rejected.append(payment)
+    await query.answer(f"❌ {len(rejected)} rejected")
+    await show_review_digest(query, page)
+    await asyncio.gather(*(notify_rejected(client, p, admin_ref_of(p)) for p in rejected))
+
+
+# ========== BACK TO MENU ==========
+@router.route("back_menu", rate=USER_RATE)
+async def on_back_menu(client: Client, query: CallbackQuery):
+    user_id = query.from_user.id
+    
+    storage.clear_state(user_id)
+    text, markup = views.get("main_menu")
+    await tg_send(query.message.reply_text, text, reply_markup=markup)
+
+
+@app.on_callback_query()
+@dispatcher.per_user(lambda query: f"callback:{query.data}", on_drop=drop_callback)
+async def callback_handler(client: Client, query: CallbackQuery):
+    await router.dispatch(client, query)
 
 
 # ==========================
 # SCREENSHOT HANDLER
 # ==========================
 @app.on_message(filters.photo & filters.private)
+@dispatcher.per_user(lambda message: f"photo:{message.photo.file_unique_id}", on_drop=drop_photo, limit=PHOTO_LIMIT)
 async def screenshot_handler(client: Client, message: Message):
     user_id = message.from_user.id
     user = message.from_user
     
-    if user_id not in user_states or user_states[user_id].get("state") != "waiting_screenshot":
-        await message.reply_text(
+    state = storage.get_state(user_id)
+    if not state or state.get("state") != "waiting_screenshot":
+        await tg_send(
+            message.reply_text,
             "❓ Plan ရွေးပါ။",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔐 VLESS VPN", callback_data="vless_prices")],
@@ -1296,14 +4756,14 @@ async def screenshot_handler(client: Client, message: Message):
         )
         return
     
-    plan_key = user_states[user_id]["plan_key"]
-    plan = user_states[user_id]["plan"]
+    plan_key = state["plan_key"]
+    plan = state["plan"]
     tg_username = get_username(user)
     plan_type = plan.get("type", "vless")
     
     payment_id = str(uuid.uuid4())
     
-    pending_payments[payment_id] = {
+    payment = {
         "user_id": user_id,
         "username": tg_username,
         "first_name": user.first_name or "User",
@@ -1314,19 +4774,26 @@ async def screenshot_handler(client: Client, message: Message):
         "timestamp": time.time(),
         "status": "pending",
         "chat_id": message.chat.id,
+        "renew_sub_id": state.get("renew_sub_id"),
     }
     
-    user_states.pop(user_id, None)
+    storage.clear_state(user_id)
     
     type_emoji = "🔐" if plan_type == "vless" else "🌐"
     
-    waiting_msg = await message.reply_text(
+    waiting_msg = await tg_send(
+        message.reply_text,
         f"✅ **Screenshot လက်ခံရရှိပါပြီ!**\n\n"
         f"📦 Plan: {type_emoji} {plan['name']}\n"
         f"⏳ Admin စစ်ဆေးနေပါတယ်..."
     )
     
-    pending_payments[payment_id]["message_id"] = waiting_msg.id
+    payment["message_id"] = waiting_msg.id
+    storage.add_payment(payment_id, payment)
+    
+    screenshot_hash, duplicates = await screenshots.check(client, message)
+    if screenshot_hash is not None:
+        screenshots.add(screenshot_hash, payment_id, user_id)
     
     # Prepare admin text based on plan type
     if plan_type == "vless":
@@ -1334,6 +4801,9 @@ async def screenshot_handler(client: Client, message: Message):
     else:
         plan_info = f"🔑 Keys: {plan.get('num_keys', 1)}"
     
+    if payment["renew_sub_id"]:
+        plan_info += f"\n🔄 Renewal of subscription #{payment['renew_sub_id']}"
+    
     admin_text = (
         f"💳 **New Payment**\n"
         f"━━━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -1343,30 +4813,22 @@ async def screenshot_handler(client: Client, message: Message):
         f"📦 Plan: **{type_emoji} {plan['name']}**\n"
         f"💵 Price: {plan['price']}\n"
         f"{plan_info}\n\n"
+        f"{screenshots.caption_text(duplicates, user_id)}"
         f"💳 Payment ID: `{payment_id[:8]}`"
     )
     
     try:
-        await client.send_photo(
-            chat_id=ADMIN_USER_ID,
-            photo=message.photo.file_id,
-            caption=admin_text,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("✅ Approve", callback_data=f"approve_{payment_id}"),
-                    InlineKeyboardButton("❌ Reject", callback_data=f"reject_{payment_id}"),
-                ],
-            ])
-        )
+        storage.update_payment(payment_id, duplicates=[match[1] for match in duplicates])
+        # The photo goes to one reviewer, who is recorded on the payment
+        if await reviewers.assign(client, payment_id, message.photo.file_id, admin_text) is None:
+            raise RuntimeError("no reviewer could be reached")
         
-        task = asyncio.create_task(
-            show_waiting_animation(client, message.chat.id, waiting_msg.id, payment_id)
-        )
-        waiting_tasks[payment_id] = task
+        animator.add(message.chat.id, waiting_msg.id, payment_id)
         
     except Exception as e:
         logger.error(f"Failed to forward to admin: {e}")
-        await message.reply_text(
+        await tg_send(
+            message.reply_text,
             "❌ Admin ဆီပို့မရပါ။",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🆘 Contact Admin", url=f"https://t.me/{ADMIN_USERNAME}")],
@@ -1382,21 +4844,176 @@ async def admin_panel(client: Client, message: Message):
     if message.from_user.id != ADMIN_USER_ID:
         return
     
-    pending = len([p for p in pending_payments.values() if p["status"] == "pending"])
+    xray_text = ""
+    if xui:
+        restarter = xui.restarter
+        last = f"{restarter.last_latency:.2f}s" if restarter.last_latency is not None else "-"
+        xray_text = (
+            f"🔄 Xray restarts: {restarter.restarts} "
+            f"(failed: {restarter.failures}, last: {last}"
+            f"{', pending' if restarter.dirty else ''})\n"
+        )
+    
+    health_text = "".join(panel.breaker.health_text() for panel in (xui, marzban) if panel)
     
-    await message.reply_text(
+    await tg_send(
+        message.reply_text,
         f"👑 **Admin Panel**\n\n"
-        f"⏳ Pending: {pending}\n"
-        f"👥 Subscribers: {len(user_subscriptions)}\n"
-        f"🎁 Trial users: {len(user_trials)}\n\n"
+        f"⏳ Pending: {queue_summary()}\n"
+        f"👥 Subscribers: {storage.count_subscribers()}\n"
+        f"🎁 Trial users: {storage.count_trials()}\n\n"
+        f"**Panels:**\n"
+        f"{health_text}"
+        f"{xray_text}\n"
+        f"{key_pool.stats_text()}"
+        f"{provisioner.stats_text()}"
+        f"{expiry_engine.stats_text()}"
+        f"{client_gc.stats_text()}"
+        f"{usage_sync.stats_text()}"
+        f"{animator.stats_text()}"
+        f"{governor.stats_text()}"
+        f"{dispatcher.stats_text()}"
+        f"{RateLimit.stats_text()}"
+        f"{screenshots.stats_text()}"
+        f"{reviewers.stats_text()}"
+        f"{router.stats_text()}\n"
         f"**Commands:**\n"
-        f"/generate <user_id> <plan_key>"
+        f"/queue - review pending payments in bulk\n"
+        f"/generate <user_id> <plan_key> [count]\n"
+        f"/gc - delete long-expired panel clients now",
+        priority=PRIORITY_ADMIN,
+    )
+
+
+@app.on_message(filters.command("queue") & filters.private)
+async def admin_queue(client: Client, message: Message):
+    if not reviewers.role(message.from_user.id):
+        return
+    
+    text, markup = review_digest(message.from_user.id, 0)
+    await tg_send(message.reply_text, text, reply_markup=markup, priority=PRIORITY_ADMIN)
+
+
+@app.on_message(filters.command("gc") & filters.private)
+async def admin_gc(client: Client, message: Message):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    
+    status_msg = await tg_send(message.reply_text, "🧹 Collecting expired clients...", priority=PRIORITY_ADMIN)
+    try:
+        report = await client_gc.collect()
+    except Exception as e:
+        logger.error(f"Client GC failed: {e}")
+        report = f"❌ GC failed: {e}"
+    await tg_send(status_msg.edit_text, report, priority=PRIORITY_ADMIN)
+
+
+@app.on_message(filters.command("generate") & filters.private)
+async def admin_generate(client: Client, message: Message):
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    
+    args = message.text.split()
+    if len(args) < 3:
+        await tg_send(
+            message.reply_text,
+            "Usage: /generate <user_id> <plan_key> [count]\n"
+            f"Plans: {', '.join(VLESS_PLANS)}\n"
+            f"Count: 1-{BULK_GENERATE_MAX} keys in one panel request",
+            priority=PRIORITY_ADMIN,
+        )
+        return
+    
+    target_user = args[1]
+    plan_key = args[2]
+    
+    if plan_key not in VLESS_PLANS:
+        await tg_send(message.reply_text, f"❌ Invalid plan: {plan_key}", priority=PRIORITY_ADMIN)
+        return
+    
+    if not xui:
+        await tg_send(message.reply_text, "❌ VLESS server not configured.", priority=PRIORITY_ADMIN)
+        return
+    
+    count = int(args[3]) if len(args) > 3 and args[3].isdigit() else 1
+    if not 1 <= count <= BULK_GENERATE_MAX:
+        await tg_send(message.reply_text, f"❌ Count must be 1-{BULK_GENERATE_MAX}", priority=PRIORITY_ADMIN)
+        return
+    
+    plan = VLESS_PLANS[plan_key]
+    
+    results = await xui.add_clients(
+        inbound_id=plan.get("inbound_id", PLAN1_INBOUND_ID),
+        count=count,
+        email=f"manual_{target_user}",
+        tg_username=f"user_{target_user}",
+        traffic_limit_gb=plan.get("traffic_gb", 0),
+        expiry_days=plan.get("days", 30),
+        ip_limit=plan.get("ip_limit", 1),
     )
+    
+    if not results:
+        await tg_send(message.reply_text, "❌ Failed to generate key.", priority=PRIORITY_ADMIN)
+        return
+    
+    await tg_send(
+        message.reply_text,
+        f"✅ **{len(results)} Key(s) Generated!**\n\n"
+        f"📦 Plan: {plan['name']}\n"
+        f"📱 IP Limit: {plan.get('ip_limit', 1)}\n"
+        f"📅 Expires: {results[0]['expiry'].strftime('%Y-%m-%d')}",
+        priority=PRIORITY_ADMIN,
+    )
+    
+    # Telegram messages are capped at 4096 chars, so send keys in chunks
+    chunk = ""
+    for i, result in enumerate(results, 1):
+        entry = (
+            f"**#{i}** `{result['email']}`\n"
+            f"🔑 `{result['vless_key']}`\n"
+            f"📱 `{result['sub_link']}`\n\n"
+        )
+        if len(chunk) + len(entry) > 3500:
+            await tg_send(message.reply_text, chunk, priority=PRIORITY_ADMIN)
+            chunk = ""
+        chunk += entry
+    if chunk:
+        await tg_send(message.reply_text, chunk, priority=PRIORITY_ADMIN)
 
 
 # ==========================
 # MAIN
 # ==========================
+async def main():
+    screenshots.load()
+    await app.start()
+    if xui:
+        inbound_ids = [TRIAL_INBOUND_ID] + [p.get("inbound_id", PLAN1_INBOUND_ID) for p in VLESS_PLANS.values()]
+        asyncio.create_task(xui.warm_inbounds(inbound_ids))
+    key_pool.start()
+    animator.start(app)
+    provisioner.start(app)
+    expiry_engine.start(app)
+    client_gc.start(app)
+    usage_sync.start()
+    reviewers.start(app)
+    resume_waiting_animations()
+    await idle()
+    await animator.stop()
+    await provisioner.stop()
+    await expiry_engine.stop()
+    await client_gc.stop()
+    await usage_sync.stop()
+    await reviewers.stop()
+    await dispatcher.stop()
+    screenshots.close()
+    await key_pool.stop()
+    await governor.stop()
+    await app.stop()
+    await close_panel_sessions()
+    storage.close()
+
+
 if __name__ == "__main__":
     print("=" * 50)
     print("🚀 Zembi VPN Bot")
@@ -1405,7 +5022,7 @@ if __name__ == "__main__":
     print("=" * 50)
     
     try:
-        app.run()
+        app.run(main())
     except Exception as e:
         print(f"❌ Error: {e}")
         sys.exit(1)
\ No newline at end of file